@@ -2,13 +2,16 @@
 import os
 import logging
 import hashlib
+import io
+import mmap
+import struct
 import zipfile
-import tempfile
 from pathlib import Path
-from typing import Optional, Tuple, BinaryIO, Union
+from typing import Optional, Tuple, BinaryIO, Union, Dict, List
 
 from . import config
 from .phash_tool import PHashTool
+from .page_index import PageIndex, page_index_cache, IMAGE_EXTENSIONS
 
 try:
     import rarfile
@@ -22,8 +25,314 @@ try:
 except ImportError:
     py7zr = None
 
+try:
+    from py7zr.io import Py7zIO, WriterFactory
+except ImportError:
+    # 旧版 py7zr 没有 io 工厂接口 (提供 SevenZipFile.read)
+    Py7zIO = WriterFactory = object
+
 logger = logging.getLogger(__name__)
 
+# 文件头魔数 -> 归档格式
+ARCHIVE_SIGNATURES = (
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),      # 空 zip
+    (b'PK\x07\x08', 'zip'),      # 分卷标记
+    (b'Rar!\x1a\x07', 'rar'),    # RAR4 / RAR5
+    (b'7z\xbc\xaf\x27\x1c', '7z'),
+)
+SIGNATURE_LENGTH = max(len(sig) for sig, _ in ARCHIVE_SIGNATURES)
+
+# zip 本地文件头: 签名(4) ... 文件名长度(2) 扩展字段长度(2)，共 30 字节
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+ZIP_LOCAL_SIGNATURE = b'PK\x03\x04'
+
+# 流式 Hash 的缓冲区范围 (按成员大小自适应)
+HASH_CHUNK_MIN = 64 * 1024
+HASH_CHUNK_MAX = 1024 * 1024
+
+
+def detect_archive_format(header: bytes) -> Optional[str]:
+    """根据文件头魔数识别归档格式，无法识别返回 None"""
+    for signature, fmt in ARCHIVE_SIGNATURES:
+        if header.startswith(signature):
+            return fmt
+    return None
+
+
+class _TargetsComplete(Exception):
+    """7z 目标成员已全部解出，用于提前结束解压"""
+
+
+class _MemberBuffer(Py7zIO):
+    """7z 成员的内存写入目标；写满预期大小后通知收集器"""
+    def __init__(self, name: str, collector: "_MemberCollector"):
+        self.name = name
+        self._collector = collector
+        self._buf = io.BytesIO()
+
+    def write(self, s) -> int:
+        written = self._buf.write(s)
+        self._collector.on_write(self)
+        return written
+
+    def read(self, size: Optional[int] = None) -> bytes:
+        return self._buf.read(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._buf.seek(offset, whence)
+
+    def flush(self) -> None:
+        pass
+
+    def size(self) -> int:
+        return self._buf.getbuffer().nbytes
+
+    def getvalue(self) -> bytes:
+        return self._buf.getvalue()
+
+
+class _MemberCollector(WriterFactory):
+    """
+    7z 成员收集器 (py7zr WriterFactory)
+    成员直接解压到内存；所有目标都达到预期大小后抛出 _TargetsComplete，
+    solid 归档只需解码到最后一个目标为止，不必解完整个数据块。
+    """
+    def __init__(self, sizes: Dict[str, int]):
+        self.sizes = sizes
+        self.products: Dict[str, _MemberBuffer] = {}
+        self._complete = set()
+
+    def create(self, filename: str) -> _MemberBuffer:
+        buf = _MemberBuffer(filename, self)
+        self.products[filename] = buf
+        return buf
+
+    def on_write(self, buf: _MemberBuffer):
+        expected = self.sizes.get(buf.name)
+        if expected and buf.size() >= expected:
+            self._complete.add(buf.name)
+            if self._complete.issuperset(self.sizes):
+                raise _TargetsComplete()
+
+
+class ArchiveReader:
+    """
+    已打开的归档句柄
+    只读取一次文件头，按魔数识别 zip / rar / 7z 后打开对应的归档对象，
+    并缓存成员列表；计算 Hash、pHash 以及解压兜底都共用这一个句柄。
+    页面索引按 (路径, 大小, mtime) 缓存，同一文件再次打开时不再重新过滤排序。
+    """
+    def __init__(self, path: Path, fmt: str, handler, fileobj: Optional[BinaryIO] = None):
+        self.path = path
+        self.format = fmt
+        self.handler = handler
+        self._fileobj = fileobj
+        self._names: Optional[List[str]] = None
+        self._page_index: Optional[PageIndex] = None
+        self._cache_key = None
+        self._sizes: Optional[Dict[str, int]] = None
+        self._mmap: Optional[mmap.mmap] = None
+
+    @classmethod
+    def open(cls, archive_path: Union[str, Path]) -> Optional["ArchiveReader"]:
+        """
+        打开归档；格式不支持 (或缺少对应依赖) 时返回 None
+        :raises OSError / 归档库异常: 文件读取失败或归档损坏
+        """
+        archive_path = Path(archive_path)
+        f = open(archive_path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+        except OSError:
+            f.close()
+            raise
+        reader = cls._open_handler(archive_path, f)
+        if reader:
+            reader._cache_key = (str(archive_path), st.st_size, st.st_mtime)
+        return reader
+
+    @classmethod
+    def _open_handler(cls, archive_path: Path, f: BinaryIO) -> Optional["ArchiveReader"]:
+        """按文件头识别格式并打开对应的归档对象；失败或不支持时关闭 f"""
+        try:
+            fmt = detect_archive_format(f.read(SIGNATURE_LENGTH))
+            f.seek(0)
+            if fmt is None and zipfile.is_zipfile(f):
+                # 带前缀数据的 zip (如自解压包)，魔数不在文件开头
+                fmt = 'zip'
+                f.seek(0)
+
+            if fmt == 'zip':
+                return cls(archive_path, fmt, zipfile.ZipFile(f, 'r'), f)
+            if fmt == '7z' and py7zr:
+                return cls(archive_path, fmt, py7zr.SevenZipFile(f, mode='r'), f)
+
+            f.close()
+            if fmt == 'rar' and rarfile:
+                # rarfile 需要通过路径调用 UnRAR，由它自行管理文件句柄
+                return cls(archive_path, fmt, rarfile.RarFile(archive_path, 'r'))
+            return None
+        except Exception:
+            f.close()
+            raise
+
+    @property
+    def names(self) -> List[str]:
+        """归档成员列表 (首次访问时读取并缓存)"""
+        if self._names is None:
+            self._names = self.handler.getnames() if self.format == '7z' else self.handler.namelist()
+        return self._names
+
+    @property
+    def page_index(self) -> PageIndex:
+        """自然排序的页面索引 (首次访问时构建，并按文件状态缓存)"""
+        if self._page_index is None:
+            self._page_index = page_index_cache.get(self._cache_key) if self._cache_key else None
+            if self._page_index is None:
+                self._page_index = PageIndex(self.names)
+                if self._cache_key:
+                    page_index_cache.put(self._cache_key, self._page_index)
+        return self._page_index
+
+    @property
+    def images(self) -> List[str]:
+        """按自然顺序排列的页面"""
+        return self.page_index.pages
+
+    def select_target(self, target_mode: Union[str, int] = 'cover') -> Optional[str]:
+        """cover = 第一页；second = 第 10 页 (不足 10 页时取最后一页)；整数 = 第 N 页"""
+        return self.page_index.select(target_mode)
+
+    def open_member(self, name: str) -> BinaryIO:
+        """以流的方式打开成员；7z 不支持流式读取，解压到内存后返回 BytesIO"""
+        if self.format == '7z':
+            data = self.read(name)
+            if data is None:
+                # 与 zipfile / rarfile 一致：成员不存在时抛出 KeyError
+                raise KeyError(f"成员不存在: {name}")
+            return io.BytesIO(data)
+        return self.handler.open(name)
+
+    def read_members(self, names: List[str]) -> Dict[str, bytes]:
+        """读取多个成员到内存"""
+        names = list(dict.fromkeys(names))
+        if self.format == '7z':
+            return self._read_7z_members(names)
+        result = {}
+        for name in names:
+            span = self.stored_span(name)
+            if span:
+                result[name] = self.mapping[span[0]:span[1]]
+            else:
+                result[name] = self.handler.read(name)
+        return result
+
+    @property
+    def mapping(self) -> mmap.mmap:
+        """归档文件的只读内存映射 (仅 zip，首次访问时创建)"""
+        if self._mmap is None:
+            self._mmap = mmap.mmap(self._fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def stored_span(self, name: str) -> Optional[Tuple[int, int]]:
+        """
+        未压缩 (STORED) zip 成员在文件中的数据区间 [start, end)
+        压缩、加密或本地文件头异常的成员返回 None，由调用方走常规读取
+        """
+        if self.format != 'zip':
+            return None
+        info = self.handler.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            return None
+
+        mm = self.mapping
+        offset = info.header_offset
+        if offset + ZIP_LOCAL_HEADER.size > len(mm):
+            return None
+        signature, name_len, extra_len = ZIP_LOCAL_HEADER.unpack_from(mm, offset)
+        if signature != ZIP_LOCAL_SIGNATURE:
+            return None
+        start = offset + ZIP_LOCAL_HEADER.size + name_len + extra_len
+        end = start + info.compress_size
+        if end > len(mm):
+            return None
+        return start, end
+
+    def member_size(self, name: str) -> int:
+        """成员解压后的大小 (未知时返回 0)"""
+        if self.format == '7z':
+            return 0
+        try:
+            return self.handler.getinfo(name).file_size
+        except Exception:
+            return 0
+
+    def _read_7z_members(self, names: List[str]) -> Dict[str, bytes]:
+        """
+        7z 成员直接解压到内存 (不落盘)
+        一次 extract 取出全部目标，目标齐全后立即停止解码
+        """
+        if WriterFactory is object:
+            # 旧版 py7zr: read() 返回 {成员名: BytesIO}
+            try:
+                return {name: bio.read() for name, bio in self.handler.read(targets=names).items()}
+            finally:
+                self.handler.reset()
+
+        if self._sizes is None:
+            self._sizes = {info.filename: info.uncompressed for info in self.handler.list()}
+        collector = _MemberCollector({name: self._sizes.get(name, 0) for name in names})
+        try:
+            self.handler.extract(targets=names, factory=collector)
+        except _TargetsComplete:
+            pass
+        finally:
+            self.handler.reset()
+
+        result = {}
+        for name in names:
+            buf = collector.products.get(name)
+            if buf is not None and buf.size() == self._sizes.get(name, buf.size()):
+                result[name] = buf.getvalue()
+        return result
+
+    def read(self, name: str) -> Optional[bytes]:
+        return self.read_members([name]).get(name)
+
+    def extract_members(self, names: List[str], dest_dir: Path) -> Dict[str, Path]:
+        """解压成员到 dest_dir，返回 {成员名: 解压后的路径}"""
+        result = {}
+        if self.format == '7z':
+            # 先解压到内存再按成员名写出，路径与成员名一一对应
+            for name, data in self.read_members(names).items():
+                extracted = dest_dir / name
+                extracted.parent.mkdir(parents=True, exist_ok=True)
+                extracted.write_bytes(data)
+                result[name] = extracted
+        else:
+            for name in names:
+                self.handler.extract(name, dest_dir)
+                result[name] = dest_dir / name
+        return result
+
+    def close(self):
+        try:
+            self.handler.close()
+        finally:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if self._fileobj:
+                self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class ArchiveProcessor:
     def __init__(self):
         self._check_dependencies()
@@ -32,17 +341,37 @@ class ArchiveProcessor:
         missing = []
         if not rarfile: missing.append("rarfile")
         if not py7zr: missing.append("py7zr")
-        if not PHashTool.is_available(): missing.append("Pillow/ImageHash (pHash查重)")
-        
+        if not PHashTool.is_available(): missing.append("Pillow/NumPy (pHash查重)")
+
         if missing:
             logger.debug(f"ℹ️ [Init] 部分依赖未安装: {', '.join(missing)}")
 
-    def calculate_sha1_from_stream(self, file_stream: BinaryIO) -> str:
+    def calculate_sha1_from_stream(self, file_stream: BinaryIO, chunk_size: int = HASH_CHUNK_MIN) -> str:
         sha1 = hashlib.sha1()
-        while chunk := file_stream.read(65536):
+        while chunk := file_stream.read(chunk_size):
             sha1.update(chunk)
         return sha1.hexdigest()
 
+    def calculate_member_sha1(self, reader: ArchiveReader, name: str) -> str:
+        """
+        计算归档成员的 SHA1
+        STORED zip 成员直接对内存映射切片计算 (无拷贝)；其余成员流式读取，缓冲区随成员大小调整
+        """
+        span = reader.stored_span(name)
+        if span:
+            with memoryview(reader.mapping) as view, view[span[0]:span[1]] as data:
+                return hashlib.sha1(data).hexdigest()
+
+        if reader.format == '7z':
+            data = reader.read(name)
+            if data is None:
+                raise KeyError(name)
+            return hashlib.sha1(data).hexdigest()
+
+        chunk_size = min(max(reader.member_size(name), HASH_CHUNK_MIN), HASH_CHUNK_MAX)
+        with reader.open_member(name) as f_stream:
+            return self.calculate_sha1_from_stream(f_stream, chunk_size)
+
     def calculate_sha1(self, file_path: Union[str, Path]) -> Optional[str]:
         try:
             with open(file_path, 'rb') as f:
@@ -51,123 +380,74 @@ class ArchiveProcessor:
             logger.error(f"❌ [IO] 读取文件失败: {file_path} - {e}")
             return None
 
-    def get_file_hash(self, archive_path: Union[str, Path], target_mode: str = 'cover') -> Tuple[Optional[str], str]:
+    def open_archive(self, archive_path: Union[str, Path]) -> Tuple[Optional[ArchiveReader], str]:
+        """
+        打开归档 (单次探测)
+        :return: (reader, status)，status 为 OK / UNSUPPORTED / FILE_ERROR
+        """
         archive_path = Path(archive_path)
         if not archive_path.exists():
             return None, "FILE_ERROR"
-
-        f_hash, status = self._get_hash_from_archive_stream(archive_path, target_mode)
-
-        if status == "USE_FALLBACK":
-            with tempfile.TemporaryDirectory() as temp_dir:
-                extracted_path, extract_status = self._extract_image_to_disk(archive_path, target_mode, Path(temp_dir))
-                if extracted_path:
-                    f_hash = self.calculate_sha1(extracted_path)
-                    return f_hash, "OK"
-                else:
-                    return None, extract_status 
-
-        return f_hash, status
-
-    # [集成] pHash 计算
-    def get_image_phash(self, archive_path: Union[str, Path]) -> Optional[str]:
-        if not PHashTool.is_available():
-            return None
-
-        archive_path = Path(archive_path)
-        if not archive_path.exists(): return None
-
         try:
-            image_data = self._get_image_bytes_from_archive(archive_path)
-            
-            if not image_data:
-                 with tempfile.TemporaryDirectory() as temp_dir:
-                    extracted_path, status = self._extract_image_to_disk(archive_path, 'cover', Path(temp_dir))
-                    if status == 'OK' and extracted_path:
-                        with open(extracted_path, 'rb') as f:
-                            image_data = f.read()
-
-            return PHashTool.compute(image_data)
-
+            reader = ArchiveReader.open(archive_path)
         except Exception as e:
-            logger.warning(f"⚠️ [pHash] 计算异常 {archive_path.name}: {e}")
-            return None
-
-    def _get_image_bytes_from_archive(self, archive_path: Path) -> Optional[bytes]:
-        try:
-            if zipfile.is_zipfile(archive_path):
-                with zipfile.ZipFile(archive_path, 'r') as zf:
-                    imgs = sorted([f for f in zf.namelist() if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))])
-                    if imgs: return zf.read(imgs[0])
-            elif rarfile and rarfile.is_rarfile(archive_path):
-                with rarfile.RarFile(archive_path, 'r') as rf:
-                    imgs = sorted([f for f in rf.namelist() if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))])
-                    if imgs: return rf.read(imgs[0])
-        except Exception:
-            pass
-        return None
-    
-    def _get_hash_from_archive_stream(self, archive_path: Path, target_mode: str) -> Tuple[Optional[str], str]:
-        is_zip = zipfile.is_zipfile(archive_path)
-        is_rar = rarfile and rarfile.is_rarfile(archive_path) if rarfile else False
-
-        if not (is_zip or is_rar):
-            if py7zr and py7zr.is_7zfile(archive_path): return None, "USE_FALLBACK"
+            logger.debug(f"⚠️ [Archive] 打开失败 {archive_path.name}: {e}")
+            return None, "FILE_ERROR"
+        if reader is None:
             return None, "UNSUPPORTED"
+        return reader, "OK"
 
-        archive_handler = None
-        try:
-            if is_zip:
-                archive_handler = zipfile.ZipFile(archive_path, 'r')
-                namelist = archive_handler.namelist()
-            else:
-                archive_handler = rarfile.RarFile(archive_path, 'r')
-                namelist = archive_handler.namelist()
+    def get_fingerprint(self, archive_path: Union[str, Path], pages: Optional[List[Union[str, int]]] = None) -> Dict:
+        """
+        一次打开归档，计算扫描 / 重试 / 查重所需的全部指纹
+        :param pages: 额外计算 SHA1 的页面位置标签 (见 PageIndex.position)，结果存入 page_hashes
+        :return: {'status', 'cover_sha1', 'second_sha1', 'cover_phash', 'image_count', 'archive_format', 'page_hashes'}
+                 page_hashes 为 {标签: sha1}，超出页数的位置值为 None
+        """
+        archive_path = Path(archive_path)
+        fp = {
+            'status': 'FILE_ERROR', 'cover_sha1': None, 'second_sha1': None,
+            'cover_phash': None, 'image_count': 0, 'archive_format': None, 'page_hashes': {}
+        }
 
-            imgs = sorted([f for f in namelist if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))])
-            if not imgs: return None, "NO_IMAGES"
+        reader, status = self.open_archive(archive_path)
+        if not reader:
+            fp['status'] = status
+            return fp
 
-            target_img = imgs[0]
-            if target_mode == 'second':
-                 target_img = imgs[9] if len(imgs) >= 10 else imgs[-1]
+        try:
+            with reader:
+                fp['archive_format'] = reader.format
+                fp['image_count'] = reader.page_index.count
+                if not reader.page_index.count:
+                    fp['status'] = 'NO_IMAGES'
+                    return fp
 
-            with archive_handler.open(target_img) as f_stream:
-                return self.calculate_sha1_from_stream(f_stream), "OK"
-        except Exception:
-            return None, "USE_FALLBACK"
-        finally:
-            if archive_handler: archive_handler.close()
+                cover = reader.select_target('cover')
+                second = reader.select_target('second')
+                positions = {str(label): reader.page_index.position(label) for label in pages or []}
+                others = list(dict.fromkeys(n for n in [second, *positions.values()] if n and n != cover))
 
-    def _extract_image_to_disk(self, archive_path: Path, target_mode: str, temp_dir: Path) -> Tuple[Optional[Path], str]:
-        handler = None
-        is_7z = False
-        try:
-            if py7zr and py7zr.is_7zfile(archive_path):
-                handler = py7zr.SevenZipFile(archive_path, mode='r'); is_7z = True
-            elif zipfile.is_zipfile(archive_path):
-                handler = zipfile.ZipFile(archive_path, 'r')
-            elif rarfile and rarfile.is_rarfile(archive_path):
-                handler = rarfile.RarFile(archive_path, 'r')
-            
-            if not handler: return None, "UNSUPPORTED"
-
-            with handler:
-                names = handler.getnames() if is_7z else handler.namelist()
-                imgs = sorted([f for f in names if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))])
-                if not imgs: return None, "NO_IMAGES"
-
-                target_img = imgs[0]
-                if target_mode == 'second':
-                     target_img = imgs[9] if len(imgs) >= 10 else imgs[-1]
-                
-                if is_7z:
-                    handler.extract(path=temp_dir, targets=[target_img])
-                    for root, _, files in os.walk(temp_dir):
-                        for file in files:
-                            if file.endswith(Path(target_img).name): return Path(root) / file, "OK"
+                if reader.format == '7z':
+                    # 7z 一次解压取出全部目标
+                    data = reader.read_members([cover] + others)
+                    if data.get(cover) is None or data.get(second) is None:
+                        return fp
+                    cover_data = data[cover]
+                    hashes = {name: hashlib.sha1(data[name]).hexdigest() for name in others if name in data}
                 else:
-                    handler.extract(target_img, temp_dir)
-                    return temp_dir / target_img, "OK"
-                return None, "FILE_ERROR"
+                    # 封面需要字节计算 pHash；其余页面只需 Hash
+                    cover_data = reader.read(cover)
+                    hashes = {name: self.calculate_member_sha1(reader, name) for name in others}
+
+                hashes[cover] = hashlib.sha1(cover_data).hexdigest()
+                fp['cover_sha1'] = hashes[cover]
+                fp['second_sha1'] = hashes[second]
+                fp['page_hashes'] = {label: hashes.get(name) if name else None for label, name in positions.items()}
+                fp['cover_phash'] = PHashTool.compute(cover_data)
+                fp['status'] = 'OK'
+                return fp
         except Exception as e:
-            return None, "FILE_ERROR"
\ No newline at end of file
+            logger.warning(f"⚠️ [Fingerprint] 读取失败 {archive_path.name}: {e}")
+            return fp
+
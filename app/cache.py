@@ -0,0 +1,165 @@
+# app/cache.py
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+GalleryKey = Tuple[int, str]
+
+class MetadataCache:
+    """
+    画廊元数据缓存
+    内存 LRU (有上限) + SQLite 持久化 (eh_scan_results.db 的 metadata_cache 表)
+    存储 gdata 接口返回的原始 gmetadata，超过 TTL 的条目视为未命中
+    """
+    def __init__(self, db=None, max_items: int = 2048, ttl_days: float = 30):
+        """
+        :param db: DatabaseManager 实例；为 None 时只使用内存缓存
+        :param max_items: 内存 LRU 最大条目数
+        :param ttl_days: 缓存有效期 (天)，<= 0 表示永不过期
+        """
+        self.db = db
+        self.max_items = max(1, max_items)
+        self.ttl = ttl_days * 86400 if ttl_days and ttl_days > 0 else None
+
+        self._lru: "OrderedDict[GalleryKey, Tuple[Dict, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0}
+
+    def get_many(self, keys: List[GalleryKey]) -> Dict[GalleryKey, Dict]:
+        """批量查询：先查内存，再一次性查数据库，返回命中的 {key: gmetadata}"""
+        result = {}
+        missing = []
+        now = time.time()
+
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                entry = self._lru.get(key)
+                if entry and not self._is_expired(entry[1], now):
+                    self._lru.move_to_end(key)
+                    result[key] = entry[0]
+                    self._stats['memory_hits'] += 1
+                else:
+                    if entry:
+                        del self._lru[key]
+                    missing.append(key)
+
+        if missing and self.db:
+            min_fetched_at = now - self.ttl if self.ttl else 0
+            rows = self.db.get_cached_metadata(missing, min_fetched_at=min_fetched_at)
+            loaded = {}
+            for key, data in rows.items():
+                try:
+                    loaded[key] = json.loads(data)
+                except (TypeError, ValueError):
+                    continue
+            with self._lock:
+                for key, gmeta in loaded.items():
+                    self._remember(key, gmeta, now)
+                self._stats['db_hits'] += len(loaded)
+            result.update(loaded)
+
+        with self._lock:
+            self._stats['misses'] += sum(1 for key in missing if key not in result)
+        return result
+
+    def get(self, key: GalleryKey) -> Optional[Dict]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: Dict[GalleryKey, Dict]):
+        """写入内存 LRU 并持久化"""
+        if not items: return
+        now = time.time()
+        with self._lock:
+            for key, gmeta in items.items():
+                self._remember(key, gmeta, now)
+
+        if self.db:
+            self.db.save_cached_metadata([
+                (gid, token, json.dumps(gmeta, ensure_ascii=False))
+                for (gid, token), gmeta in items.items()
+            ])
+
+    def purge_expired(self):
+        """清理数据库中已过期的条目"""
+        if self.db and self.ttl:
+            self.db.purge_metadata_cache(time.time() - self.ttl)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._lru)
+        return stats
+
+    def format_stats(self) -> str:
+        s = self.get_stats()
+        total = s['memory_hits'] + s['db_hits'] + s['misses']
+        ratio = (s['memory_hits'] + s['db_hits']) / total * 100 if total else 0.0
+        return f"内存命中 {s['memory_hits']} | 数据库命中 {s['db_hits']} | 未命中 {s['misses']} | 命中率 {ratio:.1f}%"
+
+    def _remember(self, key: GalleryKey, gmeta: Dict, fetched_at: float):
+        """写入 LRU (调用方持有锁)"""
+        self._lru[key] = (gmeta, fetched_at)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_items:
+            self._lru.popitem(last=False)
+
+    def _is_expired(self, fetched_at: float, now: float) -> bool:
+        return self.ttl is not None and now - fetched_at > self.ttl
+
+
+class HashSearchCache:
+    """
+    Hash 搜索结果缓存 (SQLite hash_search_cache 表)
+    (sha1, 模式) -> 结果 URL 或 NO_MATCH；命中时无需再次发送 f_shash 请求
+    匹配结果长期有效，NO_MATCH 在 negative_ttl_days 后过期 (画廊可能稍后才上传)
+    """
+    def __init__(self, db=None, negative_ttl_days: float = 14):
+        """
+        :param db: DatabaseManager 实例；为 None 时不缓存
+        :param negative_ttl_days: NO_MATCH 结果的有效期 (天)，<= 0 表示永不过期
+        """
+        self.db = db
+        self.negative_ttl = negative_ttl_days * 86400 if negative_ttl_days and negative_ttl_days > 0 else None
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, sha1: str, mode: str) -> Optional[Tuple[str, List[str]]]:
+        """返回 (结果, 候选 URL 列表)；未命中或已过期返回 None"""
+        if not self.db or not sha1:
+            return None
+
+        row = self.db.get_hash_search(sha1, mode)
+        hit = None
+        if row and not (row['result'] == "NO_MATCH" and self._is_expired(row['searched_at'])):
+            try:
+                candidates = json.loads(row['candidates']) if row['candidates'] else []
+            except ValueError:
+                candidates = []
+            hit = (row['result'], candidates)
+
+        with self._lock:
+            self._stats['hits' if hit else 'misses'] += 1
+        return hit
+
+    def put(self, sha1: str, mode: str, result: str, candidates: Optional[List[str]] = None):
+        if not self.db or not sha1 or not result:
+            return
+        self.db.save_hash_search(sha1, mode, result, json.dumps(candidates or [], ensure_ascii=False))
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def format_stats(self) -> str:
+        s = self.get_stats()
+        return f"命中 {s['hits']} | 未命中 {s['misses']}"
+
+    def _is_expired(self, searched_at: Optional[float]) -> bool:
+        if self.negative_ttl is None:
+            return False
+        return searched_at is None or time.time() - searched_at > self.negative_ttl
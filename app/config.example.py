@@ -56,11 +56,74 @@ else:
     SCAN_LIMIT = 0  # 0 代表不限制
 
 # ================= 🔍 扫描设置 =================
-DEFAULT_MODE = "cover"  # cover (封面) 或 second (第二页)
+# cover (封面) / second (第 10 页) / multi (一次读取多页，依次搜索)
+# multi 需主动开启：搜不到时每个文件最多发出 len(FINGERPRINT_PAGES) 次搜索请求
+DEFAULT_MODE = "cover"
+# multi 模式计算 Hash 的页面位置，按命中率从高到低依次搜索
+# 'cover' = 封面 (fs_covers 搜索), 'last' = 最后一页, 数字 = 第 N 页
+FINGERPRINT_PAGES = ['cover', 10, 2, 'last']
 
-# ================= ⏱️ 访问频率控制 (秒) =================
-SLEEP_MIN = 4.0
-SLEEP_MAX = 6.0
+# ================= ⏱️ 访问频率控制 =================
+# 全局令牌桶: {端点: (每秒请求数, 突发容量)}
+# search = Hash 搜索 / 文本搜索 (网页), api = gdata 元数据接口
+RATE_LIMITS = {
+    'search': (1 / 4.5, 1),
+    'api': (1 / 2.0, 2),
+}
+# 需要等待时额外附加的随机秒数上限 (避免请求间隔过于规律)
+REQUEST_JITTER = 0.5
+
+# ================= 📦 元数据批量获取 =================
+# 攒够多少个待验证文件后合并为一次 gdata 请求 (接口上限 25，设为 1 即逐个验证)
+METADATA_BATCH_SIZE = 25
+# 每个搜索页最多保留的候选画廊数 (含首个结果)，首个结果验证不符时依次尝试
+MAX_SEARCH_CANDIDATES = 5
+# 元数据缓存: 内存 LRU 条目上限，以及数据库中缓存的有效期 (天，<= 0 为永不过期)
+METADATA_CACHE_SIZE = 2048
+METADATA_CACHE_TTL_DAYS = 30
+# Hash 搜索缓存中 NO_MATCH 结果的有效期 (天，<= 0 为永不过期)；匹配到的 URL 长期有效
+HASH_CACHE_NEGATIVE_TTL_DAYS = 14
+
+# ================= 🚚 扫描流水线 =================
+# 本地阶段 (读盘/解压/Hash) 的线程数，以及领先网络阶段的最大预读文件数
+PIPELINE_WORKERS = 4
+PIPELINE_QUEUE_SIZE = 16
+
+# ================= 👁️ pHash 查重 =================
+# 批量计算封面 pHash 的进程数 (0 = CPU 核数，1 = 单进程串行)
+PHASH_WORKERS = 0
+# 查重范围: library = 全库比对 (近邻索引)，author = 仅在同一作者/社团内比对
+DEDUP_SCOPE = 'library'
+# pHash 比对 (近邻查询) 的进程数 (0 = CPU 核数，1 = 单进程)
+DEDUP_WORKERS = 0
+
+# ================= 💾 数据库写缓冲 =================
+# 扫描结果先缓冲在内存中，每 N 条或每 T 毫秒在一个事务内批量提交 (ROWS = 0 关闭)
+DB_WRITE_BEHIND_ROWS = 50
+DB_WRITE_BEHIND_MS = 1000
+
+# ================= 🔁 失败重试 =================
+# 各失败原因的首次重试间隔 (小时)，同一模式下每再失败一次间隔翻倍，最长 RETRY_MAX_DELAY_HOURS
+# None = 永久失败，不再自动重试
+RETRY_POLICY = {
+    'NETWORK': 0.5,       # 搜索请求异常 / 超时
+    'META_FAILED': 1,     # 获取画廊元数据失败
+    'NO_MATCH': 24,       # 未找到匹配 (画廊可能之后才上传)
+    'MISMATCH': 24,       # 标题/标签验证不符
+    'FILE_ERROR': 72,     # 读取或解压失败
+    'UNKNOWN': 6,
+    'NO_IMAGES': None,    # 压缩包内无图片
+    'MISSING': None,      # 文件已不存在
+}
+RETRY_MAX_DELAY_HOURS = 24 * 30
+
+# ================= 🗄️ 数据库备份 =================
+# 在线备份 (python manage.py backup)，扫描期间也可执行
+BACKUP_DIR = DATA_DIR / "backups"
+BACKUP_KEEP = 5              # 保留最近的快照数量 (0 = 不清理)
+BACKUP_PAGES = 1024          # 每批复制的页数，批与批之间休眠 BACKUP_SLEEP_MS 毫秒
+BACKUP_SLEEP_MS = 10
+BACKUP_COMPRESS = False      # True = VACUUM INTO 紧凑副本 + gzip 压缩 (体积小，耗时长)
 
 # ================= 🛠️ UnRAR 工具路径 =================
 UNRAR_PATH = TOOLS_DIR / "UnRAR.exe"
@@ -1,9 +1,7 @@
 # app/controller.py
 import logging
-import time
-import random
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Dict, Iterable, Iterator, Tuple
 
 from . import config
 from .database import DatabaseManager
@@ -11,6 +9,8 @@ from .network import EHentaiHashSearcher
 from .services import ScannerService
 from .translator import TagTranslator
 from .deduplication import DeduplicationManager
+from .pipeline import ScanPipeline
+from .library_walker import LibraryWalker
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +29,10 @@ class AppController:
 
         # 2. 初始化数据库
         self.db = DatabaseManager(config.DB_PATH, table_name=target_table)
+        # 写缓冲：批量提交扫描结果 (0 表示关闭，每条记录单独提交)
+        write_behind_rows = getattr(config, 'DB_WRITE_BEHIND_ROWS', 50)
+        if write_behind_rows > 0:
+            self.db.enable_write_behind(write_behind_rows, getattr(config, 'DB_WRITE_BEHIND_MS', 1000))
         
         self.translator = TagTranslator(db_path=config.TAG_DB_PATH)
         
@@ -36,9 +40,12 @@ class AppController:
         self.deduplicator = DeduplicationManager(self.db)
         
         self._is_running = False
+        self._pipeline: Optional[ScanPipeline] = None
+        self._discovered = 0  # 流式遍历时目前已发现的文件数 (含无需处理的)
         
         try:
-            self.searcher = EHentaiHashSearcher(config.MY_COOKIES)
+            self.searcher = EHentaiHashSearcher(config.MY_COOKIES, db=self.db)
+            self.searcher.metadata_cache.purge_expired()
         except Exception as e:
             logger.error(f"初始化网络组件失败: {e}")
             self.searcher = None
@@ -47,68 +54,85 @@ class AppController:
 
     # ... (后续方法保持不变) ...
 
-    def _get_files_to_scan(self, directory: Path) -> List[Path]:
-        """获取未扫描的文件"""
+    def _iter_files_to_scan(self, directory: Path, batch_size: int = 500) -> Iterator[Path]:
+        """
+        流式获取未扫描的文件：边遍历目录边产出，处理无需等待遍历结束
+        已入库判断按批查询数据库 (file_path 唯一索引)，不再把所有已处理路径载入内存
+        """
         if not directory.exists(): 
             logger.warning(f"❌ 目录不存在: {directory}")
-            return []
+            return
         
         logger.info(f"📂 正在扫描目录: {directory} ...")
 
-        all_files = set()
-        extensions = ['*.zip', '*.rar', '*.7z', '*.cbz', '*.cbr']
-        for ext in extensions:
-            all_files.update(directory.rglob(ext))
-        
-        processed = self.db.get_all_processed_paths()
-        
-        pending = [f for f in all_files if str(f) not in processed]
-        
-        logger.info(f"📊 目录统计: 发现 {len(all_files)} 个 | 已入库 {len(processed)} | 🆕 待处理 {len(pending)}")
-        return sorted(list(pending))
+        # 单次遍历所有扩展名；未变化的目录直接复用文件索引
+        walker = LibraryWalker(self.db)
+        self._discovered = pending_count = 0
+        batch = []
+
+        for path, is_changed in walker.walk(directory):
+            self._discovered += 1
+            batch.append((path, is_changed))
+            if len(batch) >= batch_size:
+                for pending in self._filter_unprocessed(batch):
+                    pending_count += 1
+                    yield pending
+                batch = []
+
+        for pending in self._filter_unprocessed(batch):
+            pending_count += 1
+            yield pending
+
+        logger.info(f"🗂️ [文件索引] {walker.format_stats()}")
+        logger.info(f"📊 目录统计: 发现 {self._discovered} 个 | 有变化 {walker.stats['changed']} | 🆕 待处理 {pending_count}")
+
+    def _filter_unprocessed(self, batch: List[Tuple[Path, bool]]) -> List[Path]:
+        """保留新文件 + 已入库但大小/修改时间发生变化的文件 + 曾被重试队列判定为已删除、又重新出现的文件"""
+        if not batch:
+            return []
+        paths = [str(path) for path, _ in batch]
+        processed = self.db.get_processed_paths(paths)
+        reappeared = self.db.get_retry_paths([p for p in paths if p in processed], 'MISSING')
+        return [
+            path for path, is_changed in batch
+            if is_changed or str(path) not in processed or str(path) in reappeared
+        ]
 
-    def _get_files_to_retry(self) -> List[Path]:
-        """从数据库获取失败项"""
+    def _get_files_to_retry(self, mode: str, force: bool = False) -> List[Path]:
+        """从重试队列获取已到期、按失败原因值得用该模式重试的文件"""
         try:
-            logger.info(f"🔍 正在查询表 [{self.db.table_name}] 中的失败记录...")
-            cursor = self.db.conn.cursor() 
-            cursor.execute(f"SELECT file_path FROM {self.db.table_name} WHERE status != 'SUCCESS'")
-            rows = cursor.fetchall()
-            
-            files = []
-            for row in rows:
-                p = Path(row[0])
-                if p.exists():
-                    files.append(p)
-            
-            logger.info(f"📊 重试统计: 数据库记录 {len(rows)} 条 | 📁 实际文件存在 {len(files)} 个")
-            return files
+            logger.info(f"🔍 正在查询重试队列 [{self.db.retry_table}] ({self.service.retry_queue.format_stats()})...")
+            return self.service.retry_queue.due(mode, force=force)
         except Exception as e:
             logger.error(f"❌ 获取重试列表失败: {e}")
             return []
 
-    def scan_new_files(self, gui_callback=None):
-        files = self._get_files_to_scan(Path(config.DEFAULT_DIR))
-        self._run_batch(files, "新文件扫描", gui_callback, mode='cover')
+    def scan_new_files(self, gui_callback=None, mode: Optional[str] = None):
+        """:param mode: 本次扫描的模式；None 时使用 config.DEFAULT_MODE (默认 cover，multi 需主动开启)"""
+        files = self._iter_files_to_scan(Path(config.DEFAULT_DIR))
+        self._run_batch(files, "新文件扫描", gui_callback, mode=mode or getattr(config, 'DEFAULT_MODE', 'cover'))
 
-    def retry_failures(self, gui_callback=None):
-        files = self._get_files_to_retry()
+    def retry_failures(self, gui_callback=None, force: bool = False):
+        files = self._get_files_to_retry('second', force=force)
         self._run_batch(files, "失败项智能重试", gui_callback, mode='second')
 
-    def scan_failed_with_title(self, gui_callback=None):
-        files = self._get_files_to_retry()
+    def scan_failed_with_title(self, gui_callback=None, force: bool = False):
+        files = self._get_files_to_retry('title', force=force)
         self._run_batch(files, "失败项标题重扫", gui_callback, mode='title')
         
-    def run_deduplication(self, gui_callback=None):
-        """Action: 运行去重分析"""
+    def run_deduplication(self, gui_callback=None, full: bool = False):
+        """
+        Action: 运行去重分析
+        :param full: True 时全量重建；默认只处理上次查重后新增的记录
+        """
         self._is_running = True
         msg = f"🔍 开始多维查重分析 (表: {self.db.table_name} -> {self.db.relations_table})..."
         logger.info(msg)
         self._log_ui(msg, gui_callback)
         
         try:
-            count = self.deduplicator.run(progress_callback=gui_callback)
-            msg = f"✅ 查重完成! 发现 {count} 个重复文件 (详情请查看 {self.db.relations_table} 表)"
+            count = self.deduplicator.run(progress_callback=gui_callback, full=full)
+            msg = f"✅ 查重完成! 共 {count} 个重复文件 (详情请查看 {self.db.relations_table} 表)"
             logger.info(msg)
             self._log_ui(msg, gui_callback)
             if gui_callback: gui_callback('done', msg)
@@ -119,34 +143,57 @@ class AppController:
         finally:
             self._is_running = False
 
+    def backup_database(self, gui_callback=None, compress: Optional[bool] = None) -> Optional[Path]:
+        """
+        Action: 在线备份数据库 (不占用扫描状态，扫描可同时进行)
+        :param compress: None 时使用配置 BACKUP_COMPRESS
+        """
+        if compress is None:
+            compress = getattr(config, 'BACKUP_COMPRESS', False)
+        self._log_ui(f"💾 开始备份数据库{' (VACUUM + gzip)' if compress else ''}...", gui_callback)
+        self.db.flush()
+
+        def on_progress(done, total):
+            if gui_callback: gui_callback('progress', (done, total, "备份数据库"))
+
+        dest = self.db.create_backup(
+            dest_dir=getattr(config, 'BACKUP_DIR', None),
+            keep=getattr(config, 'BACKUP_KEEP', 5),
+            compress=compress,
+            pages=getattr(config, 'BACKUP_PAGES', 1024),
+            sleep_ms=getattr(config, 'BACKUP_SLEEP_MS', 10),
+            progress_callback=on_progress
+        )
+        msg = f"✅ 备份完成: {dest}" if dest else "❌ 备份失败，详情见日志"
+        self._log_ui(msg, gui_callback)
+        if gui_callback: gui_callback('done', msg)
+        return dest
+
     def stop_scanning(self):
         """外部调用此方法以终止扫描"""
         self._is_running = False
+        if self._pipeline:
+            self._pipeline.stop()
+        if self.searcher:
+            self.searcher.scheduler.cancel()
+        self.db.flush()
         print("🛑 接收到停止指令...")
 
-    def _wait_interval(self):
-        """智能休眠，防止请求过快"""
-        min_sleep = getattr(config, 'SLEEP_MIN', 3.0)
-        max_sleep = getattr(config, 'SLEEP_MAX', 5.0)
-        
-        sleep_time = random.uniform(min_sleep, max_sleep)
-        
-        step = 0.1 
-        elapsed = 0
-        while elapsed < sleep_time:
-            if not self._is_running: return
-            time.sleep(step)
-            elapsed += step
-
-    def _run_batch(self, files: List[Path], task_title: str, gui_callback=None, mode=None):
+    def shutdown(self):
+        """退出前调用：停止任务，提交缓冲中的记录并关闭数据库"""
+        self.stop_scanning()
+        self.db.close()
+
+    def _run_batch(self, files: Iterable[Path], task_title: str, gui_callback=None, mode=None):
         """
         通用的批量处理循环
+        :param files: 文件列表，或流式产出文件的迭代器 (总数未知，进度按"已发现"显示)
         """
         self._is_running = True
-        total = len(files)
+        total = len(files) if isinstance(files, (list, tuple)) else None
         current_mode = mode or config.DEFAULT_MODE
         
-        start_msg = f"🚀 [任务启动] {task_title} | 模式: {current_mode} | 数量: {total}"
+        start_msg = f"🚀 [任务启动] {task_title} | 模式: {current_mode} | 数量: {total if total is not None else '边遍历边处理'}"
         logger.info(start_msg)
         self._log_ui(start_msg, gui_callback)
 
@@ -156,31 +203,63 @@ class AppController:
 
         success_count = 0
         is_stopped = False
+        if self.searcher:
+            self.searcher.scheduler.resume()
+
+        # 本地阶段 (读盘/Hash) 在线程池中提前进行，主循环只负责限速的网络阶段
+        self._pipeline = ScanPipeline(
+            lambda p: self.service.prepare_file(p, mode=current_mode),
+            workers=getattr(config, 'PIPELINE_WORKERS', 4),
+            queue_size=getattr(config, 'PIPELINE_QUEUE_SIZE', 16)
+        )
 
-        for i, file_path in enumerate(files, 1):
+        # 搜索命中的文件先进入待验证队列，攒够一批后用一次 gdata 请求取回全部元数据
+        batch_size = max(1, getattr(config, 'METADATA_BATCH_SIZE', 25))
+        pending = []
+        done = 0
+
+        for i, (file_path, prepared) in enumerate(self._pipeline.iter_prepared(files), 1):
             if not self._is_running:
                 logger.warning("🛑 用户停止任务")
                 is_stopped = True
                 break
 
-            if i > 1:
-                self._wait_interval()
-
-            logger.info(f"▶️ 处理 [{i}/{total}]: {file_path.name}")
+            # 限速由 network 模块的全局调度器负责：只有真正发出的请求才会等待
+            logger.info(f"▶️ 处理 [{i}/{total or self._pipeline.submitted}]: {file_path.name}")
             
             try:
-                result = self.service.process_file(file_path, mode=current_mode)
-                if result.get('status') == 'SUCCESS':
-                    success_count += 1
-                
-                status_text = f"{result.get('status')} | {result.get('file_name')}"
-                if gui_callback:
-                    gui_callback('progress', (i, total, status_text))
-                    
+                result = self.service.search_file(file_path, mode=current_mode, prepared=prepared)
             except Exception as e:
                 logger.error(f"❌ 处理循环异常: {e}")
+                result = {'status': 'ERROR', 'file_name': file_path.name}
+
+            if result.get('status') == 'PENDING':
+                pending.append(result)
+                results = self._resolve_pending(pending, current_mode) if len(pending) >= batch_size else []
+            else:
+                results = [result]
+
+            for result in results:
+                done += 1
+                if result.get('status') == 'SUCCESS':
+                    success_count += 1
+                self._report_progress(done, total, result, gui_callback)
 
-        final_msg = f"🏁 [{task_title}] 结束! 成功: {success_count}/{total}"
+        # 处理剩余的待验证项 (用户停止时请求会被取消，这些文件不落库，下次重新扫描)
+        for result in self._resolve_pending(pending, current_mode):
+            done += 1
+            if result.get('status') == 'SUCCESS':
+                success_count += 1
+            self._report_progress(done, total, result, gui_callback)
+
+        self.db.flush()
+
+        if self.searcher:
+            logger.info(f"📡 [请求统计] {self.searcher.scheduler.format_stats()}")
+            logger.info(f"🗃️ [元数据缓存] {self.searcher.metadata_cache.format_stats()}")
+            logger.info(f"🗃️ [Hash 缓存] {self.searcher.hash_cache.format_stats()}")
+
+        final_msg = f"🏁 [{task_title}] 结束! 成功: {success_count}/{total if total is not None else done}"
         if is_stopped:
             final_msg += " (用户终止)"
             
@@ -191,5 +270,32 @@ class AppController:
             status_key = 'stopped' if is_stopped else 'done'
             gui_callback(status_key, final_msg)
 
+    def _report_progress(self, done: int, total: Optional[int], result: Dict, gui_callback=None):
+        """
+        上报进度；流式发现时总数未知，以目前已提交处理的文件数作为分母，
+        并附带 discovering 标记与目前遍历到的文件数，由 GUI 显示为仍在遍历目录
+        """
+        if not gui_callback:
+            return
+        status_text = f"{result.get('status')} | {result.get('file_name')}"
+        if total is not None:
+            gui_callback('progress', (done, total, status_text))
+        else:
+            discovering = not self._pipeline.exhausted
+            gui_callback('progress', (done, max(done, self._pipeline.submitted), status_text,
+                                      discovering, self._discovered))
+
+    def _resolve_pending(self, pending: List[Dict], mode: str) -> List[Dict]:
+        """批量验证待处理项并清空队列"""
+        if not pending:
+            return []
+        batch = list(pending)
+        pending.clear()
+        try:
+            return self.service.resolve_pending(batch, mode=mode)
+        except Exception as e:
+            logger.error(f"❌ 批量验证异常: {e}")
+            return [{'status': 'ERROR', 'file_name': item['file_name']} for item in batch]
+
     def _log_ui(self, msg, callback):
         if callback: callback('log', msg)
\ No newline at end of file
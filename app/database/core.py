@@ -1,39 +1,63 @@
 # app/database/core.py
 import sqlite3
 import logging
+import os
+import gzip
+import time
+import queue
 import threading
 import shutil
+import weakref
+from concurrent.futures import Future
+from datetime import datetime
 from pathlib import Path
-from typing import Optional, Union, Tuple, Any
+from typing import Optional, Union, Tuple, Any, Iterable, Iterator, Callable
 
 logger = logging.getLogger(__name__)
 
+class _ReaderHandle:
+    """线程本地只读连接的持有者：线程结束后线程本地存储被回收，由 weakref.finalize 关闭连接"""
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
 class DatabaseCore:
     """
     数据库核心基类
-    负责：连接管理、WAL配置、线程锁、通用SQL执行、物理备份
+    负责：连接管理、WAL配置、读写分离、通用SQL执行、在线备份
+
+    连接模型：
+    - 写：唯一的写连接只在专用写线程中使用，写操作以任务 (fn(conn)) 形式进入队列，
+      每个任务一个事务，调用方通过 Future 等待结果
+    - 读：每个线程一个只读连接 (惰性创建)，读操作不加锁，WAL 模式下与写入互不阻塞；
+      线程结束时连接随之关闭 (线程池 / GUI 任务线程反复创建时不会累积句柄)
     """
     def __init__(self, db_path: Union[str, Path]):
         self.db_path = Path(db_path)
-        self.backup_path = self.db_path.with_suffix('.db.bak')
-        self.conn: Optional[sqlite3.Connection] = None
-        
-        # 线程锁：虽然 WAL 模式支持并发读，但写操作仍需串行化
-        self._lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None  # 写连接 (仅写线程使用)
+
+        self._write_queue: "queue.Queue[Optional[Tuple[Callable, Future]]]" = queue.Queue()
+        self._writer_thread: Optional[threading.Thread] = None
+
+        # 每线程只读连接 (弱引用集合只包含仍存活线程的连接)
+        self._local = threading.local()
+        self._readers: "weakref.WeakSet[_ReaderHandle]" = weakref.WeakSet()
+        self._readers_lock = threading.Lock()
         
         # 确保存储目录存在
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
         self._connect()
 
     def _connect(self):
-        """建立数据库连接并应用优化配置"""
+        """建立写连接、应用优化配置并启动写线程"""
         try:
-            # check_same_thread=False: 允许在不同线程使用同一个连接对象
+            # 写连接在当前线程创建，之后只由写线程使用
             self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
             
-            # [优化] 开启 WAL 模式 (Write-Ahead Logging)
+            # [优化] 开启 WAL 模式 (Write-Ahead Logging)：读连接可与写入并发
             self.conn.execute("PRAGMA journal_mode=WAL;")
-            
+
             # 使用 Row 工厂，使查询结果可以通过列名访问 (row['field'])
             self.conn.row_factory = sqlite3.Row
             
@@ -43,46 +67,212 @@ class DatabaseCore:
             logger.critical(f"❌ 数据库连接失败: {e}")
             raise e
 
+        self._writer_thread = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer_thread.start()
+
+    # ================= 写线程 =================
+
+    def _writer_loop(self):
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            fn, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(self.conn)
+                self.conn.commit()
+                future.set_result(result)
+            except BaseException as e:
+                try:
+                    self.conn.rollback()
+                except Exception: pass
+                future.set_exception(e)
+
+    def _submit_write(self, fn: Callable[[sqlite3.Connection], Any]) -> Future:
+        """提交写任务：fn(conn) 在写线程中执行，成功后提交，异常时回滚"""
+        future = Future()
+        if threading.current_thread() is self._writer_thread:
+            # 写任务内部再次写入：直接在当前事务中执行，避免自锁
+            future.set_result(fn(self.conn))
+            return future
+        if not self._writer_thread or not self._writer_thread.is_alive():
+            future.set_exception(sqlite3.ProgrammingError("数据库写线程未运行"))
+            return future
+        self._write_queue.put((fn, future))
+        return future
+
+    def _run_write(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """提交写任务并等待完成 (写后读一致)；异常原样抛出"""
+        return self._submit_write(fn).result()
+
     def _execute_write(self, sql: str, params: Tuple = ()) -> bool:
-        """通用写操作：加锁 -> 执行 -> 提交 -> 捕获异常"""
+        """通用写操作：进入写队列 -> 执行 -> 提交 -> 捕获异常"""
         try:
-            with self._lock:
-                self.conn.execute(sql, params)
-                self.conn.commit()
+            self._run_write(lambda conn: conn.execute(sql, params))
             return True
         except Exception as e:
             logger.error(f"❌ [DB-Write] 执行失败: {e}\nSQL: {sql}\nParams: {params}")
             return False
 
+    def _execute_many(self, sql: str, seq_of_params: Iterable[Tuple]) -> bool:
+        """批量写操作：同一事务内 executemany -> 提交"""
+        try:
+            self._run_write(lambda conn: conn.executemany(sql, seq_of_params))
+            return True
+        except Exception as e:
+            logger.error(f"❌ [DB-Write] 批量执行失败: {e}\nSQL: {sql}")
+            return False
+
+    # ================= 读连接 =================
+
+    def _open_reader(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(f"{self.db_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        """当前线程的只读连接 (惰性创建；线程结束或 close() 时关闭)"""
+        handle = getattr(self._local, 'reader', None)
+        if handle is None:
+            if self.conn is None:
+                raise sqlite3.ProgrammingError("数据库已关闭")
+            conn = self._open_reader()
+            handle = _ReaderHandle(conn)
+            weakref.finalize(handle, conn.close)
+            self._local.reader = handle
+            with self._readers_lock:
+                self._readers.add(handle)
+        return handle.conn
+
     def _execute_read(self, sql: str, params: Tuple = (), fetch_one: bool = False) -> Any:
-        """通用读操作：加锁 -> 执行 -> 返回结果"""
+        """通用读操作：当前线程的只读连接 -> 执行 -> 返回结果 (不阻塞写入)"""
         try:
-            with self._lock:
-                cursor = self.conn.execute(sql, params)
+            cursor = self._reader().execute(sql, params)
+            try:
                 return cursor.fetchone() if fetch_one else cursor.fetchall()
+            finally:
+                # 及时结束语句，释放读快照，之后的读取能看到新提交的数据
+                cursor.close()
         except Exception as e:
             logger.error(f"❌ [DB-Read] 查询失败: {e}")
             return None if fetch_one else []
 
-    def create_backup(self):
-        """创建数据库物理备份"""
-        if not self.db_path.exists(): return
+    def _iter_read(self, sql: str, params: Tuple = (), batch_size: int = 1000) -> Iterator[sqlite3.Row]:
+        """
+        流式读操作：在独立的只读连接上逐批 fetchmany，不一次性加载全部结果
+        迭代期间看到的是开始查询时的快照；不复用线程读连接，
+        避免迭代中途放弃时未结束的语句让该连接停留在旧快照
+        """
+        conn = self._open_reader()
         try:
-            with self._lock:
-                self.conn.commit() # 确保内存数据落盘
-                shutil.copy2(self.db_path, self.backup_path)
-                logger.info(f"💾 [Backup] 备份成功: {self.backup_path.name}")
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def create_backup(self, dest_dir: Union[str, Path, None] = None, keep: int = 5, compress: bool = False,
+                      pages: int = 1024, sleep_ms: int = 10, progress_callback=None) -> Optional[Path]:
+        """
+        在线备份 (不阻塞读写)
+        在独立只读连接上开启读事务固定快照，再用 sqlite3 backup API 分批复制页；
+        快照固定后其他连接的写入不会导致备份重新开始，WAL 中已提交的数据也会包含在内。
+        :param dest_dir: 快照目录 (默认数据库同级的 backups/)
+        :param keep: 保留最近的快照数量 (0 = 不清理)
+        :param compress: True 时改用 VACUUM INTO 生成紧凑副本并 gzip 压缩
+        :param pages: 每批复制的页数；批与批之间休眠 sleep_ms 毫秒，让出磁盘 IO
+        :param progress_callback: progress_callback(已复制页数, 总页数)
+        :return: 快照路径，失败时返回 None
+        """
+        if not self.db_path.exists(): return None
+        dest_dir = Path(dest_dir) if dest_dir else self.db_path.parent / "backups"
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        dest = dest_dir / f"{self.db_path.stem}-{stamp}.db{'.gz' if compress else ''}"
+        tmp = dest.with_name(dest.name + ".tmp")
+
+        start = time.perf_counter()
+        src = self._open_reader()
+        src.isolation_level = None  # 手动控制读事务
+        try:
+            if compress:
+                self._vacuum_gzip(src, tmp)
+            else:
+                src.execute("BEGIN")
+                src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()  # 取得读快照
+
+                def on_progress(status, remaining, total):
+                    if progress_callback: progress_callback(total - remaining, total)
+                    if remaining and sleep_ms: time.sleep(sleep_ms / 1000.0)
+
+                dst = sqlite3.connect(str(tmp))
+                try:
+                    src.backup(dst, pages=max(1, pages), progress=on_progress)
+                    # 快照是独立文件，不需要 WAL
+                    dst.execute("PRAGMA journal_mode=DELETE")
+                finally:
+                    dst.close()
+                src.execute("COMMIT")
+            os.replace(tmp, dest)
         except Exception as e:
             logger.error(f"❌ 备份失败: {e}")
+            tmp.unlink(missing_ok=True)
+            return None
+        finally:
+            src.close()
+
+        size_mb = dest.stat().st_size / 1024 / 1024
+        logger.info(f"💾 [Backup] 备份成功: {dest.name} ({size_mb:.1f} MB, {time.perf_counter() - start:.1f}s)")
+        if keep > 0:
+            self._rotate_backups(dest_dir, keep)
+        return dest
+
+    @staticmethod
+    def _vacuum_gzip(src: sqlite3.Connection, dest: Path):
+        """VACUUM INTO 生成紧凑的一致快照 (只需读事务)，再流式 gzip 压缩"""
+        raw = dest.with_name(dest.name + ".raw")
+        raw.unlink(missing_ok=True)
+        try:
+            src.execute("VACUUM INTO ?", (str(raw),))
+            with open(raw, 'rb') as f_in, gzip.open(dest, 'wb', compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        finally:
+            raw.unlink(missing_ok=True)
+
+    def _rotate_backups(self, dest_dir: Path, keep: int):
+        """按时间戳 (文件名) 保留最近 keep 个快照"""
+        snapshots = sorted(
+            p for p in dest_dir.glob(f"{self.db_path.stem}-*.db*") if not p.name.endswith(('.tmp', '.raw'))
+        )
+        for old in snapshots[:-keep]:
+            try:
+                old.unlink()
+                logger.debug(f"🗑️ [Backup] 清理旧快照: {old.name}")
+            except OSError as e:
+                logger.warning(f"⚠️ 清理旧快照失败: {old.name} - {e}")
 
     def close(self):
-        """关闭连接"""
-        if self.conn:
+        """等待写队列清空后关闭写连接与全部读连接"""
+        if not self.conn:
+            return
+        if self._writer_thread and self._writer_thread.is_alive():
+            self._write_queue.put(None)
+            self._writer_thread.join()
+        self._writer_thread = None
+        with self._readers_lock:
+            readers = [handle.conn for handle in self._readers]
+            self._readers = weakref.WeakSet()
+        for conn in readers + [self.conn]:
             try:
-                self.conn.close()
-                logger.debug("🔒 数据库连接已关闭")
+                conn.close()
             except Exception: pass
-            self.conn = None
+        self.conn = None
+        logger.debug("🔒 数据库连接已关闭")
 
     def __enter__(self):
         return self
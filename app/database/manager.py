@@ -1,29 +1,83 @@
 # app/database/manager.py
+import re
+import json
+import time
 import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Set, Union, List, Dict
+from typing import Optional, Set, Union, List, Dict, Tuple, Iterator
 import sqlite3
 
 from .core import DatabaseCore
+from ..utils import cjk_search_terms
 
 logger = logging.getLogger(__name__)
 
+# 标签表回填进度 (最后处理的记录 id，完成后为 'done')，保存在 {表名}_meta
+TAGS_BACKFILL_KEY = 'tags_backfill'
+# 重试队列是否已从主表的失败记录初始化
+RETRY_BACKFILL_KEY = 'retry_queue_backfill'
+
+# 旧记录只有备注文字，迁移时据此还原失败原因 (与 ScannerService 的备注一致)
+NOTE_REASONS = [
+    ("note = '压缩包内无有效图片'", 'NO_IMAGES'),
+    ("note = '文件读取或解压失败'", 'FILE_ERROR'),
+    ("note = '未找到匹配项 (Hash/Title)'", 'NO_MATCH'),
+    ("note LIKE '搜索错误%'", 'NETWORK'),
+    ("note = '标题/标签匹配度不足'", 'MISMATCH'),
+    ("note = '获取元数据失败'", 'META_FAILED'),
+    ("note = 'File not found'", 'MISSING'),
+]
+
+# 画廊 URL: e-hentai / exhentai 两个域名指向同一画廊，以 "gid/token" 作为归一化键
+GALLERY_URL_RE = re.compile(r'^https?://(?:www\.)?(?:e-hentai|exhentai)\.org/g/(\d+)/([0-9a-f]+)/?', re.IGNORECASE)
+
 class DatabaseManager(DatabaseCore):
     """
     具体业务数据库管理器
     """
+    # 主表字段顺序 (与 save_record 参数一致，id 在前)
+    RECORD_COLUMNS = ('id', 'file_path', 'file_name', 'gallery_url', 'title', 'tags', 'status', 'note', 'scan_time',
+                      'gallery_key')
+
     def __init__(self, db_path: Union[str, Path], table_name: str = "scan_results"):
         super().__init__(db_path)
         self.table_name = table_name
+
+        # 写缓冲 (默认关闭，由 enable_write_behind 开启)
+        self._write_behind = False
+        self._write_behind_rows = 50
+        self._write_behind_delay = 1.0
+        self._write_buffer: "OrderedDict[str, Tuple]" = OrderedDict()
+        self._inflight: "OrderedDict[str, Tuple]" = OrderedDict()
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_stop = threading.Event()
+        self._flush_thread: Optional[threading.Thread] = None
+        # 标签表后台迁移
+        self._backfill_thread: Optional[threading.Thread] = None
+        self._backfill_stop = threading.Event()
         
         # [动态生成查重相关表名]
         # 这样当 table_name="test_results" 时，会自动使用 "test_results_groups"
         self.groups_table = f"{table_name}_groups"
         self.relations_table = f"{table_name}_relations"
+        # 键值表：查重高水位等运行状态
+        self.meta_table = f"{table_name}_meta"
+        # 标签字典表 + 记录-标签关联表
+        self.tags_table = f"{table_name}_tags"
+        self.gallery_tags_table = f"{table_name}_gallery_tags"
+        # 失败重试队列
+        self.retry_table = f"{table_name}_retry_queue"
+        # 全文索引 (FTS5，外部内容表为主表)
+        self.fts_table = f"{table_name}_fts"
+        self.fts_enabled = False
         
         self._init_schema()
         self._check_schema_migration()
+        self._init_fts()
         logger.info(f"📂 数据库就绪 | 主表: {self.table_name} | 查重表: {self.groups_table}, {self.relations_table}")
 
     def _init_schema(self):
@@ -40,7 +94,8 @@ class DatabaseManager(DatabaseCore):
                 tags TEXT,
                 status TEXT,
                 note TEXT,
-                scan_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                scan_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                gallery_key TEXT
             )
             """,
             f"CREATE INDEX IF NOT EXISTS idx_{self.table_name}_url ON {self.table_name}(gallery_url)",
@@ -69,112 +124,967 @@ class DatabaseManager(DatabaseCore):
             """,
             # 动态索引名
             f"CREATE INDEX IF NOT EXISTS idx_{self.relations_table}_group ON {self.relations_table}(group_id)",
-            f"CREATE INDEX IF NOT EXISTS idx_{self.relations_table}_file ON {self.relations_table}(file_path)"
+            f"CREATE INDEX IF NOT EXISTS idx_{self.relations_table}_file ON {self.relations_table}(file_path)",
+
+            # 3.1 运行状态 (键值表)
+            f"""
+            CREATE TABLE IF NOT EXISTS {self.meta_table} (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+            """,
+
+            # 3.2 标签 (tags 字符串拆分为 namespace:name，原始标签与译名都收录)
+            f"""
+            CREATE TABLE IF NOT EXISTS {self.tags_table} (
+                id INTEGER PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                name TEXT NOT NULL,
+                UNIQUE (namespace, name)
+            )
+            """,
+            f"""
+            CREATE TABLE IF NOT EXISTS {self.gallery_tags_table} (
+                tag_id INTEGER NOT NULL,
+                record_id INTEGER NOT NULL,
+                PRIMARY KEY (tag_id, record_id)
+            ) WITHOUT ROWID
+            """,
+            f"CREATE INDEX IF NOT EXISTS idx_{self.gallery_tags_table}_record ON {self.gallery_tags_table}(record_id)",
+            # 主表记录被删除时清理其标签 (保存记录时先显式 DELETE 再 INSERT，不依赖 REPLACE 触发删除触发器)
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{self.table_name}_tags_delete
+            AFTER DELETE ON {self.table_name} BEGIN
+                DELETE FROM {self.gallery_tags_table} WHERE record_id = old.id;
+            END
+            """,
+
+            # 3.3 失败重试队列 (next_eligible 为空表示永久失败，不再自动重试)
+            f"""
+            CREATE TABLE IF NOT EXISTS {self.retry_table} (
+                file_path TEXT PRIMARY KEY,
+                reason TEXT,
+                attempts INTEGER DEFAULT 0,
+                last_mode TEXT,
+                last_error TEXT,
+                last_attempt REAL,
+                next_eligible REAL
+            )
+            """,
+            f"CREATE INDEX IF NOT EXISTS idx_{self.retry_table}_due ON {self.retry_table}(next_eligible)",
+
+            # 4. 画廊元数据缓存 (与扫描表无关，所有模式共用)
+            """
+            CREATE TABLE IF NOT EXISTS metadata_cache (
+                gid INTEGER,
+                token TEXT,
+                data TEXT,
+                fetched_at REAL,
+                PRIMARY KEY (gid, token)
+            )
+            """,
+
+            # 5. Hash 搜索结果缓存 (sha1 + 搜索模式 -> 结果 URL 或 NO_MATCH)
+            """
+            CREATE TABLE IF NOT EXISTS hash_search_cache (
+                sha1 TEXT,
+                mode TEXT,
+                result TEXT,
+                candidates TEXT,
+                searched_at REAL,
+                PRIMARY KEY (sha1, mode)
+            )
+            """,
+
+            # 6. 文件索引 (目录遍历状态)，用于跳过未变化的目录
+            """
+            CREATE TABLE IF NOT EXISTS dir_index (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                subdirs TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS file_index (
+                path TEXT PRIMARY KEY,
+                dir TEXT,
+                size INTEGER,
+                mtime REAL,
+                inode INTEGER,
+                pending INTEGER DEFAULT 0
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_file_index_dir ON file_index(dir)",
+
+            # 7. 归档指纹表 (按路径 + 大小/mtime 判断是否需要重新计算)
+            """
+            CREATE TABLE IF NOT EXISTS archive_fingerprints (
+                file_path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                version INTEGER,
+                status TEXT,
+                cover_sha1 TEXT,
+                second_sha1 TEXT,
+                cover_phash TEXT,
+                image_count INTEGER,
+                archive_format TEXT,
+                page_hashes TEXT,
+                updated_at REAL
+            )
+            """
         ]
 
-        with self._lock:
-            try:
-                cursor = self.conn.cursor()
-                for sql in ddl_statements:
-                    cursor.execute(sql)
-                self.conn.commit()
-            except Exception as e:
-                logger.error(f"❌ 初始化 Schema 失败: {e}")
+        def create(conn):
+            for sql in ddl_statements:
+                conn.execute(sql)
+        try:
+            self._run_write(create)
+        except Exception as e:
+            logger.error(f"❌ 初始化 Schema 失败: {e}")
 
     def _check_schema_migration(self):
-        """检查并自动修复表结构"""
-        with self._lock:
+        """检查并自动修复表结构 (在写线程中执行)"""
+        self._add_column_if_missing(self.table_name, 'note')
+        # 多页指纹 (旧版指纹表没有 page_hashes 列)
+        self._add_column_if_missing('archive_fingerprints', 'page_hashes')
+        # 归一化画廊键 (旧版主表没有 gallery_key 列)
+        self._add_column_if_missing(self.table_name, 'gallery_key')
+        # 文件变化待处理标记 (旧版文件索引没有 pending 列)
+        self._add_column_if_missing('file_index', 'pending', 'INTEGER DEFAULT 0')
+
+        def index_and_backfill(conn):
+            # URL 查重按 status + gallery_key 分组，索引覆盖 GROUP BY 无需临时排序
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{self.table_name}_key ON {self.table_name}(status, gallery_key)"
+            )
+            self._backfill_gallery_keys(conn)
+        try:
+            self._run_write(index_and_backfill)
+        except Exception as e:
+            logger.error(f"❌ 回填 gallery_key 失败: {e}")
+
+        self._start_tags_backfill()
+        self._backfill_retry_queue()
+
+    def _start_tags_backfill(self):
+        """标签表尚未迁移完成时在后台线程中继续，不阻塞启动 (大库首次迁移需要数分钟)"""
+        if self.get_meta(TAGS_BACKFILL_KEY) == 'done':
+            return
+        self._backfill_stop.clear()
+        self._backfill_thread = threading.Thread(target=self._backfill_tags, name="db-tags-backfill", daemon=True)
+        self._backfill_thread.start()
+
+    def wait_tags_backfill(self):
+        """等待后台标签迁移完成 (按标签查询前调用，保证结果完整)"""
+        if self._backfill_thread:
+            self._backfill_thread.join()
+
+    def _backfill_tags(self, chunk_size: int = 1000):
+        """
+        一次性迁移：把已有记录的 tags 字符串拆分写入标签表
+        按 id 分批，每批在写线程的一个短事务内读取并写入 (与扫描写入交替进行)；
+        进度记录在 {表名}_meta，中断 / 关闭后下次启动继续
+        """
+        last_id = int(self.get_meta(TAGS_BACKFILL_KEY) or 0)
+        row = self._execute_read(f"SELECT COUNT(*) AS n FROM {self.table_name} WHERE id > ?", (last_id,), fetch_one=True)
+        total, done = (row['n'] if row else 0), 0
+        if total:
+            logger.info(f"🏷️ 后台迁移标签表: 共 {total} 条记录 (完成前按标签查询的结果可能不完整)")
+
+        def backfill(conn, after_id):
+            rows = conn.execute(
+                f"SELECT id, tags FROM {self.table_name} WHERE id > ? ORDER BY id LIMIT ?", (after_id, chunk_size)
+            ).fetchall()
+            if not rows:
+                conn.execute(f"INSERT OR REPLACE INTO {self.meta_table} (key, value) VALUES (?, 'done')",
+                             (TAGS_BACKFILL_KEY,))
+                return None, 0
+            self._save_tags(conn, [(r['id'], r['tags']) for r in rows])
+            conn.execute(f"INSERT OR REPLACE INTO {self.meta_table} (key, value) VALUES (?, ?)",
+                         (TAGS_BACKFILL_KEY, str(rows[-1]['id'])))
+            return rows[-1]['id'], len(rows)
+
+        try:
+            while not self._backfill_stop.is_set():
+                last_id, count = self._run_write(lambda conn: backfill(conn, last_id))
+                if last_id is None:
+                    if total:
+                        logger.info(f"🏷️ 标签迁移完成: {done} 条记录")
+                    return
+                done += count
+                if done % (chunk_size * 20) < count:
+                    logger.info(f"🏷️ 标签迁移中... {done}/{total}")
+        except Exception as e:
+            logger.error(f"❌ 标签迁移失败 (下次启动继续): {e}")
+
+    def sync_tags(self, record_ids: Optional[List[int]] = None, chunk_size: int = 1000) -> int:
+        """
+        按主表的 tags 字符串重建记录的标签关联 (外部工具直接修改主表后使用)
+        :param record_ids: 需要同步的记录 id；None 表示全表重建
+        :return: 同步的记录数
+        """
+        self.flush()
+        if record_ids is None:
+            rows = self._execute_read(f"SELECT id FROM {self.table_name} ORDER BY id")
+            record_ids = [row['id'] for row in rows]
+
+        def sync(conn, ids):
+            marks = ','.join('?' * len(ids))
+            conn.execute(f"DELETE FROM {self.gallery_tags_table} WHERE record_id IN ({marks})", ids)
+            rows = conn.execute(f"SELECT id, tags FROM {self.table_name} WHERE id IN ({marks})", ids).fetchall()
+            self._save_tags(conn, [(r['id'], r['tags']) for r in rows])
+            return len(rows)
+
+        total = 0
+        try:
+            for start in range(0, len(record_ids), chunk_size):
+                chunk = tuple(record_ids[start:start + chunk_size])
+                total += self._run_write(lambda conn: sync(conn, chunk))
+        except Exception as e:
+            logger.error(f"❌ 同步标签失败: {e}")
+        return total
+
+    def _backfill_retry_queue(self, permanent_reasons: Tuple[str, ...] = ('NO_IMAGES', 'MISSING')):
+        """一次性迁移：主表中已有的失败记录加入重试队列 (原因由备注还原，永久失败之外立即可重试)"""
+        if self.get_meta(RETRY_BACKFILL_KEY) == 'done':
+            return
+        reason_sql = "CASE " + " ".join(f"WHEN {cond} THEN '{reason}'" for cond, reason in NOTE_REASONS) + " ELSE 'UNKNOWN' END"
+        permanent = ','.join(f"'{r}'" for r in permanent_reasons)
+
+        def backfill(conn):
+            cur = conn.execute(f"""
+            INSERT OR IGNORE INTO {self.retry_table}
+                (file_path, reason, attempts, last_error, last_attempt, next_eligible)
+            SELECT file_path, reason, 1, note, CAST(strftime('%s', scan_time, 'utc') AS REAL),
+                   CASE WHEN reason IN ({permanent}) THEN NULL ELSE 0 END
+            FROM (SELECT file_path, note, scan_time, {reason_sql} AS reason
+                  FROM {self.table_name} WHERE status != 'SUCCESS')
+            """)
+            conn.execute(f"INSERT OR REPLACE INTO {self.meta_table} (key, value) VALUES (?, 'done')",
+                         (RETRY_BACKFILL_KEY,))
+            return cur.rowcount
+        try:
+            count = self._run_write(backfill)
+            if count:
+                logger.info(f"🔁 已将 {count} 条失败记录加入重试队列")
+        except Exception as e:
+            logger.error(f"❌ 初始化重试队列失败: {e}")
+
+    def _init_fts(self):
+        """
+        创建 file_name / title / tags 的 FTS5 全文索引，由主表触发器同步
+        使用 trigram 分词：不依赖空格，中日文与英文混合的标题都能按子串检索 (SQLite >= 3.34)；
+        首次创建时从主表重建索引
+        """
+        t, fts = self.table_name, self.fts_table
+        statements = [
+            f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                file_name, title, tags, content='{t}', content_rowid='id', tokenize='trigram'
+            )
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{t}_fts_insert AFTER INSERT ON {t} BEGIN
+                INSERT INTO {fts} (rowid, file_name, title, tags) VALUES (new.id, new.file_name, new.title, new.tags);
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{t}_fts_delete AFTER DELETE ON {t} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, file_name, title, tags)
+                VALUES ('delete', old.id, old.file_name, old.title, old.tags);
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{t}_fts_update AFTER UPDATE OF file_name, title, tags ON {t} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, file_name, title, tags)
+                VALUES ('delete', old.id, old.file_name, old.title, old.tags);
+                INSERT INTO {fts} (rowid, file_name, title, tags) VALUES (new.id, new.file_name, new.title, new.tags);
+            END
+            """,
+        ]
+
+        def create(conn):
+            existed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts,)).fetchone()
+            for sql in statements:
+                conn.execute(sql)
+            if not existed:
+                conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+            return not existed
+        try:
+            if self._run_write(create):
+                logger.info(f"🔎 全文索引已建立: {fts}")
+            self.fts_enabled = True
+        except sqlite3.OperationalError as e:
+            # 创建失败时整个事务回滚，不会留下引用不存在索引的触发器
+            logger.warning(f"⚠️ 当前 SQLite ({sqlite3.sqlite_version}) 不支持 FTS5 trigram，搜索退化为 LIKE: {e}")
+
+    def rebuild_fts(self) -> bool:
+        """从主表重建全文索引 (外部工具绕过触发器修改主表后使用)"""
+        if not self.fts_enabled:
+            return False
+        self.flush()
+        return self._execute_write(f"INSERT INTO {self.fts_table} ({self.fts_table}) VALUES ('rebuild')")
+
+    def _add_column_if_missing(self, table: str, column: str, col_type: str = 'TEXT'):
+        def migrate(conn):
             try:
-                self.conn.execute(f"SELECT note FROM {self.table_name} LIMIT 1")
+                conn.execute(f"SELECT {column} FROM {table} LIMIT 1")
             except sqlite3.OperationalError:
-                try:
-                    self.conn.execute(f"ALTER TABLE {self.table_name} ADD COLUMN note TEXT")
-                    self.conn.commit()
-                except Exception: pass
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}")
+        try:
+            self._run_write(migrate)
+        except Exception: pass
+
+    def _backfill_gallery_keys(self, conn: sqlite3.Connection):
+        """为缺少 gallery_key 的记录补齐 (旧数据 / 外部导入的数据)"""
+        rows = conn.execute(
+            f"SELECT id, gallery_url FROM {self.table_name} WHERE gallery_key IS NULL AND gallery_url LIKE '%/g/%'"
+        ).fetchall()
+        updates = []
+        for row in rows:
+            url, key = self.normalize_gallery_url(row['gallery_url'])
+            if key:
+                updates.append((url, key, row['id']))
+        if updates:
+            conn.executemany(
+                f"UPDATE {self.table_name} SET gallery_url = ?, gallery_key = ? WHERE id = ?", updates
+            )
+            logger.info(f"🔧 已为 {len(updates)} 条记录回填归一化画廊键")
+
+    @staticmethod
+    def normalize_gallery_url(url: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        归一化画廊 URL (写入时调用)
+        :return: (统一为 https、小写域名、末尾带 / 的 URL, "gid/token" 键)；非画廊 URL 原样返回，键为 None
+        """
+        match = GALLERY_URL_RE.match(url.strip()) if url else None
+        if not match:
+            return url, None
+        gid, token = match.group(1), match.group(2).lower()
+        host = 'exhentai.org' if 'exhentai' in match.group(0).lower() else 'e-hentai.org'
+        return f"https://{host}/g/{gid}/{token}/", f"{gid}/{token}"
 
     # ================= 业务方法 =================
 
     def save_record(self, file_path: Union[str, Path], status: str, 
                     url: Optional[str] = None, title: Optional[str] = None, 
-                    tags: Optional[str] = None, note: Optional[str] = None):
-        sql = f"""
-        INSERT OR REPLACE INTO {self.table_name} 
-        (file_path, file_name, gallery_url, title, tags, status, note, scan_time)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    tags: Optional[str] = None, note: Optional[str] = None,
+                    retry: Optional[Tuple[str, Optional[str], Optional[str], Optional[float], float]] = None):
+        """
+        保存扫描结果 (写缓冲开启时进入缓冲，与其他记录合并提交)
+        重试队列随记录在同一事务内更新：SUCCESS 时移除条目；
+        retry = (原因, 模式, 错误信息, 首次重试间隔秒数 (None 为永久失败), 最大间隔秒数)，由 RetryQueue.failure() 生成
         """
+        url, gallery_key = self.normalize_gallery_url(url)
         params = (
             str(file_path), Path(file_path).name, url, title, tags, status, note,
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"), gallery_key, retry
         )
-        self._execute_write(sql, params)
 
-    def get_record_by_path(self, file_path: Union[str, Path]) -> Optional[sqlite3.Row]:
+        if self._write_behind:
+            # 写缓冲模式：同一路径只保留最新一条，攒够 N 条或超过 T 毫秒后合并提交
+            with self._buffer_lock:
+                self._write_buffer[params[0]] = params
+                self._write_buffer.move_to_end(params[0])
+                should_flush = len(self._write_buffer) >= self._write_behind_rows
+            if should_flush:
+                self.flush()
+            return
+
+        self._write_records([params])
+
+    def _write_records(self, rows: List[Tuple]) -> bool:
+        """
+        在一个事务内写入记录及其标签，并清除文件索引中对应的"变化待处理"标记
+        已有记录先显式删除再插入 (新 id 供增量查重识别)：删除触发器清理旧标签和全文索引，
+        不依赖 INSERT OR REPLACE 在 recursive_triggers 开启时才会触发的隐式删除
+        """
+        def write(conn):
+            items = []
+            now = time.time()
+            for params in rows:
+                record, retry = params[:-1], params[-1]
+                conn.execute(f"DELETE FROM {self.table_name} WHERE file_path = ?", (record[0],))
+                items.append((conn.execute(self._save_sql(), record).lastrowid, record[4]))
+                if record[5] == 'SUCCESS':
+                    conn.execute(f"DELETE FROM {self.retry_table} WHERE file_path = ?", (record[0],))
+                elif retry:
+                    reason, mode, error, base, cap = retry
+                    conn.execute(self._retry_upsert_sql(), {
+                        'path': record[0], 'reason': reason, 'mode': mode, 'error': error,
+                        'now': now, 'base': base, 'cap': cap
+                    })
+            self._save_tags(conn, items)
+            conn.executemany("UPDATE file_index SET pending = 0 WHERE path = ? AND pending = 1",
+                             [(params[0],) for params in rows])
+        try:
+            self._run_write(write)
+            return True
+        except Exception as e:
+            logger.error(f"❌ [DB-Write] 保存记录失败 ({len(rows)} 条): {e}")
+            return False
+
+    def _save_tags(self, conn: sqlite3.Connection, items: List[Tuple[int, Optional[str]]]):
+        """
+        写入记录的标签 (记录为新插入，旧标签已由删除触发器清理)
+        :param items: [(record_id, tags 字符串)]
+        """
+        parsed = [
+            (record_id, {self.split_tag(tag) for tag in (tags or "").split(',') if tag.strip()})
+            for record_id, tags in items
+        ]
+        pairs = set().union(*(p for _, p in parsed))
+        if not pairs:
+            return
+        conn.executemany(f"INSERT OR IGNORE INTO {self.tags_table} (namespace, name) VALUES (?, ?)", list(pairs))
+        lookup = f"SELECT id FROM {self.tags_table} WHERE namespace = ? AND name = ?"
+        tag_ids = {pair: conn.execute(lookup, pair).fetchone()[0] for pair in pairs}
+        conn.executemany(
+            f"INSERT OR IGNORE INTO {self.gallery_tags_table} (tag_id, record_id) VALUES (?, ?)",
+            [(tag_ids[pair], record_id) for record_id, record_pairs in parsed for pair in record_pairs]
+        )
+
+    @staticmethod
+    def split_tag(tag: str, default_namespace: Optional[str] = 'misc') -> Tuple[Optional[str], str]:
+        """'namespace:name' -> (namespace, name)；没有命名空间时使用 default_namespace"""
+        parts = tag.strip().split(':', 1)
+        if len(parts) == 2 and parts[0].strip():
+            return parts[0].strip(), parts[1].strip()
+        return default_namespace, tag.strip()
+
+    def _retry_upsert_sql(self) -> str:
+        """
+        记录一次失败：同一模式、同一原因连续失败时次数累加、间隔翻倍 (base * 2^(次数-1)，不超过 cap)，否则重新计数
+        DO UPDATE 中的列引用均为旧值；base 为 NULL 时 next_eligible 为 NULL (永久失败)
+        """
+        same = "(last_mode IS excluded.last_mode AND reason = excluded.reason)"
+        return f"""
+        INSERT INTO {self.retry_table}
+            (file_path, reason, attempts, last_mode, last_error, last_attempt, next_eligible)
+        VALUES (:path, :reason, 1, :mode, :error, :now, :now + min(:base, :cap))
+        ON CONFLICT(file_path) DO UPDATE SET
+            attempts = CASE WHEN {same} THEN coalesce(attempts, 0) + 1 ELSE 1 END,
+            next_eligible = :now + min(:base * (1 << CASE WHEN {same} THEN min(coalesce(attempts, 0), 30) ELSE 0 END), :cap),
+            reason = excluded.reason,
+            last_mode = excluded.last_mode,
+            last_error = excluded.last_error,
+            last_attempt = excluded.last_attempt
+        """
+
+    def _save_sql(self) -> str:
+        return f"""
+        INSERT INTO {self.table_name} 
+        (file_path, file_name, gallery_url, title, tags, status, note, scan_time, gallery_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """
+
+    # ================= 写缓冲 (Group Commit) =================
+
+    def enable_write_behind(self, max_rows: int = 50, max_delay_ms: int = 1000):
+        """
+        开启写缓冲：save_record 先进入内存缓冲，每 max_rows 条或每 max_delay_ms 毫秒
+        在一个事务内批量提交，避免每条记录都触发一次 WAL fsync
+        """
+        if self._write_behind:
+            return
+        self._write_behind_rows = max(1, max_rows)
+        self._write_behind_delay = max(10, max_delay_ms) / 1000.0
+        self._write_behind = True
+        self._flush_stop.clear()
+        self._flush_thread = threading.Thread(target=self._flush_loop, name="db-write-behind", daemon=True)
+        self._flush_thread.start()
+        logger.debug(f"📝 [DB] 写缓冲已开启: {self._write_behind_rows} 条 / {max_delay_ms} ms")
+
+    def disable_write_behind(self):
+        """关闭写缓冲并提交剩余记录"""
+        if not self._write_behind:
+            return
+        self._write_behind = False
+        self._flush_stop.set()
+        if self._flush_thread:
+            self._flush_thread.join(timeout=5)
+            self._flush_thread = None
+        self.flush()
+
+    def flush(self) -> bool:
+        """立即提交缓冲区中的所有记录"""
+        with self._flush_lock:
+            with self._buffer_lock:
+                if not self._write_buffer:
+                    return True
+                batch = self._write_buffer
+                self._write_buffer = OrderedDict()
+                # 提交完成前仍可被 get_record_by_path 读到
+                self._inflight = batch
+
+            ok = self._write_records(list(batch.values()))
+            if not ok:
+                # 批量失败时逐条写入，避免一条坏数据拖累整批
+                logger.warning(f"⚠️ [DB] 批量提交失败，改为逐条写入 ({len(batch)} 条)")
+                for params in batch.values():
+                    self._write_records([params])
+
+            with self._buffer_lock:
+                self._inflight = OrderedDict()
+            logger.debug(f"📝 [DB] 批量提交 {len(batch)} 条记录")
+            return ok
+
+    def _flush_loop(self):
+        while not self._flush_stop.wait(self._write_behind_delay):
+            self.flush()
+
+    def _get_buffered(self, file_path: str) -> Optional[Dict]:
+        """读取尚未提交的记录 (保证写后读一致)"""
+        with self._buffer_lock:
+            params = self._write_buffer.get(file_path) or self._inflight.get(file_path)
+        if not params:
+            return None
+        return dict(zip(self.RECORD_COLUMNS, (None,) + params[:-1]))
+
+    def close(self):
+        """关闭前停止后台标签迁移 (进度已保存) 并提交缓冲区中的记录"""
+        if self.conn:
+            self._backfill_stop.set()
+            if self._backfill_thread:
+                self._backfill_thread.join()
+                self._backfill_thread = None
+            self.disable_write_behind()
+            self.flush()
+        super().close()
+
+    def get_record_by_path(self, file_path: Union[str, Path]) -> Optional[Union[sqlite3.Row, Dict]]:
+        buffered = self._get_buffered(str(file_path))
+        if buffered:
+            return buffered
         sql = f"SELECT * FROM {self.table_name} WHERE file_path = ?"
         return self._execute_read(sql, (str(file_path),), fetch_one=True)
 
-    def get_all_processed_paths(self) -> Set[str]:
-        sql = f"SELECT file_path FROM {self.table_name}"
-        rows = self._execute_read(sql)
-        return {row['file_path'] for row in rows} if rows else set()
+    def get_processed_paths(self, file_paths: List[str]) -> Set[str]:
+        """返回给定路径中已在主表中的部分 (按 file_path 索引分批查询)"""
+        with self._buffer_lock:
+            found = {p for p in file_paths if p in self._write_buffer or p in self._inflight}
+        for start in range(0, len(file_paths), 500):
+            chunk = file_paths[start:start + 500]
+            sql = f"SELECT file_path FROM {self.table_name} WHERE file_path IN ({','.join('?' * len(chunk))})"
+            found.update(row['file_path'] for row in self._execute_read(sql, tuple(chunk)))
+        return found
 
-    def get_success_records(self) -> List[Dict]:
-        """获取所有 status='SUCCESS' 的记录"""
+    def get_success_records(self, min_id: int = 0) -> List[Dict]:
+        """
+        获取 status='SUCCESS' 的记录 (物化为列表，供增量查重读取少量新记录；全库请用 iter_success_records)
+        :param min_id: 只返回 id 大于该值的记录 (增量查重)
+        """
+        self.flush()
         sql = f"""
-        SELECT id, file_path, file_name, gallery_url, title 
+        SELECT id, file_path, file_name, gallery_url, gallery_key, title 
         FROM {self.table_name} 
-        WHERE status = 'SUCCESS'
+        WHERE status = 'SUCCESS' AND id > ?
         """
-        rows = self._execute_read(sql)
+        rows = self._execute_read(sql, (min_id,))
         return [dict(row) for row in rows] if rows else []
 
+    def iter_success_records(self, batch_size: int = 1000) -> Iterator[sqlite3.Row]:
+        """流式遍历全部 SUCCESS 记录 (只读连接 + fetchmany，不在内存中物化整表)"""
+        self.flush()
+        sql = f"SELECT id, file_path, file_name, gallery_key FROM {self.table_name} WHERE status = 'SUCCESS'"
+        return self._iter_read(sql, batch_size=batch_size)
+
+    def iter_url_duplicates(self, keys: Optional[List[str]] = None) -> Iterator[sqlite3.Row]:
+        """
+        流式返回画廊键重复 (>1 条 SUCCESS) 的记录，按 gallery_key 排序，可直接 groupby
+        分组在 SQL 中完成 (走 status + gallery_key 索引)，只有重复的行会被读出
+        :param keys: 只检查这些画廊键 (增量查重)；None 表示全库
+        """
+        self.flush()
+        select = f"""
+        SELECT id, file_path, file_name, gallery_url, gallery_key, title FROM {self.table_name}
+        WHERE status = 'SUCCESS' AND gallery_key IN (
+            SELECT gallery_key FROM {self.table_name}
+            WHERE status = 'SUCCESS' AND gallery_key IS NOT NULL {{key_filter}}
+            GROUP BY gallery_key HAVING COUNT(*) > 1
+        )
+        ORDER BY gallery_key, id
+        """
+        if keys is None:
+            yield from self._iter_read(select.format(key_filter=''))
+            return
+        keys = sorted(set(keys))
+        # 分批后每批内按键排序，批之间的键也有序，整体仍按 gallery_key 排序
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            key_filter = f"AND gallery_key IN ({','.join('?' * len(chunk))})"
+            yield from self._iter_read(select.format(key_filter=key_filter), tuple(chunk))
+
+    def get_max_record_id(self) -> int:
+        self.flush()
+        row = self._execute_read(f"SELECT MAX(id) AS max_id FROM {self.table_name}", fetch_one=True)
+        return (row['max_id'] if row else None) or 0
+
+    # ================= 标签查询 =================
+
+    def query_by_tags(self, tags: List[str] = (), namespaces: List[str] = (),
+                      status: Optional[str] = 'SUCCESS', limit: int = 100) -> List[sqlite3.Row]:
+        """
+        按标签筛选记录 (条件之间为 AND)，走标签表索引而非 LIKE 全表扫描
+        第一个条件通过 (namespace, name) -> tag_id -> record_id 索引取候选，
+        其余条件用 EXISTS 按 record_id 索引逐条核对；只有 (大) 命名空间条件时按 id 顺序扫描到 limit 即停
+        :param tags: 'namespace:name' 精确匹配；不带命名空间时匹配任意命名空间下的同名标签
+        :param namespaces: 记录至少含有一个该命名空间下的标签
+        """
+        conditions = []
+        for tag in tags:
+            ns, name = self.split_tag(tag, default_namespace=None)
+            conditions.append(("t.name = ?", (name,)) if ns is None else ("t.namespace = ? AND t.name = ?", (ns, name)))
+        for ns in namespaces:
+            conditions.append(("t.namespace = ?", (ns.strip().rstrip(':'),)))
+        if not conditions:
+            return []
+
+        where, params = [], []
+        driver = bool(tags)
+        if not driver:
+            # 只有命名空间条件：命名空间下标签很少时 (记录少) 也用索引取候选，避免扫描整表仍凑不满 limit
+            row = self._execute_read(f"SELECT COUNT(*) AS n FROM {self.tags_table} WHERE namespace = ?",
+                                     conditions[0][1], fetch_one=True)
+            if not row or not row['n']:
+                return []
+            driver = row['n'] < 100
+        if driver:
+            cond, cond_params = conditions.pop(0)
+            where.append(f"""r.id IN (
+                SELECT gt.record_id FROM {self.tags_table} t
+                JOIN {self.gallery_tags_table} gt ON gt.tag_id = t.id WHERE {cond})""")
+            params.extend(cond_params)
+        for cond, cond_params in conditions:
+            where.append(f"""EXISTS (
+                SELECT 1 FROM {self.gallery_tags_table} gt JOIN {self.tags_table} t ON t.id = gt.tag_id
+                WHERE gt.record_id = r.id AND {cond})""")
+            params.extend(cond_params)
+        if status:
+            # "+" 禁止使用 (status, gallery_key) 索引：按状态取全部行再排序远慢于按标签 / id 顺序过滤
+            where.append("+r.status = ?")
+            params.append(status)
+
+        sql = f"""
+        SELECT r.id, r.file_path, r.title, r.gallery_url, r.status FROM {self.table_name} r
+        WHERE {' AND '.join(where)}
+        ORDER BY r.id LIMIT ?
+        """
+        self.flush()
+        return self._execute_read(sql, tuple(params) + (limit,))
+
+    # ================= 全文检索 =================
+
+    def search(self, text: str, status: Optional[str] = 'SUCCESS', limit: int = 20) -> List[sqlite3.Row]:
+        """
+        按文件名 / 标题 / 标签全文检索，结果按 bm25 相关度排序 (分数越小越相关)
+        查询词按 cjk_search_terms 切分，全部命中 (AND)；trigram 至少需要 3 个字符，
+        更短的词 (如两个汉字的人名) 在 FTS 候选上用 LIKE 过滤，全为短词时退化为主表 LIKE
+        """
+        terms = cjk_search_terms(text)
+        if not terms:
+            return []
+        long_terms = [term for term in terms if len(term) >= 3] if self.fts_enabled else []
+        short_terms = [term for term in terms if term not in long_terms]
+
+        where, params = [], []
+        for term in short_terms:
+            where.append("(r.file_name LIKE ? OR r.title LIKE ? OR r.tags LIKE ?)")
+            params.extend([f"%{term}%"] * 3)
+        if status:
+            where.append("+r.status = ?")
+            params.append(status)
+
+        columns = "r.id, r.file_path, r.file_name, r.title, r.gallery_url, r.status"
+        if long_terms:
+            match = ' AND '.join(f'"{term}"' for term in long_terms)
+            sql = f"""
+            SELECT {columns}, bm25({self.fts_table}, 2.0, 2.0, 1.0) AS score
+            FROM {self.fts_table} JOIN {self.table_name} r ON r.id = {self.fts_table}.rowid
+            WHERE {self.fts_table} MATCH ? {''.join(' AND ' + w for w in where)}
+            ORDER BY score LIMIT ?
+            """
+            params.insert(0, match)
+        else:
+            sql = f"""
+            SELECT {columns}, NULL AS score FROM {self.table_name} r
+            WHERE {' AND '.join(where)}
+            ORDER BY r.id DESC LIMIT ?
+            """
+        self.flush()
+        return self._execute_read(sql, tuple(params) + (limit,))
+
+    # ================= 重试队列 =================
+
+    def get_due_retries(self, reasons: List[str], before: float, limit: int = -1) -> List[sqlite3.Row]:
+        """到期 (next_eligible <= before) 且原因在 reasons 中的条目，按到期时间、失败次数排序 (走 next_eligible 索引)"""
+        self.flush()
+        sql = f"""
+        SELECT file_path, reason, attempts, last_mode FROM {self.retry_table}
+        WHERE next_eligible <= ? AND reason IN ({','.join('?' * len(reasons))})
+        ORDER BY next_eligible, attempts LIMIT ?
+        """
+        return self._execute_read(sql, (before, *reasons, limit))
+
+    def get_retry_paths(self, file_paths: List[str], reason: str) -> Set[str]:
+        """给定路径中重试队列原因为 reason 的部分 (按主键分批查询；MISSING 等由 mark_retries_permanent 直接写入，无需 flush)"""
+        found = set()
+        for start in range(0, len(file_paths), 500):
+            chunk = file_paths[start:start + 500]
+            sql = f"""SELECT file_path FROM {self.retry_table}
+                      WHERE reason = ? AND file_path IN ({','.join('?' * len(chunk))})"""
+            found.update(row['file_path'] for row in self._execute_read(sql, (reason, *chunk)))
+        return found
+
+    def mark_retries_permanent(self, file_paths: List[str], reason: str):
+        """标记为永久失败 (不再自动重试)"""
+        self._execute_many(
+            f"UPDATE {self.retry_table} SET reason = ?, next_eligible = NULL WHERE file_path = ?",
+            [(reason, path) for path in file_paths]
+        )
+
+    def count_retries_by_reason(self) -> Dict[str, Tuple[int, int]]:
+        """{reason: (条目数, 其中永久失败数)}"""
+        self.flush()
+        sql = f"""
+        SELECT reason, COUNT(*) AS n, SUM(next_eligible IS NULL) AS permanent
+        FROM {self.retry_table} GROUP BY reason
+        """
+        return {row['reason']: (row['n'], row['permanent']) for row in self._execute_read(sql)}
+
+    # ================= 运行状态 =================
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._execute_read(f"SELECT value FROM {self.meta_table} WHERE key = ?", (key,), fetch_one=True)
+        return row['value'] if row else None
+
+    def set_meta(self, key: str, value):
+        self._execute_write(f"INSERT OR REPLACE INTO {self.meta_table} (key, value) VALUES (?, ?)", (key, str(value)))
+
+    # ================= 元数据缓存 =================
+
+    def get_cached_metadata(self, keys: List[Tuple[int, str]], min_fetched_at: float = 0) -> Dict[Tuple[int, str], str]:
+        """批量读取未过期的 gmetadata 原始 JSON: {(gid, token): json}"""
+        result = {}
+        wanted = set(keys)
+        gids = list({gid for gid, _ in wanted})
+        # SQLite 单条语句参数数量有限，分批查询
+        for start in range(0, len(gids), 500):
+            chunk = gids[start:start + 500]
+            sql = f"""
+            SELECT gid, token, data FROM metadata_cache
+            WHERE gid IN ({','.join('?' * len(chunk))}) AND fetched_at >= ?
+            """
+            for row in self._execute_read(sql, (*chunk, min_fetched_at)):
+                key = (row['gid'], row['token'])
+                if key in wanted:
+                    result[key] = row['data']
+        return result
+
+    def save_cached_metadata(self, items: List[Tuple[int, str, str]]):
+        """批量写入 gmetadata 原始 JSON: [(gid, token, json)]"""
+        if not items: return
+        sql = "INSERT OR REPLACE INTO metadata_cache (gid, token, data, fetched_at) VALUES (?, ?, ?, ?)"
+        now = time.time()
+        self._execute_many(sql, [(gid, token, data, now) for gid, token, data in items])
+
+    def purge_metadata_cache(self, before: float) -> bool:
+        """删除 fetched_at 早于 before 的缓存条目"""
+        return self._execute_write("DELETE FROM metadata_cache WHERE fetched_at < ?", (before,))
+
+    # ================= Hash 搜索缓存 =================
+
+    def get_hash_search(self, sha1: str, mode: str) -> Optional[sqlite3.Row]:
+        sql = "SELECT result, candidates, searched_at FROM hash_search_cache WHERE sha1 = ? AND mode = ?"
+        return self._execute_read(sql, (sha1, mode), fetch_one=True)
+
+    def save_hash_search(self, sha1: str, mode: str, result: str, candidates: Optional[str] = None):
+        sql = """
+        INSERT OR REPLACE INTO hash_search_cache (sha1, mode, result, candidates, searched_at)
+        VALUES (?, ?, ?, ?, ?)
+        """
+        self._execute_write(sql, (sha1, mode, result, candidates, time.time()))
+
+    # ================= 文件索引 =================
+
+    def get_dir_state(self, dir_path: str) -> Optional[sqlite3.Row]:
+        return self._execute_read("SELECT mtime, subdirs FROM dir_index WHERE path = ?", (dir_path,), fetch_one=True)
+
+    def get_dir_files(self, dir_path: str) -> Dict[str, Tuple[int, float, int, bool]]:
+        """
+        目录下已索引的归档: {path: (size, mtime, inode, pending)}，按路径排序
+        pending 为真表示文件已变化、但新的扫描结果尚未入库
+        """
+        sql = "SELECT path, size, mtime, inode, pending FROM file_index WHERE dir = ? ORDER BY path"
+        rows = self._execute_read(sql, (dir_path,))
+        return {
+            row['path']: (row['size'], row['mtime'], row['inode'], bool(row['pending'])) for row in rows
+        } if rows else {}
+
+    def save_dir_state(self, dir_path: str, mtime: float, subdirs: List[str],
+                       files: List[Tuple[str, int, float, int, bool]]):
+        """
+        在一个事务内刷新目录状态及其下的文件索引: files = [(path, size, mtime, inode, pending)]
+        pending 标记在对应记录保存时 (_write_records) 清除，中途停止的扫描下次仍会重新处理
+        """
+        def save(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO dir_index (path, mtime, subdirs) VALUES (?, ?, ?)",
+                (dir_path, mtime, json.dumps(subdirs, ensure_ascii=False))
+            )
+            conn.execute("DELETE FROM file_index WHERE dir = ?", (dir_path,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO file_index (path, dir, size, mtime, inode, pending) VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, dir_path, size, f_mtime, inode, int(pending)) for path, size, f_mtime, inode, pending in files]
+            )
+        try:
+            self._run_write(save)
+        except Exception as e:
+            logger.error(f"❌ 保存目录索引失败: {dir_path} - {e}")
+
+    # ================= 归档指纹 =================
+
+    def get_fingerprint(self, file_path: str) -> Optional[sqlite3.Row]:
+        return self._execute_read("SELECT * FROM archive_fingerprints WHERE file_path = ?", (file_path,), fetch_one=True)
+
+    def get_fingerprints(self, file_paths: List[str]) -> Dict[str, sqlite3.Row]:
+        """批量读取指纹: {file_path: row}"""
+        result = {}
+        for start in range(0, len(file_paths), 500):
+            chunk = file_paths[start:start + 500]
+            sql = f"SELECT * FROM archive_fingerprints WHERE file_path IN ({','.join('?' * len(chunk))})"
+            result.update((row['file_path'], row) for row in self._execute_read(sql, tuple(chunk)))
+        return result
+
+    def iter_stale_fingerprint_paths(self, version: int) -> Iterator[str]:
+        """
+        SUCCESS 记录中没有指纹行、或指纹行版本过期的文件路径
+        只在数据库内 JOIN，不访问文件 (增量查重据此决定哪些旧记录需要重算 pHash)
+        """
+        self.flush()
+        sql = f"""
+        SELECT m.file_path FROM {self.table_name} m
+        LEFT JOIN archive_fingerprints f ON f.file_path = m.file_path
+        WHERE m.status = 'SUCCESS' AND (f.file_path IS NULL OR f.version IS NOT ?)
+        """
+        for row in self._iter_read(sql, (version,)):
+            yield row['file_path']
+
+    def save_cover_phashes(self, updates: List[Tuple[str, str]],
+                           inserts: List[Tuple[str, Optional[int], Optional[float], int, Optional[str], Optional[str]]]):
+        """
+        批量写入封面 pHash
+        :param updates: [(pHash, file_path)]，指纹行仍有效，只补 pHash
+        :param inserts: [(file_path, size, mtime, version, pHash, status)]，无有效指纹行，写入只含 pHash 的部分行；
+                        pHash 为 None 表示已尝试但无法计算 (无封面 / 无法解码)，避免每次查重重复打开；
+                        status 通常为空，文件已不存在时为 FILE_ERROR
+        """
+        now = time.time()
+        if updates:
+            self._execute_many(
+                "UPDATE archive_fingerprints SET cover_phash = ?, updated_at = ? WHERE file_path = ?",
+                [(phash, now, path) for phash, path in updates]
+            )
+        if inserts:
+            self._execute_many(
+                """INSERT OR REPLACE INTO archive_fingerprints
+                   (file_path, size, mtime, version, cover_phash, status, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                [row + (now,) for row in inserts]
+            )
+
+    def save_fingerprint(self, file_path: str, size: int, mtime: float, version: int, fp: Dict):
+        sql = """
+        INSERT OR REPLACE INTO archive_fingerprints
+        (file_path, size, mtime, version, status, cover_sha1, second_sha1,
+         cover_phash, image_count, archive_format, page_hashes, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """
+        params = (
+            file_path, size, mtime, version, fp.get('status'), fp.get('cover_sha1'), fp.get('second_sha1'),
+            fp.get('cover_phash'), fp.get('image_count'), fp.get('archive_format'),
+            json.dumps(fp.get('page_hashes') or {}), time.time()
+        )
+        self._execute_write(sql, params)
+
     def find_and_store_url_duplicates(self) -> int:
         return 0
             
-    def store_dedup_results(self, flat_records: List[Dict]):
+    def get_dedup_relations(self) -> Dict[str, Tuple[str, str, float]]:
+        """当前查重结果: {file_path: (group_id, duplicate_type, similarity_score)}"""
+        sql = f"""
+        SELECT r.file_path, r.group_id, g.duplicate_type, r.similarity_score
+        FROM {self.relations_table} r LEFT JOIN {self.groups_table} g ON g.group_id = r.group_id
+        """
+        return {
+            row['file_path']: (row['group_id'], row['duplicate_type'], row['similarity_score'])
+            for row in self._execute_read(sql)
+        }
+
+    def count_dedup_relations(self) -> int:
+        row = self._execute_read(f"SELECT COUNT(*) AS n FROM {self.relations_table}", fetch_one=True)
+        return row['n'] if row else 0
+
+    def clear_dedup_results(self):
+        """清空查重结果 (全量重建前调用)"""
+        def clear(conn):
+            conn.execute(f"DELETE FROM {self.relations_table}")
+            conn.execute(f"DELETE FROM {self.groups_table}")
+        try:
+            self._run_write(clear)
+        except Exception as e:
+            logger.error(f"❌ 清空查重结果失败: {e}")
+
+    def merge_dedup_results(self, assignments: Dict[str, Tuple[str, str, float, str]],
+                            absorbed_groups: List[str] = (), reset_paths: List[str] = ()):
         """
-        批量存储高级查重结果到关系表
+        增量合并查重结果 (同一事务)
+        :param assignments: {file_path: (group_id, duplicate_type, score, file_name)}，每个文件只属于一个组
+        :param absorbed_groups: 已并入其他组的旧组 ID (成员已包含在 assignments 中)
+        :param reset_paths: 需要重新判定的文件，先移除其旧关系
+        assignments 为空时只清理失效关系 (已删除 / 非 SUCCESS 的文件及成员不足 2 个的组)
         """
-        if not flat_records: return
+        groups = {gid: dup_type for gid, dup_type, _, _ in assignments.values()}
+
+        def merge(conn):
+            paths = list(dict.fromkeys(list(reset_paths) + list(assignments)))
+            for start in range(0, len(paths), 500):
+                chunk = paths[start:start + 500]
+                conn.execute(
+                    f"DELETE FROM {self.relations_table} WHERE file_path IN ({','.join('?' * len(chunk))})",
+                    tuple(chunk)
+                )
+            conn.executemany(f"DELETE FROM {self.groups_table} WHERE group_id = ?",
+                             [(gid,) for gid in absorbed_groups])
+
+            conn.executemany(
+                f"INSERT OR IGNORE INTO {self.groups_table} (group_id, duplicate_type) VALUES (?, ?)",
+                list(groups.items())
+            )
+            conn.executemany(
+                f"""INSERT INTO {self.relations_table} (group_id, file_path, file_name, similarity_score)
+                    VALUES (?, ?, ?, ?)""",
+                [(gid, path, name, score) for path, (gid, _, score, name) in assignments.items()]
+            )
+
+            # 记录已删除或不再是 SUCCESS (重新扫描失败等) 的文件移出分组
+            conn.execute(f"""
+            DELETE FROM {self.relations_table} WHERE NOT EXISTS (
+                SELECT 1 FROM {self.table_name} m
+                WHERE m.file_path = {self.relations_table}.file_path AND m.status = 'SUCCESS'
+            )""")
+            # 成员不足 2 个的组已无意义 (成员被重新判定后离开)
+            conn.execute(f"""
+            DELETE FROM {self.relations_table} WHERE group_id IN (
+                SELECT group_id FROM {self.relations_table} GROUP BY group_id HAVING COUNT(*) < 2
+            )""")
+            conn.execute(f"""
+            DELETE FROM {self.groups_table}
+            WHERE group_id NOT IN (SELECT DISTINCT group_id FROM {self.relations_table})
+            """)
 
         try:
-            with self._lock:
-                # 1. 清空旧表 (使用动态表名)
-                self.conn.execute(f"DELETE FROM {self.relations_table}")
-                self.conn.execute(f"DELETE FROM {self.groups_table}")
-                
-                # 2. 插入数据
-                groups_map = {}
-                relations_data = []
-
-                for item in flat_records:
-                    gid = item['group_id']
-                    if gid not in groups_map:
-                        groups_map[gid] = item['type']
-                    
-                    relations_data.append((
-                        gid,
-                        item['file_path'],
-                        item['file_name'],
-                        item.get('score', 0.0)
-                    ))
-
-                # 3. 批量插入组表
-                sql_group = f"""
-                INSERT INTO {self.groups_table} (group_id, duplicate_type) 
-                VALUES (?, ?)
-                """
-                self.conn.executemany(sql_group, list(groups_map.items()))
-
-                # 4. 批量插入关系表
-                sql_rel = f"""
-                INSERT INTO {self.relations_table} 
-                (group_id, file_path, file_name, similarity_score)
-                VALUES (?, ?, ?, ?)
-                """
-                self.conn.executemany(sql_rel, relations_data)
-
-                self.conn.commit()
-                logger.info(f"💾 查重数据已保存到 [{self.relations_table}] ({len(groups_map)} 组)")
-                
+            self._run_write(merge)
+            logger.info(f"💾 查重数据已合并到 [{self.relations_table}] ({len(groups)} 组有变化)")
         except Exception as e:
-            logger.error(f"❌ 存储查重结果失败: {e}")
\ No newline at end of file
+            logger.error(f"❌ 合并查重结果失败: {e}")
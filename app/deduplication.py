@@ -1,150 +1,350 @@
 # app/deduplication.py
+import os
+import math
 import logging
-import uuid
+import hashlib
 from collections import defaultdict
-from typing import List, Dict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+from typing import List, Dict, Tuple, Set, Iterator
 
+from . import config
 from .utils import parse_gallery_title
 from .archive_processor import ArchiveProcessor
 from .phash_tool import PHashTool
+from .fingerprint import FingerprintStore
+from .phash_index import PHashIndex
 
 logger = logging.getLogger(__name__)
 
+# 查重高水位 (已处理到的最大记录 id)，保存在 {表名}_meta
+HIGH_WATER_KEY = 'dedup_high_water'
+
+# {file_path: (group_id, duplicate_type, score, file_name)}
+Assignments = Dict[str, Tuple[str, str, float, str]]
+
+# (新记录路径, 相似文件路径, 汉明距离)
+Edge = Tuple[str, str, int]
+
+# 待查询的新记录少于该数量时不启动进程池 (进程启动与传输数据的开销大于收益)
+PARALLEL_MIN_QUERIES = 2000
+
+
+# ================= 进程池任务 =================
+# 工作进程内的分组数据 (由 initializer 注入一次) 及已建好的近邻索引 (每个进程每个分组只建一次)
+_worker_buckets: Dict[str, List[Tuple[str, int]]] = {}
+_worker_indexes: Dict[str, PHashIndex] = {}
+_worker_radius = 5
+
+
+def _init_cluster_worker(buckets: Dict[str, List[Tuple[str, int]]], radius: int):
+    global _worker_buckets, _worker_radius
+    _worker_buckets, _worker_radius = buckets, radius
+    _worker_indexes.clear()
+
+
+def _cluster_worker(task: List[Tuple[str, List[str]]]) -> List[Edge]:
+    """进程池任务：task 为 [(分组键, 该组中需要查询的新记录路径)]"""
+    edges = []
+    for key, query_paths in task:
+        index = _worker_indexes.get(key)
+        if index is None:
+            index = _worker_indexes[key] = _build_index(_worker_buckets[key], _worker_radius)
+        edges.extend(_query_edges(index, query_paths))
+    return edges
+
+
+def _build_index(items: List[Tuple[str, int]], radius: int) -> PHashIndex:
+    index = PHashIndex(radius)
+    index.add_many(items)
+    return index
+
+
+def _query_edges(index: PHashIndex, query_paths: List[str]) -> List[Edge]:
+    edges = []
+    for path in query_paths:
+        value = index.get(path)
+        if value is None:
+            continue
+        edges.extend((path, other, dist) for other, dist in index.query(value) if other != path)
+    return edges
+
+
 class DeduplicationManager:
     """
     高级多维查重管理器
     支持 URL 分组和 pHash 视觉相似度分组
+
+    增量模式：只处理上次查重之后新增 / 重新扫描的记录 (id 大于高水位)，
+    在全库中查找它们的重复项并合并进已有分组；组 ID 由内容确定 (URL / 成员路径)，
+    多次运行保持稳定，分组合并时保留较小的 ID。
     """
     def __init__(self, db_manager):
         self.db = db_manager
         self.processor = ArchiveProcessor()
+        # 封面 pHash 优先读取指纹表，文件未变化时不再打开归档
+        self.fingerprints = FingerprintStore(db_manager, self.processor)
         # pHash 汉明距离阈值 (<=5 视为同一张图)
         self.phash_threshold = 5
 
-    def run(self, progress_callback=None) -> int:
-        if progress_callback: progress_callback('log', "📊 正在读取数据库记录...")
-        records = self.db.get_success_records()
-        
-        if len(records) < 2:
-            return 0
+    def run(self, progress_callback=None, full: bool = False) -> int:
+        """
+        :param full: True 时清空查重结果并全量重建；从未运行过查重时自动全量
+        :return: 当前查重结果中的重复文件数
+        """
+        high_water = self.db.get_meta(HIGH_WATER_KEY)
+        full = full or high_water is None
+        since = 0 if full else int(high_water)
+        max_id = self.db.get_max_record_id()
 
-        all_duplicate_records = []
-        processed_file_paths = set()
+        mode_text = "全量重建" if full else f"增量 (记录 id > {since})"
+        if progress_callback: progress_callback('log', f"📊 正在读取数据库记录... [{mode_text}]")
+        # 全量模式不物化全表：Phase 1 在 SQL 中分组，Phase 2 流式读取全库
+        new_records = [] if full else self.db.get_success_records(min_id=since)
+
+        if full:
+            self.db.clear_dedup_results()
+        relations = {} if full else self.db.get_dedup_relations()
+
+        # 指纹表中缺少 pHash 或算法版本过期的旧记录 (URL 组成员不参与视觉查重)，与新记录一起重新判定
+        new_paths = {r['file_path'] for r in new_records}
+        stale = [] if full or not PHashTool.is_available() else [
+            p for p in self.fingerprints.stale_phash_paths()
+            if p not in new_paths and relations.get(p, (None, None))[1] != 'URL_MATCH'
+        ]
+        if stale:
+            if progress_callback: progress_callback('log', f"♻️ {len(stale)} 条旧记录的 pHash 缺失或已过期，将重新计算")
+
+        if not full and not new_records and not stale:
+            # 仍需清理已删除 / 不再是 SUCCESS 的记录留下的关系
+            self.db.merge_dedup_results({})
+            self.db.set_meta(HIGH_WATER_KEY, max_id)
+            if progress_callback: progress_callback('log', "✅ 没有新增记录，查重结果无需更新")
+            return self.db.count_dedup_relations()
+
+        # 新记录 (含重新扫描的) 及 pHash 重算的记录，旧分组不再可信，重新判定
+        for path in list(new_paths) + stale:
+            relations.pop(path, None)
 
         # ================= Phase 1: URL 分组 =================
         if progress_callback: progress_callback('log', "🔍 [Phase 1] URL 精确查重...")
-        
-        url_map = defaultdict(list)
-        for r in records:
-            if r.get('gallery_url'):
-                url_map[r['gallery_url']].append(r)
-        
-        url_group_count = 0
-        for url, group in url_map.items():
-            if len(group) > 1:
-                group_id = f"URL-{uuid.uuid4().hex[:8]}"
-                url_group_count += 1
-                for item in group:
-                    all_duplicate_records.append({
-                        **item,
-                        'group_id': group_id,
-                        'type': 'URL_MATCH',
-                        'score': 1.0
-                    })
-                    processed_file_paths.add(item['file_path'])
+        url_assignments = self._group_by_url(new_records, full)
 
         # ================= Phase 2: pHash 视觉分组 =================
+        phash_assignments, absorbed = {}, set()
         if not PHashTool.is_available():
             logger.warning("⚠️ 缺少依赖，跳过 pHash 查重")
-            self.db.store_dedup_results(all_duplicate_records)
-            return len(all_duplicate_records)
-
-        if progress_callback: progress_callback('log', "👁️ [Phase 2] pHash 视觉查重 (按作者分组)...")
-        
-        # 排除已被 URL 分组命中的文件
-        candidates = [r for r in records if r['file_path'] not in processed_file_paths]
-        
-        # 按作者分组
-        author_groups = defaultdict(list)
-        for r in candidates:
-            info = parse_gallery_title(r['file_name'])
-            key = "Misc"
-            if info.get('artist'): key = f"Artist:{info['artist']}"
-            elif info.get('group'): key = f"Group:{info['group']}"
-            author_groups[key].append(r)
-        
-        phash_cache = {}
-        phash_group_count = 0
-        
-        total_groups = len(author_groups)
-        curr_group_idx = 0
-
-        for key, items in author_groups.items():
-            curr_group_idx += 1
-            if len(items) < 2: continue
-            
-            if progress_callback and curr_group_idx % 10 == 0:
-                progress_callback('log', f"Processing {curr_group_idx}/{total_groups}: {key}")
-
-            # 并查集初始化
-            parent = list(range(len(items)))
-            def find(i):
-                if parent[i] != i: parent[i] = find(parent[i])
-                return parent[i]
-            def union(i, j):
-                root_i, root_j = find(i), find(j)
-                if root_i != root_j: parent[root_i] = root_j
-
-            # 组内两两比对 (对于单文档重复3次以上的情况：A=B, B=C -> A,B,C 一组)
-            has_merge = False
-            for i in range(len(items)):
-                p1 = self._get_phash(items[i]['file_path'], phash_cache)
-                if not p1: continue
-                
-                for j in range(i + 1, len(items)):
-                    p2 = self._get_phash(items[j]['file_path'], phash_cache)
-                    if not p2: continue
-                    
-                    dist = PHashTool.calculate_distance(p1, p2)
-                    if dist <= self.phash_threshold:
-                        union(i, j)
-                        has_merge = True
-
-            if has_merge:
-                # 收集分组
-                clusters = defaultdict(list)
-                for i in range(len(items)):
-                    root = find(i)
-                    clusters[root].append(items[i])
-                
-                for root, cluster_items in clusters.items():
-                    if len(cluster_items) > 1:
-                        group_id = f"PHASH-{uuid.uuid4().hex[:8]}"
-                        phash_group_count += 1
-                        for item in cluster_items:
-                            # 重新计算相对于组内第一个元素的相似度 (仅作参考)
-                            base_phash = self._get_phash(cluster_items[0]['file_path'], phash_cache)
-                            curr_phash = self._get_phash(item['file_path'], phash_cache)
-                            dist = PHashTool.calculate_distance(base_phash, curr_phash)
-                            score = PHashTool.get_similarity_score(dist)
-                            
-                            all_duplicate_records.append({
-                                **item,
-                                'group_id': group_id,
-                                'type': 'PHASH_MATCH',
-                                'score': score
-                            })
-
-        msg = f"查重结束: {url_group_count} 个 URL 组, {phash_group_count} 个 pHash 组"
+        else:
+            phash_assignments, absorbed = self._group_by_phash(
+                new_records, stale, relations, url_assignments, full, progress_callback
+            )
+
+        url_group_count = len({v[0] for v in url_assignments.values()})
+        phash_group_count = len({v[0] for v in phash_assignments.values()})
+        msg = f"查重结束: {url_group_count} 个 URL 组, {phash_group_count} 个 pHash 组有更新"
         logger.info(msg)
         if progress_callback: progress_callback('log', msg)
 
         # ================= Phase 3: 保存 =================
-        self.db.store_dedup_results(all_duplicate_records)
-        return len(all_duplicate_records)
-
-    def _get_phash(self, path, cache):
-        if path in cache: return cache[path]
-        val = self.processor.get_image_phash(path)
-        cache[path] = val
-        return val
\ No newline at end of file
+        self.db.merge_dedup_results(
+            {**phash_assignments, **url_assignments},
+            absorbed_groups=sorted(absorbed),
+            reset_paths=list(new_paths) + stale
+        )
+        self.db.set_meta(HIGH_WATER_KEY, max_id)
+        return self.db.count_dedup_relations()
+
+    def _group_by_url(self, new_records: List[Dict], full: bool) -> Assignments:
+        """
+        新记录的画廊与库中其他 SUCCESS 记录相同即为一组 (组 ID 由归一化画廊键决定)
+        分组由数据库 GROUP BY 完成，这里只流式读取重复的行
+        :param new_records: 增量模式下的新记录；全量模式为空，检查全库
+        """
+        keys = None if full else [r['gallery_key'] for r in new_records if r.get('gallery_key')]
+        if keys == []:
+            return {}
+
+        assignments = {}
+        for key, group in groupby(self.db.iter_url_duplicates(keys), key=lambda row: row['gallery_key']):
+            group_id = self._stable_id('URL', key)
+            for item in group:
+                assignments[item['file_path']] = (group_id, 'URL_MATCH', 1.0, item['file_name'])
+        return assignments
+
+    def _group_by_phash(self, new_records: List[Dict], stale: List[str], relations: Dict[str, Tuple[str, str, float]],
+                        url_assignments: Assignments, full: bool, progress_callback=None) -> Tuple[Assignments, Set[str]]:
+        """
+        新记录在 (全库或同作者的) 近邻索引中查询，并与命中文件所在的已有 pHash 组合并
+        :param new_records: 增量模式下的新记录；全量模式为空，全库记录均视为新记录
+        :param stale: 需要重算 pHash 的旧记录，与新记录一样重新计算并查询
+        :return: (有变化的分组成员, 被并入其他组的旧组 ID)
+        """
+        scope = getattr(config, 'DEDUP_SCOPE', 'library')
+        scope_text = "全库" if scope == 'library' else "按作者分组"
+        if progress_callback: progress_callback('log', f"👁️ [Phase 2] pHash 视觉查重 ({scope_text})...")
+
+        # 已在 URL 组中的文件不参与视觉查重
+        def in_url_group(path):
+            return path in url_assignments or relations.get(path, (None, None))[1] == 'URL_MATCH'
+
+        new_candidates = [r for r in new_records if not in_url_group(r['file_path'])]
+        if not full and not new_candidates and not stale:
+            return {}, set()
+        # 候选文件名 {file_path: file_name}；流式读取全库，只保留路径和文件名
+        names = {
+            row['file_path']: row['file_name'] for row in self.db.iter_success_records()
+            if not in_url_group(row['file_path'])
+        }
+        if full:
+            new_paths = set(names)
+        else:
+            new_paths = {r['file_path'] for r in new_candidates}
+            new_paths.update(p for p in stale if p in names)
+
+        # 只有新记录和过期记录需要 stat 并计算 pHash (进程池批量写入指纹表)；
+        # 其余记录信任指纹表中的大小/mtime，不再逐个访问文件
+        self.fingerprints.prefill_phashes(
+            list(new_paths),
+            workers=getattr(config, 'PHASH_WORKERS', 0),
+            progress_callback=progress_callback
+        )
+        phashes = {
+            path: PHashTool.to_int(h)
+            for path, h in self.fingerprints.get_phashes(list(names), check_files=False).items()
+        }
+
+        # 只需要为含有新记录的分组建立索引
+        buckets = defaultdict(list)
+        for path, name in names.items():
+            buckets[self._bucket_key(name, scope)].append(path)
+        buckets = {k: v for k, v in buckets.items() if new_paths.intersection(v)}
+
+        # 并查集 (节点为文件路径；已有分组以 "G:组ID" 作为虚拟节点，使同组成员保持连通)
+        parent = {}
+        def find(x):
+            parent.setdefault(x, x)
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+        def union(a, b):
+            ra, rb = find(a), find(b)
+            if ra != rb: parent[ra] = rb
+
+        # 分组数据只保留有 pHash 的文件；查询集为组内的新记录
+        bucket_items = {
+            key: [(p, phashes[p]) for p in paths if phashes.get(p) is not None]
+            for key, paths in buckets.items()
+        }
+        bucket_queries = {
+            key: [p for p, _ in items if p in new_paths] for key, items in bucket_items.items()
+        }
+        bucket_queries = {k: v for k, v in bucket_queries.items() if v}
+
+        best_dist: Dict[str, int] = {}
+        for path, other, dist in self._find_edges(bucket_items, bucket_queries, progress_callback):
+            union(path, other)
+            for p in (path, other):
+                best_dist[p] = min(best_dist.get(p, dist), dist)
+                old = relations.get(p)
+                if old and old[1] == 'PHASH_MATCH':
+                    union(p, f"G:{old[0]}")
+
+        # 收集分组
+        components = defaultdict(list)
+        for node in list(parent):
+            components[find(node)].append(node)
+
+        members_by_group = defaultdict(list)
+        for path, (gid, dup_type, _) in relations.items():
+            if dup_type == 'PHASH_MATCH':
+                members_by_group[gid].append(path)
+
+        assignments, absorbed = {}, set()
+        for nodes in components.values():
+            old_groups = sorted(n[2:] for n in nodes if n.startswith('G:'))
+            paths = [n for n in nodes if not n.startswith('G:')]
+            for gid in old_groups:
+                paths.extend(members_by_group.get(gid, []))
+            paths = list(dict.fromkeys(paths))
+            if len(paths) < 2:
+                continue
+
+            # 合并时保留最小的已有组 ID；全新分组的 ID 由最小的成员路径决定
+            group_id = old_groups[0] if old_groups else self._stable_id('PHASH', min(paths))
+            absorbed.update(old_groups[1:])
+            for path in paths:
+                if path in best_dist:
+                    score = PHashTool.get_similarity_score(best_dist[path])
+                else:
+                    score = relations[path][2]
+                name = names.get(path) or path.replace('\\', '/').rsplit('/', 1)[-1]
+                assignments[path] = (group_id, 'PHASH_MATCH', score, name)
+        return assignments, absorbed
+
+    def _find_edges(self, bucket_items: Dict[str, List[Tuple[str, int]]], bucket_queries: Dict[str, List[str]],
+                    progress_callback=None) -> Iterator[Edge]:
+        """
+        在各分组的近邻索引中查询新记录，返回距离不超过阈值的相似对
+        查询量较大时拆分到进程池：大分组按查询切块，小分组合并成一个任务，
+        每个工作进程对同一分组只建一次索引；并查集合并仍在主进程完成
+        """
+        total = sum(len(q) for q in bucket_queries.values())
+        workers = getattr(config, 'DEDUP_WORKERS', 0) or os.cpu_count() or 1
+
+        if workers <= 1 or total < PARALLEL_MIN_QUERIES:
+            done = 0
+            for idx, (key, query_paths) in enumerate(bucket_queries.items(), 1):
+                yield from _query_edges(_build_index(bucket_items[key], self.phash_threshold), query_paths)
+                done += len(query_paths)
+                if progress_callback and (idx % 10 == 0 or done == total):
+                    progress_callback('progress', (done, total, f"pHash 比对: {key}"))
+            return
+
+        tasks = self._plan_tasks(bucket_queries, chunk_size=math.ceil(total / (workers * 4)))
+        # 只需传输含有新记录的分组
+        shared = {key: bucket_items[key] for key in bucket_queries}
+        if progress_callback: progress_callback('log', f"⚙️ pHash 比对: {total} 个新文件, {len(tasks)} 个任务, {workers} 个进程")
+
+        done = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_cluster_worker,
+                                 initargs=(shared, self.phash_threshold)) as executor:
+            futures = {executor.submit(_cluster_worker, task): sum(len(q) for _, q in task) for task in tasks}
+            for future in as_completed(futures):
+                yield from future.result()
+                done += futures[future]
+                if progress_callback: progress_callback('progress', (done, total, "pHash 比对"))
+
+    @staticmethod
+    def _plan_tasks(bucket_queries: Dict[str, List[str]], chunk_size: int) -> List[List[Tuple[str, List[str]]]]:
+        """按分组大小切分任务：每个任务约 chunk_size 个查询，大任务在前以平衡负载"""
+        chunk_size = max(1, chunk_size)
+        tasks, current, current_size = [], [], 0
+        for key, query_paths in sorted(bucket_queries.items(), key=lambda kv: -len(kv[1])):
+            if len(query_paths) >= chunk_size:
+                tasks.extend([(key, query_paths[i:i + chunk_size])]
+                             for i in range(0, len(query_paths), chunk_size))
+                continue
+            current.append((key, query_paths))
+            current_size += len(query_paths)
+            if current_size >= chunk_size:
+                tasks.append(current)
+                current, current_size = [], 0
+        if current:
+            tasks.append(current)
+        return tasks
+
+    @staticmethod
+    def _bucket_key(file_name: str, scope: str) -> str:
+        if scope == 'library':
+            # 全库一个分组：文件名中作者/社团不同的重复也能找到
+            return "Library"
+        info = parse_gallery_title(file_name)
+        if info.get('artist'): return f"Artist:{info['artist']}"
+        if info.get('group'): return f"Group:{info['group']}"
+        return "Misc"
+
+    @staticmethod
+    def _stable_id(prefix: str, seed: str) -> str:
+        """由内容决定的组 ID，重复运行保持不变"""
+        return f"{prefix}-{hashlib.sha1(seed.encode('utf-8')).hexdigest()[:12]}"
@@ -33,4 +33,9 @@ class ParseError(ScannerBaseError):
 class EmptyArchiveError(ScannerBaseError):
     """文件为空"""
     def __init__(self, message="压缩包文件为空或损坏", code=None):
-        super().__init__(message, code)
\ No newline at end of file
+        super().__init__(message, code)
+
+class RequestCancelledError(ScannerBaseError):
+    """请求在排队等待调度时被取消 (用户停止任务)"""
+    def __init__(self, message="请求已取消", code=None):
+        super().__init__(message, code)
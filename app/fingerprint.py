@@ -0,0 +1,209 @@
+# app/fingerprint.py
+import os
+import json
+import logging
+from pathlib import Path
+from typing import Optional, Dict, Tuple, Union, List
+
+from . import config
+
+from .archive_processor import ArchiveProcessor
+from .phash_tool import PHashTool
+
+logger = logging.getLogger(__name__)
+
+# 指纹算法版本：选页规则、pHash 解码方式等发生变化时递增，旧记录会被视为过期并重新计算
+# 3: pHash 改为降采样解码 (短边 >= 256)，与旧的完整解码结果不可混用
+FINGERPRINT_VERSION = 3
+
+class FingerprintStore:
+    """
+    归档指纹表 (archive_fingerprints)
+    以 (文件路径, 大小, mtime) 为键，缓存一次打开归档得到的全部指纹：
+    封面 SHA1、第二目标页 SHA1、封面 pHash、图片数量、归档格式，
+    以及多页模式下各位置页面的 SHA1 (page_hashes)。
+    扫描、重试和查重共用；文件未变化时不再打开归档。
+    """
+    def __init__(self, db=None, processor: Optional[ArchiveProcessor] = None):
+        """
+        :param db: DatabaseManager 实例；为 None 时每次都重新计算
+        """
+        self.db = db
+        self.processor = processor or ArchiveProcessor()
+        # 多页模式依次尝试的页面位置 (按命中率从高到低)
+        self.pages: List[str] = [str(p) for p in getattr(config, 'FINGERPRINT_PAGES', ['cover', 10, 2, 'last'])]
+
+    def get(self, archive_path: Union[str, Path], compute: bool = True,
+            pages: Optional[List[str]] = None) -> Optional[Dict]:
+        """
+        获取归档指纹：文件未变化时直接读表，否则打开归档计算并写回
+        :param compute: False 时只查表，不打开归档
+        :param pages: 需要的页面位置标签；缓存中缺少其中任一位置时重新计算
+        """
+        archive_path = Path(archive_path)
+        try:
+            st = os.stat(archive_path)
+        except OSError:
+            return None
+
+        if self.db:
+            row = self.db.get_fingerprint(str(archive_path))
+            if row and self._is_fresh(row, st):
+                fp = dict(row)
+                fp['page_hashes'] = self._load_page_hashes(fp.get('page_hashes'))
+                if fp['status'] != 'OK' or all(label in fp['page_hashes'] for label in pages or []):
+                    return fp
+                # 已有的页面位置一并重新计算，避免覆盖丢失
+                pages = list(dict.fromkeys(list(fp['page_hashes']) + list(pages)))
+
+        if not compute:
+            return None
+
+        fp = self.processor.get_fingerprint(archive_path, pages=pages)
+        # 读取失败可能是临时性的 (网络盘断开等)，不写入缓存
+        if self.db and fp['status'] != 'FILE_ERROR':
+            self.db.save_fingerprint(str(archive_path), st.st_size, st.st_mtime, FINGERPRINT_VERSION, fp)
+        return fp
+
+    def get_hash(self, archive_path: Union[str, Path], target_mode: str = 'cover') -> Tuple[Optional[str], str]:
+        """返回指定模式 (cover / second) 目标图片的 Hash: (sha1, status)"""
+        fp = self.get(archive_path)
+        if not fp:
+            return None, "FILE_ERROR"
+        if fp['status'] != 'OK':
+            return None, fp['status']
+        return fp['second_sha1' if target_mode == 'second' else 'cover_sha1'], "OK"
+
+    def get_page_hashes(self, archive_path: Union[str, Path]) -> Tuple[Optional[List[Tuple[str, str]]], str]:
+        """
+        多页模式：一次打开归档得到各位置页面的 SHA1
+        :return: ([(位置标签, sha1), ...], status)，按配置顺序排列，跳过超出页数和重复的页面
+        """
+        fp = self.get(archive_path, pages=self.pages)
+        if not fp:
+            return None, "FILE_ERROR"
+        if fp['status'] != 'OK':
+            return None, fp['status']
+
+        hashes, seen = [], set()
+        for label in self.pages:
+            sha1 = fp['page_hashes'].get(label)
+            if sha1 and sha1 not in seen:
+                seen.add(sha1)
+                hashes.append((label, sha1))
+        return hashes, "OK"
+
+    def get_phash(self, archive_path: Union[str, Path]) -> Optional[str]:
+        # 查重预计算写入的部分行 (只有 pHash) 同样可用，无需再打开归档
+        if self.db:
+            row = self.db.get_fingerprint(str(archive_path))
+            if row and row['cover_phash'] and self._matches_file(row, archive_path):
+                return row['cover_phash']
+        fp = self.get(archive_path)
+        return fp.get('cover_phash') if fp else None
+
+    def get_phashes(self, archive_paths: List[Union[str, Path]], check_files: bool = True) -> Dict[str, str]:
+        """
+        批量读取指纹表中仍有效的封面 pHash: {路径: pHash}；不打开归档
+        :param check_files: False 时不逐个 stat，信任表中记录的大小/mtime (只核对算法版本)，
+                            供查重在已对新记录 prefill 之后读取全库使用 (网络盘上避免全量 stat)
+        """
+        if not self.db:
+            return {}
+        paths = [str(p) for p in archive_paths]
+        rows = self.db.get_fingerprints(paths)
+        result = {}
+        for path in paths:
+            row = rows.get(path)
+            if not (row and row['cover_phash']):
+                continue
+            if self._matches_file(row, path) if check_files else row['version'] == FINGERPRINT_VERSION:
+                result[path] = row['cover_phash']
+        return result
+
+    def stale_phash_paths(self) -> List[str]:
+        """SUCCESS 记录中没有指纹行或指纹版本过期的路径 (只查数据库，不访问文件)"""
+        if not self.db:
+            return []
+        return list(self.db.iter_stale_fingerprint_paths(FINGERPRINT_VERSION))
+
+    def prefill_phashes(self, archive_paths: List[Union[str, Path]], workers: int = 0, progress_callback=None) -> int:
+        """
+        批量补齐缺失的封面 pHash (进程池并行，JPEG 降采样解码)
+        :return: 新计算的数量
+        """
+        if not self.db or not PHashTool.is_available():
+            return 0
+
+        paths = [str(p) for p in archive_paths]
+        rows = self.db.get_fingerprints(paths)
+        missing, vanished = {}, []
+        for path in paths:
+            row = rows.get(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # 文件已不存在：写入当前版本的标记行 (FILE_ERROR，无大小/mtime)，
+                # 避免 stale_phash_paths 每次查重都报告同一批路径；文件重新出现时大小不符会重新计算
+                if not row or row['version'] != FINGERPRINT_VERSION:
+                    vanished.append((path, None, None, FINGERPRINT_VERSION, None, 'FILE_ERROR'))
+                continue
+            # 已有 pHash，或之前已尝试过但无法计算 (部分行 / 无图片等)：文件未变化时不再打开
+            if row and self._is_same_file(row, st) and (row['cover_phash'] or row['status'] != 'OK'):
+                continue
+            missing[path] = (st, row is not None and self._is_same_file(row, st))
+
+        if vanished:
+            self.db.save_cover_phashes([], vanished)
+        if not missing:
+            return 0
+        logger.info(f"👁️ [pHash] 需要计算 {len(missing)} 个封面 pHash")
+
+        updates, inserts, done = [], [], 0
+        for path, phash in PHashTool.compute_batch(((p, p) for p in missing), workers=workers):
+            done += 1
+            st, has_row = missing[path]
+            if has_row:
+                if phash:
+                    updates.append((phash, path))
+            else:
+                # 计算失败也写入部分行 (pHash 为空)，文件不变时不再重复尝试
+                inserts.append((path, st.st_size, st.st_mtime, FINGERPRINT_VERSION, phash, None))
+            if len(updates) + len(inserts) >= 500:
+                self.db.save_cover_phashes(updates, inserts)
+                updates, inserts = [], []
+            if progress_callback and done % 200 == 0:
+                progress_callback('log', f"👁️ pHash 计算进度 {done}/{len(missing)}")
+
+        self.db.save_cover_phashes(updates, inserts)
+        return done
+
+    @classmethod
+    def _matches_file(cls, row, archive_path: Union[str, Path]) -> bool:
+        try:
+            return cls._is_same_file(row, os.stat(archive_path))
+        except OSError:
+            return False
+
+    @staticmethod
+    def _is_same_file(row, st: os.stat_result) -> bool:
+        return row['version'] == FINGERPRINT_VERSION and row['size'] == st.st_size and row['mtime'] == st.st_mtime
+
+    @staticmethod
+    def _load_page_hashes(data: Optional[str]) -> Dict[str, Optional[str]]:
+        try:
+            return json.loads(data) if data else {}
+        except ValueError:
+            return {}
+
+    @staticmethod
+    def _is_fresh(row, st: os.stat_result) -> bool:
+        if not FingerprintStore._is_same_file(row, st):
+            return False
+        # 只含 pHash 的部分行：扫描时仍需完整计算
+        if row['status'] is None:
+            return False
+        # 之前缺少 pHash 依赖，现在已安装：重新计算以补齐 pHash
+        if row['status'] == 'OK' and not row['cover_phash'] and PHashTool.is_available():
+            return False
+        return True
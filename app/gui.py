@@ -87,11 +87,17 @@ class ScannerGUI:
         self.txt_log.see(tk.END)
         self.txt_log.config(state='disabled')
 
-    def update_progress(self, current, total, msg):
-        """更新进度条"""
-        self.progress["maximum"] = total
+    def update_progress(self, current, total, msg, discovering=False, discovered=0):
+        """
+        更新进度条
+        discovering=True: 目录仍在遍历中，total 为目前已提交处理的文件数，discovered 为目前遍历到的文件数
+        """
+        self.progress["maximum"] = max(total, 1)
         self.progress["value"] = current
-        self.lbl_status.config(text=f"[{current}/{total}] {msg}")
+        if discovering:
+            self.lbl_status.config(text=f"[{current}/{total}+ | 已发现 {discovered}，仍在遍历目录...] {msg}")
+        else:
+            self.lbl_status.config(text=f"[{current}/{total}] {msg}")
 
     # --- 线程与回调处理 ---
 
@@ -210,4 +216,8 @@ class ScannerGUI:
 def run_gui():
     root = tk.Tk()
     app = ScannerGUI(root)
-    root.mainloop()
\ No newline at end of file
+    try:
+        root.mainloop()
+    finally:
+        # 窗口关闭后提交写缓冲中的记录
+        app.controller.shutdown()
\ No newline at end of file
@@ -0,0 +1,109 @@
+# app/library_walker.py
+import os
+import json
+import time
+import logging
+from pathlib import Path
+from typing import Iterator, Tuple, List, Dict
+
+logger = logging.getLogger(__name__)
+
+# 支持的归档扩展名 (小写)
+ARCHIVE_EXTENSIONS = ('.zip', '.rar', '.7z', '.cbz', '.cbr')
+
+# 目录 mtime 距今不足该秒数时不信任 (文件系统时间精度有限，同一秒内的后续修改可能无法体现)
+DIR_MTIME_GRACE = 2.0
+
+class LibraryWalker:
+    """
+    单次遍历的归档文件发现器
+    1. 基于 os.scandir，一次遍历匹配所有扩展名 (不再按扩展名多次 rglob)
+    2. 持久化 (path, size, mtime, inode) 文件索引及目录 mtime
+    3. 目录 mtime 未变化时不再列目录，直接复用索引中的文件和子目录
+       (子目录仍会逐个检查，因为子目录内的变化不会体现在父目录 mtime 上)
+    4. 发生变化的文件在索引中标记为待处理，直到新的扫描结果入库；
+       扫描中途停止 / 崩溃时，下次遍历仍会把它们报告为有变化
+    """
+    def __init__(self, db, extensions: Tuple[str, ...] = ARCHIVE_EXTENSIONS):
+        self.db = db
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.stats = {'dirs_listed': 0, 'dirs_skipped': 0, 'files': 0, 'changed': 0}
+
+    def walk(self, root: Path, full: bool = False) -> Iterator[Tuple[Path, bool]]:
+        """
+        遍历 root 下所有归档文件
+        :param full: True 时忽略目录 mtime，强制重新列出所有目录 (仍会更新索引)
+        :return: 迭代 (文件路径, 是否相对索引发生变化)；首次出现的文件不算变化
+        """
+        self.stats = {'dirs_listed': 0, 'dirs_skipped': 0, 'files': 0, 'changed': 0}
+        stack = [Path(root)]
+
+        while stack:
+            directory = stack.pop()
+            try:
+                dir_mtime = os.stat(directory).st_mtime
+            except OSError as e:
+                logger.warning(f"⚠️ [Walker] 无法访问目录: {directory} - {e}")
+                continue
+
+            state = None if full else self.db.get_dir_state(str(directory))
+            if state and state['mtime'] == dir_mtime:
+                # 目录内容未变化：直接使用索引
+                self.stats['dirs_skipped'] += 1
+                entries = [
+                    (Path(path), pending) for path, (_, _, _, pending) in self.db.get_dir_files(str(directory)).items()
+                ]
+                subdirs = json.loads(state['subdirs'] or "[]")
+            else:
+                self.stats['dirs_listed'] += 1
+                entries, subdirs = self._list_directory(directory, dir_mtime)
+
+            for path, changed in entries:
+                self.stats['files'] += 1
+                if changed:
+                    self.stats['changed'] += 1
+                yield path, changed
+
+            # 倒序压栈，保证按名称顺序遍历
+            for name in reversed(subdirs):
+                stack.append(directory / name)
+
+    def _list_directory(self, directory: Path, dir_mtime: float) -> Tuple[List[Tuple[Path, bool]], List[str]]:
+        """列出目录并刷新索引，返回 ([(文件, 是否变化)], [子目录名])"""
+        known = self.db.get_dir_files(str(directory))
+        files = []
+        subdirs = []
+        records = []
+
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif entry.name.lower().endswith(self.extensions) and entry.is_file():
+                            st = entry.stat()
+                            path = directory / entry.name
+                            old = known.get(str(path))
+                            # 上次发现的变化尚未处理完 (pending) 时仍算作变化
+                            changed = bool(old) and (old[3] or old[0] != st.st_size or old[1] != st.st_mtime)
+                            files.append((path, changed))
+                            records.append((str(path), st.st_size, st.st_mtime, entry.inode(), changed))
+                    except OSError as e:
+                        logger.warning(f"⚠️ [Walker] 读取条目失败: {entry.path} - {e}")
+        except OSError as e:
+            logger.warning(f"⚠️ [Walker] 列目录失败: {directory} - {e}")
+            return [], []
+
+        files.sort(key=lambda item: item[0].name)
+        subdirs.sort()
+
+        # 刚被修改过的目录不记录 mtime，下次仍会重新列出
+        saved_mtime = dir_mtime if time.time() - dir_mtime > DIR_MTIME_GRACE else -1.0
+        self.db.save_dir_state(str(directory), saved_mtime, subdirs, records)
+        return files, subdirs
+
+    def format_stats(self) -> str:
+        s = self.stats
+        return (f"列出目录 {s['dirs_listed']} | 跳过未变目录 {s['dirs_skipped']} | "
+                f"归档 {s['files']} | 有变化 {s['changed']}")
@@ -2,16 +2,23 @@
 from pathlib import Path
 import re
 import html
+import time
+import random
 import logging
-from typing import Optional, Dict, Union
+import threading
+from collections import deque, OrderedDict
+from typing import Optional, Dict, Union, Tuple, List, Any
 from functools import lru_cache
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
-from .exceptions import IpBlockedError
+from . import config
+from .exceptions import IpBlockedError, RequestCancelledError
 from .archive_processor import ArchiveProcessor
+from .cache import MetadataCache, HashSearchCache
+from .fingerprint import FingerprintStore
 
 try:
     from bs4 import BeautifulSoup
@@ -20,8 +27,146 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+class TokenBucket:
+    """
+    令牌桶：以 rate (次/秒) 匀速补充令牌，最多积攒 burst 个
+    reserve() 预约一个令牌并返回需要等待的秒数 (令牌可透支，实现排队)
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = max(rate, 1e-6)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def refund(self):
+        """取消预约时归还令牌"""
+        self._tokens = min(self.burst, self._tokens + 1)
+
+
+class RequestScheduler:
+    """
+    全局请求调度器
+    所有对 E-Hentai 的请求 (Hash 搜索 / 文本搜索 / gdata API) 都要先 acquire 对应端点的令牌。
+    只有真正发出请求时才消耗配额，本地失败 (NO_IMAGES 等) 不产生任何等待。
+    """
+    # 统计当前速率的滑动窗口 (秒)
+    RATE_WINDOW = 60.0
+
+    def __init__(self, limits: Dict[str, Tuple[float, int]], jitter: float = 0.0):
+        """
+        :param limits: {endpoint: (每秒请求数, 突发容量)}
+        :param jitter: 每次需要等待时额外附加的随机秒数上限 (防止请求间隔过于规律)
+        """
+        self.jitter = max(0.0, jitter)
+        self._buckets = {name: TokenBucket(rate, burst) for name, (rate, burst) in limits.items()}
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        self._stats = {name: {'sent': 0, 'wait_time': 0.0} for name in self._buckets}
+        self._history = {name: deque() for name in self._buckets}
+
+    def acquire(self, endpoint: str):
+        """
+        阻塞直到允许向 endpoint 发送请求
+        :raises RequestCancelledError: 等待期间调用了 cancel()
+        """
+        if self._cancel_event.is_set():
+            raise RequestCancelledError()
+
+        with self._lock:
+            bucket = self._buckets.get(endpoint)
+            if bucket is None:
+                raise KeyError(f"未配置的请求端点: {endpoint}")
+            wait = bucket.reserve()
+
+        if wait > 0:
+            wait += random.uniform(0, self.jitter)
+            logger.debug(f"⏳ [Scheduler] {endpoint} 等待 {wait:.2f}s")
+            if self._cancel_event.wait(wait):
+                with self._lock:
+                    bucket.refund()
+                raise RequestCancelledError()
+
+        now = time.monotonic()
+        with self._lock:
+            stats = self._stats[endpoint]
+            stats['sent'] += 1
+            stats['wait_time'] += wait
+            history = self._history[endpoint]
+            history.append(now)
+            while history and now - history[0] > self.RATE_WINDOW:
+                history.popleft()
+
+    def cancel(self):
+        """唤醒并取消所有正在等待的请求 (用户停止任务)"""
+        self._cancel_event.set()
+
+    def resume(self):
+        """新任务开始前恢复调度"""
+        self._cancel_event.clear()
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """
+        各端点统计: sent (已发送请求数), wait_time (累计等待秒数),
+        rate (最近 RATE_WINDOW 秒内的请求速率，次/分钟)
+        """
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for name, stats in self._stats.items():
+                history = self._history[name]
+                while history and now - history[0] > self.RATE_WINDOW:
+                    history.popleft()
+                result[name] = {
+                    'sent': stats['sent'],
+                    'wait_time': round(stats['wait_time'], 2),
+                    'rate': round(len(history) * 60.0 / self.RATE_WINDOW, 2),
+                }
+        return result
+
+    def format_stats(self) -> str:
+        return " | ".join(
+            f"{name}: {s['sent']} 次, 等待 {s['wait_time']:.1f}s, {s['rate']:.1f} 次/分"
+            for name, s in self.get_stats().items()
+        )
+
+
+_scheduler: Optional[RequestScheduler] = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler() -> RequestScheduler:
+    """获取全局共享的请求调度器 (按 config.RATE_LIMITS 懒加载)"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            # 兼容旧配置：未配置 RATE_LIMITS 时按 SLEEP_MIN/SLEEP_MAX 的平均间隔限速
+            interval = (getattr(config, 'SLEEP_MIN', 4.0) + getattr(config, 'SLEEP_MAX', 5.0)) / 2
+            limits = getattr(config, 'RATE_LIMITS', None) or {
+                'search': (1 / interval, 1),
+                'api': (1 / interval, 1),
+            }
+            _scheduler = RequestScheduler(limits, jitter=getattr(config, 'REQUEST_JITTER', 0.0))
+        return _scheduler
+
+
 class EHentaiHashSearcher:
-    def __init__(self, cookies: Optional[Dict] = None):
+    # gdata 接口单次请求最多可查询的画廊数
+    GDATA_BATCH_LIMIT = 25
+    # 保留候选列表的搜索结果数
+    CANDIDATE_CACHE_SIZE = 512
+
+    def __init__(self, cookies: Optional[Dict] = None, scheduler: Optional[RequestScheduler] = None,
+                 db=None):
+        """
+        :param scheduler: 请求调度器，默认使用全局共享实例
+        :param db: DatabaseManager 实例，用于持久化缓存；为 None 时只使用内存缓存
+        """
         # 1. 初始化网络会话
         self.session = requests.Session()
         self._setup_session(cookies)
@@ -30,11 +175,28 @@ class EHentaiHashSearcher:
         self.domain = "https://exhentai.org" if cookies and cookies.get('igneous') != 'mystery' else "https://e-hentai.org"
         self.api_url = "https://api.e-hentai.org/api.php"
         
-        # 2. 初始化本地归档处理器
+        # 2. 初始化本地归档处理器 (指纹按文件大小/mtime 持久化，重试时不再打开归档)
         self.processor = ArchiveProcessor()
+        self.fingerprints = FingerprintStore(db, self.processor)
         
-        # 3. [优化] 简单的内存缓存，避免重复请求相同的画廊元数据
-        self._metadata_cache = {}
+        # 3. [优化] 元数据缓存 (内存 LRU + 数据库持久化)，重试/重扫时无需再次请求
+        self.metadata_cache = MetadataCache(
+            db,
+            max_items=getattr(config, 'METADATA_CACHE_SIZE', 2048),
+            ttl_days=getattr(config, 'METADATA_CACHE_TTL_DAYS', 30)
+        )
+
+        # 4. Hash 搜索结果缓存 (sha1 + 模式)，重试时相同的 f_shash 查询不再发送
+        self.hash_cache = HashSearchCache(
+            db, negative_ttl_days=getattr(config, 'HASH_CACHE_NEGATIVE_TTL_DAYS', 14)
+        )
+
+        # 5. 全局请求调度 (所有请求共享同一组令牌桶)
+        self.scheduler = scheduler or get_scheduler()
+
+        # 6. 搜索页候选画廊: {首个结果 URL: [其余候选 URL]}，供批量验证时备选
+        self.max_candidates = max(1, getattr(config, 'MAX_SEARCH_CANDIDATES', 5))
+        self._candidates: "OrderedDict[str, List[str]]" = OrderedDict()
 
     def _setup_session(self, cookies):
         self.session.headers.update({
@@ -51,9 +213,23 @@ class EHentaiHashSearcher:
         self.session.cookies.set('nw', '1', domain='.e-hentai.org')
         self.session.cookies.set('nw', '1', domain='.exhentai.org')
 
-    def process_archive(self, archive_path: Union[str, object], target: str = 'cover') -> Union[str, None]:
+    def prepare_archive(self, archive_path: Union[str, object], target: str = 'cover') -> Tuple[Optional[Any], str]:
+        """
+        本地阶段：计算归档指纹 (只读盘，不访问网络)
+        标题模式无需指纹，直接返回 (None, "OK")
+        多页模式 (multi) 返回 ([(位置标签, sha1), ...], status)
+        """
+        if target == 'title':
+            return None, "OK"
+        if target == 'multi':
+            return self.fingerprints.get_page_hashes(Path(archive_path))
+        return self.fingerprints.get_hash(Path(archive_path), target_mode=target)
+
+    def process_archive(self, archive_path: Union[str, object], target: str = 'cover',
+                        prepared: Optional[Tuple[Optional[Any], str]] = None) -> Union[str, None]:
         """
         处理归档文件：计算 Hash 或 提取标题 -> 搜索
+        :param prepared: 流水线本地阶段已算好的 (hash, status)，传入时不再读盘
         """
         archive_path = Path(archive_path)
 
@@ -73,12 +249,48 @@ class EHentaiHashSearcher:
             return self.search_by_keyword(keyword)
 
         # === Hash 搜索模式 ===
-        f_hash, status = self.processor.get_file_hash(archive_path, target_mode=target)
+        f_hash, status = prepared or self.prepare_archive(archive_path, target)
         
         if status != "OK":
             return status
 
-        return self.search_by_hash(f_hash, is_cover=(target == 'cover'))
+        if target == 'multi':
+            return self._search_pages(f_hash)
+
+        return self._search_hash_cached(f_hash, is_cover=(target == 'cover'))
+
+    def _search_pages(self, page_hashes: List[Tuple[str, str]]) -> Union[str, None]:
+        """
+        多页模式：按配置顺序依次搜索各页 Hash，命中即返回
+        封面使用 fs_covers 搜索；全部未命中返回 NO_MATCH，出现请求失败且未命中时返回 None
+        """
+        result = "NO_MATCH"
+        for label, f_hash in page_hashes:
+            res = self._search_hash_cached(f_hash, is_cover=(label == 'cover'))
+            if res and res.startswith('http'):
+                logger.debug(f"✅ [Scanner] 多页模式命中: 位置 {label}")
+                return res
+            if res != "NO_MATCH":
+                result = None
+        return result
+
+    def _search_hash_cached(self, file_hash: str, is_cover: bool = True) -> Union[str, None]:
+        """先查 Hash 搜索缓存，未命中再访问网络，并把结果 (URL / NO_MATCH) 写回缓存"""
+        cache_mode = 'cover' if is_cover else 'page'
+        cached = self.hash_cache.get(file_hash, cache_mode)
+        if cached:
+            result, candidates = cached
+            logger.debug(f"⚡ [Cache] 命中 Hash 搜索缓存: {file_hash[:8]}... -> {result}")
+            if result.startswith('http'):
+                self._remember_candidates([result] + candidates)
+            return result
+
+        result = self.search_by_hash(file_hash, is_cover=is_cover)
+        if result == "NO_MATCH":
+            self.hash_cache.put(file_hash, cache_mode, result)
+        elif result and result.startswith('http'):
+            self.hash_cache.put(file_hash, cache_mode, result, self.get_candidates(result))
+        return result
 
     def search_by_hash(self, file_hash: str, is_cover: bool = True) -> Union[str, None]:
         if not file_hash: return None
@@ -88,13 +300,14 @@ class EHentaiHashSearcher:
         
         logger.debug(f"🔍 [Network] Hash搜索: {file_hash[:8]}... | Mode: {'Cover' if is_cover else 'Page'}")
 
+        self.scheduler.acquire('search')
         try:
             response = self.session.get(search_url, timeout=30)
             
             if "Your IP address has been" in response.text:
                 raise IpBlockedError("IP 被 E-Hentai 封禁")
 
-            result_url = self._parse_search_result(response.text)
+            result_url = self._remember_candidates(self._parse_search_results(response.text))
             if result_url:
                 logger.debug(f"✅ [Network] 找到匹配: {result_url}")
                 return result_url
@@ -111,12 +324,13 @@ class EHentaiHashSearcher:
         logger.debug(f"🔍 [Network] 文本搜索: {keyword}")
         params = {"f_search": keyword, "f_apply": "Apply Filter"}
 
+        self.scheduler.acquire('search')
         try:
             response = self.session.get(self.domain + "/", params=params, timeout=30)
             if "Your IP address has been" in response.text:
                 raise IpBlockedError("IP 被 E-Hentai 封禁")
 
-            result_url = self._parse_search_result(response.text)
+            result_url = self._remember_candidates(self._parse_search_results(response.text))
             if result_url:
                 logger.info(f"✅ [Network] 文本匹配成功: {result_url}")
                 return result_url
@@ -127,27 +341,69 @@ class EHentaiHashSearcher:
             logger.warning(f"⚠️ [Network] 搜索请求失败: {e}")
             return None
 
+    @staticmethod
+    def parse_gallery_url(gallery_url: str) -> Optional[Tuple[int, str]]:
+        """从画廊 URL 中提取 (gid, token)"""
+        match = re.search(r'/g/(\d+)/([\w]+)', gallery_url or "")
+        if not match: return None
+        return int(match.group(1)), match.group(2)
+
+    def get_candidates(self, gallery_url: str) -> List[str]:
+        """获取与该结果出现在同一搜索页上的其他候选画廊 (按页面顺序)"""
+        return list(self._candidates.get(gallery_url, []))
+
     def get_gallery_metadata(self, gallery_url: str) -> Optional[Dict]:
         """根据 URL 获取元数据 (带缓存)"""
-        match = re.search(r'/g/(\d+)/([\w]+)', gallery_url)
-        if not match: return None
-        
-        gid, token = int(match.group(1)), match.group(2)
-        cache_key = f"{gid}_{token}"
+        return self.get_gallery_metadata_batch([gallery_url]).get(gallery_url)
+
+    def get_gallery_metadata_batch(self, gallery_urls: List[str]) -> Dict[str, Optional[Dict]]:
+        """
+        批量获取元数据 (带缓存)
+        未命中缓存的画廊按 GDATA_BATCH_LIMIT 个一组合并为一次 gdata 请求
+        :return: {gallery_url: 元数据 或 None}，包含所有传入的 URL；
+                 None 表示已尝试但取不到 (URL 无效 / 请求失败 / 画廊返回错误)，调用方不应再逐个重试
+        """
+        results: Dict[str, Optional[Dict]] = {}
+        url_keys: Dict[str, Tuple[int, str]] = {}
+
+        for url in gallery_urls:
+            key = self.parse_gallery_url(url)
+            if key:
+                url_keys[url] = key
+            else:
+                results[url] = None
 
         # [优化] 检查缓存
-        if cache_key in self._metadata_cache:
-            logger.debug(f"⚡ [Cache] 命中元数据缓存: {gid}")
-            return self._metadata_cache[cache_key]
+        cached = self.metadata_cache.get_many(list(url_keys.values()))
+        pending: Dict[Tuple[int, str], List[str]] = {}
+        for url, key in url_keys.items():
+            if key in cached:
+                logger.debug(f"⚡ [Cache] 命中元数据缓存: {key[0]}")
+                results[url] = self._parse_gmetadata(cached[key])
+            else:
+                pending.setdefault(key, []).append(url)
+
+        keys = list(pending)
+        for start in range(0, len(keys), self.GDATA_BATCH_LIMIT):
+            chunk = keys[start:start + self.GDATA_BATCH_LIMIT]
+            fetched = self._fetch_gdata(chunk)
+            for key in chunk:
+                for url in pending[key]:
+                    results[url] = fetched.get(key)
 
-        logger.debug(f"☁️ [API] 获取元数据: GID={gid}")
+        return results
+
+    def _fetch_gdata(self, keys: List[Tuple[int, str]]) -> Dict[Tuple[int, str], Dict]:
+        """发送一次 gdata 请求，返回 {(gid, token): 元数据}"""
+        logger.debug(f"☁️ [API] 获取元数据: {len(keys)} 个画廊 (GID={', '.join(str(k[0]) for k in keys)})")
 
         payload = {
             "method": "gdata",
-            "gidlist": [[gid, token]],
+            "gidlist": [[gid, token] for gid, token in keys],
             "namespace": 1
         }
 
+        self.scheduler.acquire('api')
         try:
             res = self.session.post(self.api_url, json=payload, timeout=30)
             res.raise_for_status()
@@ -155,40 +411,63 @@ class EHentaiHashSearcher:
             
             if not data.get('gmetadata'): 
                 logger.warning(f"⚠️ [API] 未返回 gmetadata 数据")
-                return None
-            
-            gmeta = data['gmetadata'][0]
+                return {}
             
-            title_jpn = html.unescape(gmeta.get('title_jpn') or "")
-            title_en = html.unescape(gmeta.get('title') or "")
-            final_title = title_jpn if title_jpn else title_en
-            
-            tags = gmeta.get('tags', [])
-            if category := gmeta.get('category'):
-                tags.append(f"reclass:{category.lower()}")
-            
-            result = {
-                "title": final_title,
-                "title_jpn": title_jpn,
-                "title_en": title_en,
-                "tags": tags,
-                "uploader": gmeta.get('uploader'),
-                "category": category
-            }
+            results = {}
+            raw = {}
+            for gmeta in data['gmetadata']:
+                if gmeta.get('error'):
+                    logger.warning(f"⚠️ [API] GID={gmeta.get('gid')} 返回错误: {gmeta['error']}")
+                    continue
+
+                key = (int(gmeta['gid']), str(gmeta['token']))
+                raw[key] = gmeta
+                results[key] = self._parse_gmetadata(gmeta)
             
-            # [优化] 写入缓存
-            self._metadata_cache[cache_key] = result
-            return result
+            # [优化] 写入缓存 (保存原始 gmetadata)
+            self.metadata_cache.put_many(raw)
+            return results
 
         except Exception as e:
             logger.warning(f"⚠️ [API] 获取元数据异常: {e}")
-            return None
+            return {}
+
+    @staticmethod
+    def _parse_gmetadata(gmeta: Dict) -> Dict:
+        """将 gdata 接口返回的单条 gmetadata 转换为内部元数据格式"""
+        title_jpn = html.unescape(gmeta.get('title_jpn') or "")
+        title_en = html.unescape(gmeta.get('title') or "")
+        final_title = title_jpn if title_jpn else title_en
+        
+        tags = list(gmeta.get('tags', []))
+        if category := gmeta.get('category'):
+            tags.append(f"reclass:{category.lower()}")
+        
+        return {
+            "title": final_title,
+            "title_jpn": title_jpn,
+            "title_en": title_en,
+            "tags": tags,
+            "uploader": gmeta.get('uploader'),
+            "category": category
+        }
 
-    def _parse_search_result(self, html_content: str) -> Optional[str]:
-        """解析搜索结果页面"""
+    def _remember_candidates(self, urls: List[str]) -> Optional[str]:
+        """记录搜索页上的候选画廊，返回排在第一位的结果"""
+        if not urls: return None
+        primary = urls[0]
+        self._candidates[primary] = urls[1:self.max_candidates]
+        self._candidates.move_to_end(primary)
+        while len(self._candidates) > self.CANDIDATE_CACHE_SIZE:
+            self._candidates.popitem(last=False)
+        return primary
+
+    def _parse_search_results(self, html_content: str) -> List[str]:
+        """解析搜索结果页面，按页面顺序返回所有画廊链接 (去重)"""
         if "/g/" not in html_content:
-            return None
+            return []
 
+        results = []
         # 优先使用 BeautifulSoup 解析，更准确
         if BeautifulSoup:
             try:
@@ -199,14 +478,20 @@ class EHentaiHashSearcher:
                     # 匹配 /g/12345/abcdef/ 格式
                     if re.search(r'/g/\d+/[a-z0-9]+', href):
                         if self.domain in href:
-                            return href
+                            url = href
                         elif href.startswith("/"):
-                            return self.domain + href
+                            url = self.domain + href
+                        else:
+                            continue
+                        if url not in results:
+                            results.append(url)
             except Exception:
                 pass
 
         # 正则兜底
-        match = re.search(r'https?://e[x-]?hentai\.org/g/\d+/[a-z0-9]+/', html_content)
-        if match: return match.group(0)
+        if not results:
+            for url in re.findall(r'https?://e[x-]?hentai\.org/g/\d+/[a-z0-9]+/', html_content):
+                if url not in results:
+                    results.append(url)
         
-        return None
\ No newline at end of file
+        return results
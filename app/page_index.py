@@ -0,0 +1,107 @@
+# app/page_index.py
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Tuple, Iterable, Union
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+# 不属于画廊页面的目录 (macOS 资源分支、缩略图等)
+SKIP_DIRS = ('__macosx', 'thumbs', 'thumbnails', '.thumbnails')
+
+_DIGITS = re.compile(r'(\d+)')
+
+PageKey = Tuple[str, int, float]
+
+
+def natural_key(name: str) -> List[Union[str, int]]:
+    """自然排序键: 1.jpg < 2.jpg < 10.jpg (数字段按数值比较，其余忽略大小写)"""
+    parts = _DIGITS.split(name.lower())
+    parts[1::2] = [int(p) for p in parts[1::2]]
+    return parts
+
+
+def is_page(name: str) -> bool:
+    """是否为画廊页面：图片扩展名，且不是目录、隐藏文件或缩略图目录中的文件"""
+    if name.endswith('/') or not name.lower().endswith(IMAGE_EXTENSIONS):
+        return False
+    parts = name.replace('\\', '/').lower().split('/')
+    if parts[-1].startswith('.'):
+        return False
+    return not any(part in SKIP_DIRS for part in parts[:-1])
+
+
+class PageIndex:
+    """
+    归档的页面索引
+    成员列表过滤、自然排序只做一次；封面 / 第二目标页 / 任意第 N 页都从这里选取
+    """
+    def __init__(self, names: Iterable[str]):
+        self.pages: List[str] = sorted((n for n in names if is_page(n)), key=natural_key)
+
+    @property
+    def count(self) -> int:
+        return len(self.pages)
+
+    def page(self, number: int) -> Optional[str]:
+        """第 number 页 (从 1 开始；负数从末尾计，-1 为最后一页)，超出范围返回 None"""
+        if number == 0 or not self.pages:
+            return None
+        index = number - 1 if number > 0 else number
+        if not -len(self.pages) <= index < len(self.pages):
+            return None
+        return self.pages[index]
+
+    def position(self, label: Union[str, int]) -> Optional[str]:
+        """
+        按位置标签取页 (多页指纹使用)
+        :param label: 'cover' / 'second' / 'last' / 页码 (整数或数字字符串)；页码超出范围返回 None
+        """
+        label = str(label).lower()
+        if label in ('cover', 'second'):
+            return self.select(label)
+        if label == 'last':
+            return self.page(-1)
+        try:
+            return self.page(int(label))
+        except ValueError:
+            return None
+
+    def select(self, target: Union[str, int] = 'cover') -> Optional[str]:
+        """
+        选择目标页
+        :param target: 'cover' = 第一页；'second' = 第 10 页 (不足 10 页时取最后一页)；
+                       整数 = 第 N 页 (超出范围时取最后一页)
+        """
+        if not self.pages:
+            return None
+        if target == 'second':
+            return self.page(10) or self.pages[-1]
+        if isinstance(target, int):
+            return self.page(target) or self.pages[-1]
+        return self.pages[0]
+
+
+class PageIndexCache:
+    """以 (路径, 大小, mtime) 为键的页面索引 LRU；文件变化后自动失效"""
+    def __init__(self, max_items: int = 256):
+        self.max_items = max(1, max_items)
+        self._lru: "OrderedDict[PageKey, PageIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: PageKey) -> Optional[PageIndex]:
+        with self._lock:
+            index = self._lru.get(key)
+            if index is not None:
+                self._lru.move_to_end(key)
+            return index
+
+    def put(self, key: PageKey, index: PageIndex):
+        with self._lock:
+            self._lru[key] = index
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_items:
+                self._lru.popitem(last=False)
+
+
+page_index_cache = PageIndexCache()
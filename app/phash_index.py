@@ -0,0 +1,77 @@
+# app/phash_index.py
+from collections import defaultdict
+from itertools import combinations
+from typing import Dict, Hashable, Iterable, List, Tuple
+
+from .phash_tool import PHashTool
+
+class PHashIndex:
+    """
+    pHash 近邻索引 (多索引哈希 / 鸽巢原理)
+    64 位 pHash 切成 4 段 16 位；两个 Hash 距离 <= r 时，至少有一段的距离 <= r // 4。
+    查询时只枚举每段半径 r // 4 内的取值并查表，再用完整距离过滤候选，
+    避免两两比对 (O(n²))，可以在整个库范围内查重。
+    """
+    BANDS = 4
+    BAND_BITS = 16
+    BAND_MASK = (1 << BAND_BITS) - 1
+
+    def __init__(self, radius: int = 5):
+        """
+        :param radius: 查询半径 (汉明距离阈值)
+        """
+        self.radius = radius
+        self._tables: List[Dict[int, List[Hashable]]] = [defaultdict(list) for _ in range(self.BANDS)]
+        self._values: Dict[Hashable, int] = {}
+        self._probes = self._build_probes(radius // self.BANDS)
+
+    def _build_probes(self, band_radius: int) -> List[int]:
+        """单段内距离 <= band_radius 的所有翻转掩码 (含 0)"""
+        probes = [0]
+        for k in range(1, min(band_radius, self.BAND_BITS) + 1):
+            for bits in combinations(range(self.BAND_BITS), k):
+                mask = 0
+                for b in bits:
+                    mask |= 1 << b
+                probes.append(mask)
+        return probes
+
+    def _bands(self, value: int) -> List[int]:
+        return [(value >> (band * self.BAND_BITS)) & self.BAND_MASK for band in range(self.BANDS)]
+
+    def add(self, key: Hashable, value: int):
+        """加入一个 (key, 整数 pHash)；同一 key 重复加入时以首次为准"""
+        if key in self._values:
+            return
+        self._values[key] = value
+        for table, band_value in zip(self._tables, self._bands(value)):
+            table[band_value].append(key)
+
+    def add_many(self, items: Iterable[Tuple[Hashable, int]]):
+        for key, value in items:
+            self.add(key, value)
+
+    def query(self, value: int) -> List[Tuple[Hashable, int]]:
+        """返回距离 <= radius 的全部 (key, 距离)，按距离升序"""
+        seen = set()
+        result = []
+        for table, band_value in zip(self._tables, self._bands(value)):
+            for mask in self._probes:
+                for key in table.get(band_value ^ mask, ()):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    dist = PHashTool.distance(value, self._values[key])
+                    if dist <= self.radius:
+                        result.append((key, dist))
+        result.sort(key=lambda item: item[1])
+        return result
+
+    def get(self, key: Hashable):
+        return self._values.get(key)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._values
@@ -1,23 +1,125 @@
 # app/phash_tool.py
+import os
 import logging
 import io
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from typing import Optional, Iterable, Iterator, Tuple, Union, Any, List
 
 logger = logging.getLogger(__name__)
 
-# 尝试导入依赖
+# 尝试导入依赖 (pHash 由 NumPy 实现，不再依赖 imagehash)
 try:
     from PIL import Image
-    import imagehash
+    import numpy as np
     HAS_LIB = True
 except ImportError:
     Image = None
-    imagehash = None
+    np = None
     HAS_LIB = False
 
+# pHash 实际只使用 32x32 的缩略图；解码时只缩小到短边不低于该值 (32 的 8 倍)。
+# 降采样解码与完整解码的结果并非逐位一致 (此边长下少数图片偏移 1~4 位，64 时更多)，
+# 因此修改该值或解码方式时需递增 fingerprint.FINGERPRINT_VERSION，让已存 pHash 重新计算
+DECODE_MIN_SIZE = 256
+
+# 与 imagehash.phash(hash_size=8, highfreq_factor=4) 一致: 32x32 灰度图 -> 左上 8x8 DCT 系数
+HASH_SIZE = 8
+IMG_SIZE = HASH_SIZE * 4
+
+# 每个进程池任务处理的图片数 (缩略图堆叠后一次完成 DCT)
+BATCH_CHUNK = 32
+
+PHashSource = Union[bytes, str, Path]
+
+# 64 位汉明距离 (Python 3.10+ 使用 int.bit_count)
+_popcount = int.bit_count if hasattr(int, 'bit_count') else (lambda x: bin(x).count('1'))
+
+
+def _dct_matrix():
+    """DCT-II 矩阵的前 HASH_SIZE 行 (scipy.fftpack.dct 未归一化形式，常数因子不影响与中位数的比较)"""
+    k = np.arange(HASH_SIZE)[:, None]
+    n = np.arange(IMG_SIZE)[None, :]
+    return np.cos(np.pi * k * (2 * n + 1) / (2 * IMG_SIZE))
+
+_DCT = _dct_matrix() if HAS_LIB else None
+# 8x8 比特按行展开后的权重 (首位为最高位，与 imagehash 的十六进制表示一致)
+_BIT_WEIGHTS = (np.uint64(1) << np.arange(HASH_SIZE * HASH_SIZE - 1, -1, -1, dtype=np.uint64)) if HAS_LIB else None
+
+
+def _open_for_hash(image_bytes: bytes):
+    """
+    打开图片并尽量在解码阶段缩小 (短边不低于 DECODE_MIN_SIZE)：
+    JPEG 使用 draft() 按 1/2~1/8 比例解码 (保持原色彩模式，灰度转换仍由 convert('L') 完成)；
+    其他格式用 reduce() 整数倍缩小
+    """
+    img = Image.open(io.BytesIO(image_bytes))
+    if img.format == 'JPEG':
+        img.draft(img.mode, (DECODE_MIN_SIZE, DECODE_MIN_SIZE))
+    else:
+        factor = min(img.size) // DECODE_MIN_SIZE
+        if factor >= 2:
+            img = img.reduce(factor)
+    return img
+
+
+def _thumbnail(image_bytes: bytes):
+    """解码并缩放为 32x32 灰度矩阵"""
+    img = _open_for_hash(image_bytes).convert('L').resize((IMG_SIZE, IMG_SIZE), Image.LANCZOS)
+    return np.asarray(img, dtype=np.float64)
+
+
+def _hash_thumbnails(thumbs) -> List[int]:
+    """对 (N, 32, 32) 缩略图批量计算 pHash，返回 64 位整数列表"""
+    coeffs = _DCT @ thumbs @ _DCT.T                            # (N, 8, 8) 低频 DCT 系数
+    flat = coeffs.reshape(len(thumbs), -1)
+    # 对称图像的部分系数理论上为 0，浮点舍入误差会随机决定其与中位数的大小关系；统一归零
+    flat[np.abs(flat) < 1e-9 * np.abs(flat[:, :1])] = 0.0
+    bits = flat > np.median(flat, axis=1, keepdims=True)
+    return [int(v) for v in (bits.astype(np.uint64) * _BIT_WEIGHTS).sum(axis=1, dtype=np.uint64)]
+
+
+def _read_cover(source: PHashSource) -> Optional[bytes]:
+    """归档路径 -> 封面字节"""
+    from .archive_processor import ArchiveReader
+    try:
+        reader = ArchiveReader.open(source)
+        if reader is None:
+            return None
+        with reader:
+            cover = reader.select_target('cover')
+            return reader.read(cover) if cover else None
+    except Exception as e:
+        logger.warning(f"⚠️ [pHash] 读取封面失败 {Path(source).name}: {e}")
+        return None
+
+
+def _compute_worker(sources: List[PHashSource]) -> List[Optional[int]]:
+    """进程池任务：source 为图片字节或归档路径 (取封面)；整批缩略图一次完成 DCT"""
+    thumbs, slots = [], []
+    for i, source in enumerate(sources):
+        data = bytes(source) if isinstance(source, (bytes, bytearray)) else _read_cover(source)
+        if not data:
+            continue
+        try:
+            thumbs.append(_thumbnail(data))
+            slots.append(i)
+        except Exception as e:
+            logger.warning(f"⚠️ pHash 计算失败: {e}")
+
+    result: List[Optional[int]] = [None] * len(sources)
+    if thumbs:
+        for i, value in zip(slots, _hash_thumbnails(np.stack(thumbs))):
+            result[i] = value
+    return result
+
+
 class PHashTool:
     """
     pHash 算法独立封装模块
+    NumPy 实现 (灰度缩放 + DCT + 中位数)，对同一缩略图与 imagehash.phash 逐位一致
+    (大图经降采样解码，与完整解码相比可能偏移少量比特)；
+    内部使用 64 位整数，对外存储仍为 16 位十六进制字符串
     """
     @staticmethod
     def is_available() -> bool:
@@ -25,31 +127,99 @@ class PHashTool:
 
     @staticmethod
     def compute(image_bytes: bytes) -> Optional[str]:
-        """从二进制数据计算 pHash"""
+        """从二进制数据计算 pHash (十六进制字符串)"""
+        value = PHashTool.compute_int(image_bytes)
+        return PHashTool.to_hex(value) if value is not None else None
+
+    @staticmethod
+    def compute_int(image_bytes: bytes) -> Optional[int]:
+        """从二进制数据计算 pHash (64 位整数)"""
         if not HAS_LIB or not image_bytes:
             return None
+        return _compute_worker([image_bytes])[0]
+
+    @staticmethod
+    def compute_batch(items: Iterable[Tuple[Any, PHashSource]], workers: int = 0) -> Iterator[Tuple[Any, Optional[str]]]:
+        """
+        在进程池中批量计算 pHash
+        :param items: (key, 图片字节 或 归档路径) 序列；归档路径时计算封面
+        :param workers: 进程数，0 表示 CPU 核数，1 表示在当前进程中串行计算
+        :return: 按完成顺序迭代 (key, pHash)
+        """
+        if not HAS_LIB:
+            return
+        workers = workers or os.cpu_count() or 1
+        chunks = PHashTool._chunked(items, BATCH_CHUNK)
+
+        if workers <= 1:
+            for keys, sources in chunks:
+                for key, value in zip(keys, _compute_worker(sources)):
+                    yield key, PHashTool.to_hex(value)
+            return
+
+        # 限制在途任务数，避免一次性提交全部图片占用大量内存
+        max_inflight = workers * 2
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            inflight = {}
+            while True:
+                for keys, sources in chunks:
+                    inflight[executor.submit(_compute_worker, sources)] = keys
+                    if len(inflight) >= max_inflight:
+                        break
+                if not inflight:
+                    break
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    keys = inflight.pop(future)
+                    try:
+                        values = future.result()
+                    except Exception as e:
+                        logger.warning(f"⚠️ pHash 计算失败: {e}")
+                        values = [None] * len(keys)
+                    for key, value in zip(keys, values):
+                        yield key, PHashTool.to_hex(value)
+
+    @staticmethod
+    def _chunked(items: Iterable[Tuple[Any, PHashSource]], size: int) -> Iterator[Tuple[List[Any], List[PHashSource]]]:
+        keys, sources = [], []
+        for key, source in items:
+            keys.append(key)
+            sources.append(source)
+            if len(keys) >= size:
+                yield keys, sources
+                keys, sources = [], []
+        if keys:
+            yield keys, sources
+
+    @staticmethod
+    def to_int(hash_str: Optional[str]) -> Optional[int]:
+        """十六进制字符串 -> 64 位整数；无效时返回 None"""
+        if not hash_str:
+            return None
         try:
-            img = Image.open(io.BytesIO(image_bytes))
-            # hash_size=8 是默认值，生成 64位 hash
-            return str(imagehash.phash(img, hash_size=8))
-        except Exception as e:
-            logger.warning(f"⚠️ pHash 计算失败: {e}")
+            return int(hash_str, 16)
+        except (TypeError, ValueError):
             return None
 
+    @staticmethod
+    def to_hex(value: Optional[int]) -> Optional[str]:
+        return f"{value:016x}" if value is not None else None
+
+    @staticmethod
+    def distance(a: int, b: int) -> int:
+        """两个整数 pHash 的汉明距离"""
+        return _popcount(a ^ b)
+
     @staticmethod
     def calculate_distance(hash_str1: str, hash_str2: str) -> int:
         """计算两个 hash 字符串的汉明距离"""
-        if not HAS_LIB or not hash_str1 or not hash_str2:
+        h1, h2 = PHashTool.to_int(hash_str1), PHashTool.to_int(hash_str2)
+        if h1 is None or h2 is None:
             return 999
-        try:
-            h1 = imagehash.hex_to_hash(hash_str1)
-            h2 = imagehash.hex_to_hash(hash_str2)
-            return h1 - h2
-        except Exception:
-            return 999
-            
+        return _popcount(h1 ^ h2)
+
     @staticmethod
     def get_similarity_score(distance: int) -> float:
         """将汉明距离转换为 0.0-1.0 的相似度分值 (越接近1越相似)"""
         # 64位hash，距离0为1.0，距离>=32为0.5，距离64为0.0
-        return max(0.0, (64 - distance) / 64.0)
\ No newline at end of file
+        return max(0.0, (64 - distance) / 64.0)
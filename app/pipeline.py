@@ -0,0 +1,115 @@
+# app/pipeline.py
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+# 队列结束标记
+_SENTINEL = object()
+
+class ScanPipeline:
+    """
+    分阶段扫描流水线
+    1. 本地阶段：线程池提前计算归档指纹 (读盘/解压/Hash)，结果按顺序放入有界队列
+    2. 网络阶段：调用方单线程消费已就绪的指纹，只受请求频率限制
+
+    有界队列保证预读不会无限领先网络阶段，避免占满内存。
+    """
+    def __init__(self, prepare_func: Callable[[Path], Any],
+                 workers: int = 4, queue_size: int = 16):
+        """
+        :param prepare_func: 本地阶段处理函数 (只做本地 IO，不访问网络)
+        :param workers: 本地线程池大小
+        :param queue_size: 预读窗口 (已提交但尚未被网络阶段消费的文件数)
+        """
+        self.prepare_func = prepare_func
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self._stop_event = threading.Event()
+        # 已从输入中取出的文件数 / 输入是否已遍历完 (流式发现时用于显示进度)
+        self.submitted = 0
+        self.exhausted = False
+
+    def stop(self):
+        """通知本地阶段停止提交新任务"""
+        self._stop_event.set()
+
+    def iter_prepared(self, files: Iterable[Path]) -> Iterator[Tuple[Path, Any]]:
+        """
+        按输入顺序产出 (file_path, prepared)
+        prepared 为 prepare_func 的返回值；本地阶段异常时为 None
+        """
+        self._stop_event.clear()
+        self.submitted = 0
+        self.exhausted = False
+        pending: "queue.Queue" = queue.Queue(maxsize=self.queue_size)
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scan-local")
+
+        feeder = threading.Thread(
+            target=self._feed, args=(files, executor, pending),
+            name="scan-feeder", daemon=True
+        )
+        feeder.start()
+
+        try:
+            while True:
+                item = pending.get()
+                if item is _SENTINEL:
+                    break
+
+                file_path, future = item
+                try:
+                    prepared = future.result()
+                except Exception as e:
+                    logger.error(f"❌ [Pipeline] 本地阶段异常 {file_path.name}: {e}")
+                    prepared = None
+                yield file_path, prepared
+        finally:
+            # 消费方提前结束 (用户停止 / 异常) 时，取消尚未开始的本地任务
+            self._stop_event.set()
+            self._drain(pending)
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _feed(self, files: Iterable[Path], executor: ThreadPoolExecutor, pending: "queue.Queue"):
+        """生产者线程：遍历文件并提交到线程池 (队列满时阻塞)"""
+        try:
+            for file_path in files:
+                if self._stop_event.is_set():
+                    break
+                future = executor.submit(self.prepare_func, file_path)
+                if not self._put(pending, (file_path, future)):
+                    future.cancel()
+                    break
+                self.submitted += 1
+            else:
+                self.exhausted = True
+        except Exception as e:
+            logger.error(f"❌ [Pipeline] 文件遍历异常: {e}")
+        finally:
+            self._put(pending, _SENTINEL, force=True)
+
+    def _put(self, pending: "queue.Queue", item, force: bool = False) -> bool:
+        """带停止检测的阻塞写入"""
+        while force or not self._stop_event.is_set():
+            try:
+                pending.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                if force and self._stop_event.is_set():
+                    # 消费方已退出，直接丢弃旧任务腾出位置
+                    self._drain(pending)
+        return False
+
+    @staticmethod
+    def _drain(pending: "queue.Queue"):
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _SENTINEL:
+                item[1].cancel()
@@ -0,0 +1,109 @@
+# app/retry_queue.py
+import os
+import time
+import logging
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# 各失败原因的首次重试间隔 (小时)，之后每次失败翻倍；None 表示永久失败 (可在 config.RETRY_POLICY 中覆盖)
+DEFAULT_POLICY: Dict[str, Optional[float]] = {
+    'NETWORK': 0.5,
+    'META_FAILED': 1,
+    'NO_MATCH': 24,
+    'MISMATCH': 24,
+    'FILE_ERROR': 72,
+    'UNKNOWN': 6,
+    'NO_IMAGES': None,
+    'MISSING': None,
+}
+
+# 标题重扫只对 "搜不到 / 验证不符" 有意义；其他模式重试所有非永久失败
+MODE_REASONS = {
+    'title': ('NO_MATCH', 'MISMATCH'),
+}
+
+class RetryQueue:
+    """
+    失败重试队列 ({表名}_retry_queue)
+    记录每个失败文件的失败原因、连续失败次数、上次尝试的模式和下次可重试时间，
+    按原因指数退避；重试时只取已到期的条目 (next_eligible 索引)，
+    永久失败 (无图片 / 文件已删除) 不再消耗请求。
+    """
+    def __init__(self, db):
+        self.db = db
+        self.policy: Dict[str, Optional[float]] = {**DEFAULT_POLICY, **getattr(config, 'RETRY_POLICY', {})}
+        self.max_delay = getattr(config, 'RETRY_MAX_DELAY_HOURS', 24 * 30) * 3600
+
+    def failure(self, reason: str, mode: Optional[str] = None,
+                error: Optional[str] = None) -> Tuple[str, Optional[str], Optional[str], Optional[float], float]:
+        """
+        生成一次失败的重试队列更新，交给 db.save_record(retry=...) 随记录一起 (写缓冲内) 提交
+        同一模式、同一原因连续失败时次数累加、间隔翻倍，否则重新计数 (在写入 SQL 中完成)；
+        成功的记录保存时自动移出队列
+        """
+        base = self.policy.get(reason, self.policy.get('UNKNOWN'))
+        return reason, mode, error, (base * 3600 if base is not None else None), self.max_delay
+
+    def due(self, mode: str, force: bool = False) -> List[Path]:
+        """
+        取出本次可重试的文件 (仍存在的)
+        :param mode: 重试使用的搜索模式，决定哪些失败原因值得重试
+        :param force: 忽略退避时间 (永久失败仍然跳过)
+        """
+        reasons = MODE_REASONS.get(mode) or [r for r, base in self.policy.items() if base is not None]
+        rows = self.db.get_due_retries(list(reasons), float('inf') if force else time.time())
+
+        existing, missing, unknown = self._split_existing([row['file_path'] for row in rows])
+        if missing:
+            # 所在目录可以列出但文件已不在：不再重试 (新文件扫描再次发现时会重新处理)
+            self.db.mark_retries_permanent(missing, 'MISSING')
+
+        by_reason = defaultdict(int)
+        for row in rows:
+            by_reason[row['reason']] += 1
+        summary = ", ".join(f"{r}: {n}" for r, n in sorted(by_reason.items())) or "无"
+        logger.info(f"📊 重试统计: 到期 {len(rows)} 条 ({summary}) | 📁 文件存在 {len(existing)} | 已删除 {len(missing)}")
+        if unknown:
+            logger.warning(f"⚠️ {len(unknown)} 个文件所在目录无法访问 (网络盘离线 / 未挂载?)，本次跳过，保留在队列中")
+        return [Path(p) for p in existing]
+
+    @staticmethod
+    def _split_existing(paths: List[str]) -> Tuple[List[str], List[str], List[str]]:
+        """
+        按目录批量检查文件是否存在：每个目录只列一次，不再逐个 stat
+        :return: (存在, 已删除, 无法确定)；只有目录成功列出且其中没有该文件才算已删除，
+                 目录本身无法列出 (离线的网络盘、未挂载的磁盘、改名的库根目录等) 时无法确定
+        """
+        by_dir = defaultdict(list)
+        for path in paths:
+            by_dir[os.path.dirname(path)].append(path)
+
+        listing: Dict[str, Optional[set]] = {}
+        for directory in by_dir:
+            try:
+                listing[directory] = set(os.listdir(directory or '.'))
+            except OSError:
+                listing[directory] = None
+
+        existing, missing, unknown = [], [], []
+        for path in paths:
+            names = listing[os.path.dirname(path)]
+            if names is None:
+                unknown.append(path)
+            elif os.path.basename(path) in names:
+                existing.append(path)
+            else:
+                missing.append(path)
+        return existing, missing, unknown
+
+    def format_stats(self) -> str:
+        counts = self.db.count_retries_by_reason()
+        return ", ".join(
+            f"{reason}: {n}" + (f" (永久 {permanent})" if permanent else "")
+            for reason, (n, permanent) in sorted(counts.items())
+        ) or "空"
@@ -1,11 +1,13 @@
 # app/services.py
 import logging
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple, List
 
 from .database import DatabaseManager
 from .network import EHentaiHashSearcher
 from .validator import ScannerValidator
+from .retry_queue import RetryQueue
+from .exceptions import RequestCancelledError
 
 logger = logging.getLogger(__name__)
 
@@ -14,22 +16,46 @@ class ScannerService:
         self.db = db
         self.searcher = searcher
         self.validator = ScannerValidator(searcher, translator)
+        self.retry_queue = RetryQueue(db)
 
-    def process_file(self, file_path: Path, mode='cover') -> Dict[str, Any]:
+    def prepare_file(self, file_path: Path, mode='cover') -> Tuple[Optional[Any], str]:
         """
-        处理单个文件的主流程
+        流水线本地阶段：只计算指纹，不访问网络，可在线程池中并发执行
         """
-        file_name = file_path.name
+        if not file_path.exists():
+            return None, "FILE_ERROR"
+        try:
+            return self.searcher.prepare_archive(file_path, target=mode)
+        except Exception as e:
+            logger.error(f"❌ 指纹计算异常: {file_path.name} - {e}")
+            return None, "FILE_ERROR"
 
+    def process_file(self, file_path: Path, mode='cover',
+                     prepared: Optional[Tuple[Optional[Any], str]] = None) -> Dict[str, Any]:
+        """
+        处理单个文件的主流程 (搜索 + 立即验证)
+        :param prepared: prepare_file 的结果 (由流水线提前计算)
+        """
+        result = self.search_file(file_path, mode=mode, prepared=prepared)
+        if result.get('status') != 'PENDING':
+            return result
+        return self.resolve_pending([result], mode=mode)[0]
+
+    def search_file(self, file_path: Path, mode='cover',
+                    prepared: Optional[Tuple[Optional[Any], str]] = None) -> Dict[str, Any]:
+        """
+        搜索阶段：找到候选画廊后返回 status='PENDING' 的待验证项，
+        由 resolve_pending 批量获取元数据后统一验证；搜索失败则直接落库
+        """
         # 1. 基础检查
         if not file_path.exists():
-            return self._handle_failure(file_path, 'FAILED', 'File not found')
-            
-        clean_name = file_path.stem
+            return self._handle_failure(file_path, 'FAILED', 'File not found', reason='MISSING', mode=mode)
 
         # 2. 执行搜索 (Hash 或 Title)
         try:
-            search_res = self.searcher.process_archive(file_path, target=mode)
+            search_res = self.searcher.process_archive(file_path, target=mode, prepared=prepared)
+        except RequestCancelledError:
+            return self._handle_cancelled(file_path)
         except Exception as e:
             logger.error(f"❌ 搜索异常: {e}")
             search_res = f"ERROR: {str(e)}"
@@ -37,10 +63,81 @@ class ScannerService:
         # 3. 处理搜索结果无效的情况
         if not search_res or not search_res.startswith('http'):
             note = self._map_error_to_note(search_res)
-            return self._handle_failure(file_path, 'FAILED', note, search_res)
+            return self._handle_failure(file_path, 'FAILED', note, search_res,
+                                        reason=self._map_error_to_reason(search_res), mode=mode)
+
+        return {
+            'status': 'PENDING',
+            'file_name': file_path.name,
+            'file_path': file_path,
+            'url': search_res,
+            'candidates': self.searcher.get_candidates(search_res),
+        }
+
+    def resolve_pending(self, pending: List[Dict[str, Any]], mode='cover') -> List[Dict[str, Any]]:
+        """
+        验证阶段：合并多个文件的画廊 URL，通过 gdata 批量请求取回元数据后逐个交给 Validator
+        首轮只请求各文件的首个结果；仅首个结果验证不符的文件才在第二轮批量请求其搜索页候选
+        """
+        if not pending:
+            return []
+
+        try:
+            metas = self.searcher.get_gallery_metadata_batch([item['url'] for item in pending])
+        except RequestCancelledError:
+            return [self._handle_cancelled(item['file_path']) for item in pending]
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(pending)
+        verdicts: Dict[int, Tuple[bool, Optional[str], str]] = {}
+        for i, item in enumerate(pending):
+            url = item['url']
+            try:
+                verdicts[i] = self.validator.evaluate_scan_result(
+                    item['file_path'].stem, url, mode=mode, meta=metas.get(url), prefetched=url in metas
+                )
+            except RequestCancelledError:
+                results[i] = self._handle_cancelled(item['file_path'])
+
+        retry = [i for i, verdict in verdicts.items() if not verdict[0] and pending[i].get('candidates')]
+        if retry:
+            try:
+                metas.update(self.searcher.get_gallery_metadata_batch(
+                    [url for i in retry for url in pending[i]['candidates']]
+                ))
+            except RequestCancelledError:
+                for i in retry:
+                    results[i] = self._handle_cancelled(pending[i]['file_path'])
+                    del verdicts[i]
+
+        for i, verdict in verdicts.items():
+            results[i] = self._resolve_item(pending[i], verdict, metas, mode)
+        return results
+
+    def _resolve_item(self, item: Dict[str, Any], verdict: Tuple[bool, Optional[str], str],
+                      metas: Dict[str, Optional[Dict]], mode: str) -> Dict[str, Any]:
+        """
+        落库单个待处理项的验证结果
+        :param verdict: 首个结果的验证结果；不符时依次尝试同一搜索页上的其他候选
+        """
+        file_path = item['file_path']
+        file_name = file_path.name
+        clean_name = file_path.stem
 
         # 4. 验证结果 (Validator)
-        is_valid, final_title, final_tags = self.validator.evaluate_scan_result(clean_name, search_res, mode=mode)
+        search_res = item['url']
+        try:
+            if not verdict[0]:
+                for url in item.get('candidates', []):
+                    result = self.validator.evaluate_scan_result(
+                        clean_name, url, mode=mode, meta=metas.get(url), prefetched=url in metas
+                    )
+                    if result[0]:
+                        search_res, verdict = url, result
+                        break
+        except RequestCancelledError:
+            return self._handle_cancelled(file_path)
+
+        is_valid, final_title, final_tags = verdict
 
         if is_valid:
             # === 成功 ===
@@ -65,17 +162,25 @@ class ScannerService:
                 url=search_res,
                 title=final_title or "Unknown",
                 tags=final_tags,
-                note=note
+                note=note,
+                retry=self.retry_queue.failure('MISMATCH' if final_title else 'META_FAILED', mode, note)
             )
             logger.warning(f"⚠️ [验证不符] {file_name} | 原因: {note}")
             return {'status': status_code, 'file_name': file_name, 'note': note}
 
-    def _handle_failure(self, file_path: Path, status: str, note: str, url: str = None) -> Dict:
-        """统一处理失败落库"""
-        self.db.save_record(file_path, status=status, note=note, url=url)
+    def _handle_failure(self, file_path: Path, status: str, note: str, url: str = None,
+                        reason: str = 'UNKNOWN', mode: Optional[str] = None) -> Dict:
+        """统一处理失败落库，并加入重试队列 (随记录在同一事务内写入)"""
+        self.db.save_record(file_path, status=status, note=note, url=url,
+                            retry=self.retry_queue.failure(reason, mode, note))
         logger.info(f"🌑 [处理失败] {file_path.name} | 原因: {note}")
         return {'status': status, 'file_name': file_path.name, 'note': note}
 
+    def _handle_cancelled(self, file_path: Path) -> Dict:
+        """请求在排队时被用户取消：不落库，下次扫描会重新处理"""
+        logger.info(f"🛑 [已取消] {file_path.name}")
+        return {'status': 'CANCELLED', 'file_name': file_path.name, 'note': '用户停止'}
+
     def _map_error_to_note(self, search_res: str) -> str:
         """将搜索错误码映射为人类可读的备注"""
         if search_res == "NO_MATCH":
@@ -86,4 +191,13 @@ class ScannerService:
             return "文件读取或解压失败"
         if search_res and search_res.startswith("ERROR"):
             return f"搜索错误: {search_res}"
-        return "搜索无结果或未知错误"
\ No newline at end of file
+        return "搜索无结果或未知错误"
+
+    def _map_error_to_reason(self, search_res: str) -> str:
+        """将搜索错误码映射为重试队列的失败原因 (决定退避策略)"""
+        if search_res in ("NO_MATCH", "NO_IMAGES", "FILE_ERROR"):
+            return search_res
+        if not search_res or search_res.startswith("ERROR"):
+            # 请求失败 / 异常，多为临时网络问题
+            return "NETWORK"
+        return "UNKNOWN"
\ No newline at end of file
@@ -132,6 +132,18 @@ def cjk_tokenize(text: str) -> list:
     
     return tokens
 
+def cjk_search_terms(text: str) -> list:
+    """
+    全文检索用的查询词切分 (与 cjk_tokenize 同样区分英文/数字与 CJK)
+    区别：连续的 CJK 字符保留为一个词 (如 "海贼王" 不拆成单字)，以便按子串匹配；
+    CJK 串内的标点 (【】、「」等) 作为分隔符
+    """
+    if not text: return []
+    terms = []
+    for run in re.findall(r'[a-z0-9]+|[^\u0000-\u007F]+', text.lower()):
+        terms.extend(re.findall(r'[^\W_]+', run))
+    return terms
+
 def calculate_cjk_ordered_score(filename: str, title: str) -> float:
     """
     支持 CJK 的有序序列相似度算法
@@ -1,6 +1,6 @@
 # app/validator.py
 import logging
-from typing import Tuple, Optional, List
+from typing import Tuple, Optional, List, Dict
 
 # 确保 app/utils.py 里有 calculate_hybrid_similarity
 from .utils import calculate_hybrid_similarity, parse_gallery_title
@@ -107,13 +107,18 @@ class ScannerValidator:
                     
         return False
 
-    def evaluate_scan_result(self, clean_name: str, scan_url: str, mode: str = 'cover') -> Tuple[bool, Optional[str], str]:
+    def evaluate_scan_result(self, clean_name: str, scan_url: str, mode: str = 'cover',
+                             meta: Optional[Dict] = None, prefetched: bool = False) -> Tuple[bool, Optional[str], str]:
         """
         执行验证流程
         :param mode: 当前扫描模式，如果是 'title' 则开启严格匹配
+        :param meta: 已批量预取的元数据
+        :param prefetched: 该 URL 已在批量请求中尝试过 (meta 为 None 表示请求失败 / 画廊返回错误)，
+                           此时不再单独请求，避免 API 异常时一次批量失败变成逐个重试
         """
         # 0. 获取元数据
-        meta = self.searcher.get_gallery_metadata(scan_url)
+        if meta is None and not prefetched:
+            meta = self.searcher.get_gallery_metadata(scan_url)
         if not meta:
             logger.warning(f"⚠️ 无法获取元数据: {scan_url}")
             return False, None, ""
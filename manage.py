@@ -1,6 +1,7 @@
 # manage.py
 import argparse
 import sys
+import time
 import logging
 from app import config
 from app.logger import setup_logging
@@ -13,9 +14,25 @@ def main():
     parser = argparse.ArgumentParser(description="E-Hentai Scanner Manager")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
-    subparsers.add_parser("scan", help="[CLI] 扫描新文件")
-    subparsers.add_parser("retry", help="[CLI] 重试失败项")
-    subparsers.add_parser("dedup", help="[CLI] 命令行去重")
+    scan_parser = subparsers.add_parser("scan", help="[CLI] 扫描新文件")
+    scan_parser.add_argument("--mode", choices=["cover", "second", "multi"], help="本次扫描的模式 (默认 config.DEFAULT_MODE)")
+    retry_parser = subparsers.add_parser("retry", help="[CLI] 重试失败项 (按失败原因退避，只取到期的)")
+    retry_parser.add_argument("--force", action="store_true", help="忽略退避时间 (永久失败仍跳过)")
+    dedup_parser = subparsers.add_parser("dedup", help="[CLI] 命令行去重 (默认增量)")
+    dedup_parser.add_argument("--full", action="store_true", help="清空查重结果并全量重建")
+    backup_parser = subparsers.add_parser("backup", help="[CLI] 在线备份数据库 (扫描时也可执行)")
+    backup_parser.add_argument("--compress", action="store_true", default=None, help="VACUUM INTO 后 gzip 压缩")
+    query_parser = subparsers.add_parser("query", help="[CLI] 按标签查询已入库的画廊")
+    query_parser.add_argument("--tag", action="append", default=[], help="标签 namespace:name，可重复 (AND)")
+    query_parser.add_argument("--namespace", action="append", default=[], help="含有该命名空间下任意标签，可重复 (AND)")
+    query_parser.add_argument("--all-status", action="store_true", help="包含非 SUCCESS 记录")
+    query_parser.add_argument("--limit", type=int, default=100)
+    query_parser.add_argument("--rebuild-tags", action="store_true", help="按主表 tags 字段重建标签表 (外部工具修改主表后使用)")
+    search_parser = subparsers.add_parser("search", help="[CLI] 全文检索文件名/标题/标签 (按相关度排序)")
+    search_parser.add_argument("text", nargs="?", default="", help="检索词 (中日文与英文混合均可)")
+    search_parser.add_argument("--all-status", action="store_true", help="包含非 SUCCESS 记录")
+    search_parser.add_argument("--limit", type=int, default=20)
+    search_parser.add_argument("--rebuild", action="store_true", help="从主表重建全文索引")
     
     # 新增 gui 命令
     subparsers.add_parser("gui", help="[GUI] 启动图形界面 (推荐)")
@@ -37,11 +54,37 @@ def main():
     controller = AppController()
     try:
         if args.command == "scan":
-            controller.scan_new_files()
+            controller.scan_new_files(mode=args.mode)
         elif args.command == "retry":
-            controller.retry_failures()
+            controller.retry_failures(force=args.force)
         elif args.command == "dedup":
-            controller.run_deduplication()
+            controller.run_deduplication(full=args.full)
+        elif args.command == "backup":
+            controller.backup_database(compress=args.compress)
+        elif args.command == "query":
+            # 首次启动时标签表在后台迁移，查询前等待完成以保证结果完整
+            controller.db.wait_tags_backfill()
+            if args.rebuild_tags:
+                print(f"🏷️ 标签表重建完成: {controller.db.sync_tags()} 条记录")
+                if not (args.tag or args.namespace):
+                    return
+            start = time.perf_counter()
+            rows = controller.db.query_by_tags(
+                args.tag, args.namespace, status=None if args.all_status else 'SUCCESS', limit=args.limit
+            )
+            for row in rows:
+                print(f"[{row['status']}] {row['file_path']}\n    {row['title'] or ''} {row['gallery_url'] or ''}")
+            print(f"🏷️ 共 {len(rows)} 条 ({(time.perf_counter() - start) * 1000:.1f} ms)")
+        elif args.command == "search":
+            if args.rebuild:
+                print("🔎 全文索引重建完成" if controller.db.rebuild_fts() else "❌ 全文索引不可用或重建失败")
+            if args.text:
+                start = time.perf_counter()
+                rows = controller.db.search(args.text, status=None if args.all_status else 'SUCCESS', limit=args.limit)
+                for row in rows:
+                    score = f"{row['score']:.2f}" if row['score'] is not None else "-"
+                    print(f"[{score}] [{row['status']}] {row['file_path']}\n    {row['title'] or ''} {row['gallery_url'] or ''}")
+                print(f"🔎 共 {len(rows)} 条 ({(time.perf_counter() - start) * 1000:.1f} ms)")
     except KeyboardInterrupt:
         print("\n🛑 用户终止")
     except Exception as e:
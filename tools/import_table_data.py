@@ -9,6 +9,7 @@ project_root = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(project_root))
 
 from app import config
+from app.database.manager import DatabaseManager
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
@@ -33,6 +34,7 @@ def import_custom_csv(csv_file_path: str):
 
     success_count = 0
     error_count = 0
+    imported_ids = []
 
     try:
         with open(csv_path, 'r', encoding='utf-8-sig') as f:
@@ -68,10 +70,11 @@ def import_custom_csv(csv_file_path: str):
                     # 注意：数据库还有一个 'note' 字段，CSV 里没有，这里给默认空字符串
                     note = row.get('note', '') 
 
-                    # 使用 INSERT OR REPLACE 
-                    # 这样如果 ID 或 file_path (UNIQUE) 冲突，会覆盖旧数据
+                    # 如果 ID 或 file_path (UNIQUE) 冲突，先显式删除旧数据再插入 (覆盖)
+                    # 不使用 INSERT OR REPLACE：其隐式删除不会触发删除触发器，全文索引和标签表会与主表不一致
+                    cursor.execute("DELETE FROM scan_results WHERE file_path = ? OR id = ?", (file_path, row_id))
                     sql = """
-                    INSERT OR REPLACE INTO scan_results 
+                    INSERT INTO scan_results 
                     (id, file_path, file_name, gallery_url, title, tags, status, scan_time, note)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                     """
@@ -87,6 +90,7 @@ def import_custom_csv(csv_file_path: str):
                         scan_time,
                         note
                     ))
+                    imported_ids.append(cursor.lastrowid)
                     
                     success_count += 1
                     if success_count % 100 == 0:
@@ -100,6 +104,14 @@ def import_custom_csv(csv_file_path: str):
             conn.commit()
             logger.info(f"\n✅ 导入完成! 成功: {success_count}, 失败: {error_count}")
 
+        # 标签表由应用维护：按导入记录的 tags 字符串写入标签关联
+        if imported_ids:
+            db = DatabaseManager(config.DB_PATH, "scan_results")
+            try:
+                logger.info(f"🏷️ 已同步 {db.sync_tags(imported_ids)} 条记录的标签")
+            finally:
+                db.close()
+
     except Exception as e:
         if conn:
             conn.rollback()